@@ -0,0 +1,82 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Storage backends.
+# Everything talks to storage through an aioredis-style pool and connections. The backend decides what is behind them:
+# a real redis server, or an in-process implementation of the subset of redis we use.
+import logging
+
+logger = logging.getLogger("NavalBot")
+
+_backend = None
+
+
+class Backend:
+    """
+    A storage backend.
+
+    Connections from a backend behave like `aioredis.Redis` connections, for the commands NavalBot uses.
+    """
+
+    #: If False, there's no other process that could change the data, so cache invalidation isn't needed.
+    shared = True
+
+    def __init__(self, config: dict):
+        self.config = config
+
+    async def create_pool(self):
+        """
+        Creates a connection pool. Connections are borrowed with `async with pool.get() as conn`.
+        """
+        raise NotImplementedError
+
+    async def create_connection(self, encoding: str = None):
+        """
+        Creates a dedicated connection, i.e for subscribing to channels.
+        """
+        raise NotImplementedError
+
+    async def close(self):
+        pass
+
+
+def get_backend(config: dict) -> Backend:
+    """
+    Gets the storage backend, creating it from the `redis` config section the first time.
+    """
+    global _backend
+    if _backend is None:
+        name = config.get("backend", "redis")
+        if name == "redis":
+            from navalbot.api.backends.redis import RedisBackend
+            _backend = RedisBackend(config)
+        elif name == "memory":
+            from navalbot.api.backends.memory import MemoryBackend
+            _backend = MemoryBackend(config)
+        elif name == "sqlite":
+            from navalbot.api.backends.sqlite import SqliteBackend
+            _backend = SqliteBackend(config)
+        else:
+            raise ValueError("Unknown storage backend `{}`".format(name))
+        logger.info("Using the {} storage backend.".format(name))
+    return _backend
@@ -0,0 +1,713 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# An in-process storage backend.
+# This implements the subset of redis that NavalBot uses, so small deployments, tests and benchmarks don't need a
+# redis server. Data lives in this process only, so it can't be shared between shards.
+import asyncio
+import collections
+import fnmatch
+import json
+import logging
+import os
+import time
+
+import aioredis
+
+from navalbot.api.backends import Backend
+
+logger = logging.getLogger("NavalBot")
+
+_NOTSET = object()
+
+# Keyspace notification class for each event, as used in `notify-keyspace-events`.
+_EVENT_CLASSES = {"set": "$", "incrby": "$", "del": "g", "expire": "g", "expired": "x", "sadd": "s", "srem": "s",
+                  "hset": "h", "hdel": "h"}
+_ALL_CLASSES = "g$lshzxe"
+
+
+def _to_bytes(value) -> bytes:
+    if isinstance(value, bytes):
+        return value
+    if isinstance(value, str):
+        return value.encode()
+    if isinstance(value, (int, float)):
+        return str(value).encode()
+    raise TypeError("Cannot store a value of type {}".format(type(value).__name__))
+
+
+def _to_key(key) -> str:
+    return key.decode() if isinstance(key, bytes) else str(key)
+
+
+def _decode(value, encoding):
+    if encoding is None:
+        return value
+    if isinstance(value, bytes):
+        return value.decode(encoding)
+    if isinstance(value, list):
+        return [_decode(v, encoding) for v in value]
+    if isinstance(value, tuple):
+        return tuple(_decode(v, encoding) for v in value)
+    if isinstance(value, dict):
+        return {_decode(k, encoding): _decode(v, encoding) for k, v in value.items()}
+    return value
+
+
+def _wrong_type():
+    return aioredis.ReplyError("WRONGTYPE Operation against a key holding the wrong kind of value")
+
+
+class MemoryChannel:
+    """
+    A subscribed channel, with the same interface as `aioredis.Channel`.
+    """
+
+    def __init__(self, name: str, is_pattern: bool, encoding: str = None):
+        self.name = name.encode()
+        self.is_pattern = is_pattern
+        self._encoding = encoding
+        self._messages = collections.deque()
+        self._ready = asyncio.Event()
+        self._closed = False
+
+    @property
+    def is_active(self) -> bool:
+        return not self._closed
+
+    def put(self, channel: str, message: bytes):
+        message = _decode(message, self._encoding)
+        if self.is_pattern:
+            message = (_decode(channel.encode(), self._encoding), message)
+        self._messages.append(message)
+        self._ready.set()
+
+    def close(self):
+        self._closed = True
+        self._ready.set()
+
+    async def wait_message(self) -> bool:
+        """
+        Waits for a message, returning False if the channel was closed instead.
+        """
+        if not self._messages:
+            await self._ready.wait()
+        return bool(self._messages)
+
+    async def get(self):
+        if not self._messages:
+            if not await self.wait_message():
+                return None
+        message = self._messages.popleft()
+        if not self._messages and not self._closed:
+            self._ready.clear()
+        return message
+
+
+class MemoryStore:
+    """
+    The data behind the in-memory backend.
+
+    Commands are the `cmd_` methods, named like the `aioredis.Redis` methods. Values are stored as bytes, sets
+    as sets of bytes, and hashes as dicts of bytes to bytes. Expiry times are wall clock times, so they survive a snapshot.
+    """
+
+    def __init__(self, db: int = 0):
+        self.db = db
+        self.config = {"notify-keyspace-events": ""}
+        self.dirty = False
+
+        self._data = {}
+        self._expires = {}
+        self._channels = collections.defaultdict(set)
+        self._patterns = collections.defaultdict(set)
+
+    # Internals.
+    def _lookup(self, key: str, type_=None):
+        deadline = self._expires.get(key)
+        if deadline is not None and deadline <= time.time():
+            self._delete(key)
+            self._notify(key, "expired")
+            return None
+        value = self._data.get(key)
+        if value is not None and type_ is not None and not isinstance(value, type_):
+            raise _wrong_type()
+        return value
+
+    def _delete(self, key: str) -> bool:
+        self._expires.pop(key, None)
+        if self._data.pop(key, None) is None:
+            return False
+        self.dirty = True
+        return True
+
+    def _notify(self, key: str, event: str):
+        flags = self.config["notify-keyspace-events"]
+        if "K" not in flags:
+            return
+        cls = _EVENT_CLASSES.get(event, "g")
+        if cls not in flags and not ("A" in flags and cls in _ALL_CLASSES):
+            return
+        self.cmd_publish("__keyspace@{}__:{}".format(self.db, key), event)
+
+    def purge_expired(self) -> int:
+        """
+        Deletes every expired key, returning how many there were.
+        """
+        now = time.time()
+        expired = [key for key, deadline in self._expires.items() if deadline <= now]
+        for key in expired:
+            self._delete(key)
+            self._notify(key, "expired")
+        return len(expired)
+
+    def subscribe(self, name: str, is_pattern: bool, encoding: str = None) -> MemoryChannel:
+        channel = MemoryChannel(name, is_pattern, encoding)
+        (self._patterns if is_pattern else self._channels)[name].add(channel)
+        return channel
+
+    def unsubscribe(self, channel: MemoryChannel):
+        registry = self._patterns if channel.is_pattern else self._channels
+        name = channel.name.decode()
+        registry[name].discard(channel)
+        if not registry[name]:
+            del registry[name]
+        channel.close()
+
+    # Snapshots.
+    def dump(self) -> dict:
+        """
+        Dumps the data as JSON-safe types. Bytes are stored as latin-1, which round trips any byte string.
+        """
+        self.purge_expired()
+        strings, sets, hashes = {}, {}, {}
+        for key, value in self._data.items():
+            if isinstance(value, set):
+                sets[key] = [v.decode("latin-1") for v in value]
+            elif isinstance(value, dict):
+                hashes[key] = {f.decode("latin-1"): v.decode("latin-1") for f, v in value.items()}
+            else:
+                strings[key] = value.decode("latin-1")
+        return {"db": self.db, "strings": strings, "sets": sets, "hashes": hashes, "expires": dict(self._expires)}
+
+    def load(self, data: dict):
+        self._data = {key: value.encode("latin-1") for key, value in data.get("strings", {}).items()}
+        self._data.update({key: {v.encode("latin-1") for v in value} for key, value in data.get("sets", {}).items()})
+        self._data.update({key: {f.encode("latin-1"): v.encode("latin-1") for f, v in value.items()}
+                           for key, value in data.get("hashes", {}).items()})
+        self._expires = {key: deadline for key, deadline in data.get("expires", {}).items() if key in self._data}
+        self.purge_expired()
+        self.dirty = False
+
+    # Commands.
+    def cmd_ping(self):
+        return b"PONG"
+
+    def cmd_get(self, key):
+        return self._lookup(_to_key(key), bytes)
+
+    def cmd_mget(self, key, *keys):
+        return [self._lookup(_to_key(k), bytes) for k in (key,) + keys]
+
+    def cmd_set(self, key, value, *, expire=0, pexpire=0, exist=None):
+        key = _to_key(key)
+        exists = self._lookup(key) is not None
+        if exist == getattr(aioredis.Redis, "SET_IF_NOT_EXIST", "SET_IF_NOT_EXIST") and exists:
+            return False
+        if exist == getattr(aioredis.Redis, "SET_IF_EXIST", "SET_IF_EXIST") and not exists:
+            return False
+        self._data[key] = _to_bytes(value)
+        self._expires.pop(key, None)
+        if expire or pexpire:
+            self._expires[key] = time.time() + (expire or pexpire / 1000)
+        self.dirty = True
+        self._notify(key, "set")
+        return True
+
+    def cmd_incrby(self, key, increment):
+        key = _to_key(key)
+        value = self._lookup(key, bytes)
+        try:
+            value = int(value or 0) + increment
+        except ValueError:
+            raise aioredis.ReplyError("ERR value is not an integer or out of range")
+        self._data[key] = _to_bytes(value)
+        self.dirty = True
+        self._notify(key, "incrby")
+        return value
+
+    def cmd_incr(self, key):
+        return self.cmd_incrby(key, 1)
+
+    def cmd_delete(self, key, *keys):
+        deleted = 0
+        for k in (key,) + keys:
+            k = _to_key(k)
+            if self._lookup(k) is not None and self._delete(k):
+                deleted += 1
+                self._notify(k, "del")
+        return deleted
+
+    def cmd_exists(self, key):
+        return int(self._lookup(_to_key(key)) is not None)
+
+    def cmd_expire(self, key, timeout):
+        key = _to_key(key)
+        if self._lookup(key) is None:
+            return 0
+        self._expires[key] = time.time() + timeout
+        self.dirty = True
+        self._notify(key, "expire")
+        return 1
+
+    def cmd_ttl(self, key):
+        key = _to_key(key)
+        if self._lookup(key) is None:
+            return -2
+        deadline = self._expires.get(key)
+        return -1 if deadline is None else max(0, int(round(deadline - time.time())))
+
+    def cmd_sadd(self, key, member, *members):
+        key = _to_key(key)
+        value = self._lookup(key, set)
+        if value is None:
+            value = self._data[key] = set()
+        before = len(value)
+        value.update(_to_bytes(m) for m in (member,) + members)
+        added = len(value) - before
+        if added:
+            self.dirty = True
+            self._notify(key, "sadd")
+        return added
+
+    def cmd_srem(self, key, member, *members):
+        key = _to_key(key)
+        value = self._lookup(key, set)
+        if value is None:
+            return 0
+        before = len(value)
+        value.difference_update(_to_bytes(m) for m in (member,) + members)
+        removed = before - len(value)
+        if not value:
+            self._delete(key)
+        if removed:
+            self.dirty = True
+            self._notify(key, "srem")
+        return removed
+
+    def cmd_smembers(self, key):
+        return list(self._lookup(_to_key(key), set) or ())
+
+    def cmd_sismember(self, key, member):
+        return int(_to_bytes(member) in (self._lookup(_to_key(key), set) or ()))
+
+    def cmd_scard(self, key):
+        return len(self._lookup(_to_key(key), set) or ())
+
+    def cmd_hget(self, key, field):
+        return (self._lookup(_to_key(key), dict) or {}).get(_to_bytes(field))
+
+    def cmd_hmget(self, key, field, *fields):
+        value = self._lookup(_to_key(key), dict) or {}
+        return [value.get(_to_bytes(f)) for f in (field,) + fields]
+
+    def cmd_hgetall(self, key):
+        return dict(self._lookup(_to_key(key), dict) or {})
+
+    def cmd_hscan(self, key, cursor=0, match=None, count=None):
+        fields = self.cmd_hgetall(key).items()
+        if match is not None:
+            match = _to_key(match)
+            fields = [(f, v) for f, v in fields if fnmatch.fnmatchcase(f.decode("latin-1"), match)]
+        return 0, list(fields)
+
+    def cmd_hlen(self, key):
+        return len(self._lookup(_to_key(key), dict) or ())
+
+    def cmd_hexists(self, key, field):
+        return int(_to_bytes(field) in (self._lookup(_to_key(key), dict) or ()))
+
+    def cmd_hset(self, key, field, value):
+        key, field = _to_key(key), _to_bytes(field)
+        current = self._lookup(key, dict)
+        if current is None:
+            current = self._data[key] = {}
+        added = int(field not in current)
+        current[field] = _to_bytes(value)
+        self.dirty = True
+        self._notify(key, "hset")
+        return added
+
+    def cmd_hsetnx(self, key, field, value):
+        if self.cmd_hexists(key, field):
+            return 0
+        return self.cmd_hset(key, field, value)
+
+    def cmd_hmset(self, key, field, value, *pairs):
+        if len(pairs) % 2:
+            raise aioredis.ReplyError("ERR wrong number of arguments for 'hmset' command")
+        key = _to_key(key)
+        current = self._lookup(key, dict)
+        if current is None:
+            current = self._data[key] = {}
+        pairs = (field, value) + pairs
+        for i in range(0, len(pairs), 2):
+            current[_to_bytes(pairs[i])] = _to_bytes(pairs[i + 1])
+        self.dirty = True
+        self._notify(key, "hset")
+        return True
+
+    def cmd_hdel(self, key, field, *fields):
+        key = _to_key(key)
+        current = self._lookup(key, dict)
+        if current is None:
+            return 0
+        removed = 0
+        for f in (field,) + fields:
+            if current.pop(_to_bytes(f), None) is not None:
+                removed += 1
+        if not current:
+            self._delete(key)
+        if removed:
+            self.dirty = True
+            self._notify(key, "hdel")
+        return removed
+
+    def cmd_keys(self, pattern):
+        self.purge_expired()
+        pattern = _to_key(pattern)
+        return [key.encode() for key in self._data if fnmatch.fnmatchcase(key, pattern)]
+
+    def cmd_scan(self, cursor=0, match=None, count=None):
+        # Everything comes back in one batch, which is a valid (if unusual) answer for SCAN.
+        return 0, self.cmd_keys(match or "*")
+
+    def cmd_sscan(self, key, cursor=0, match=None, count=None):
+        members = self.cmd_smembers(key)
+        if match is not None:
+            match = _to_key(match)
+            members = [m for m in members if fnmatch.fnmatchcase(m.decode("latin-1"), match)]
+        return 0, members
+
+    def cmd_flushdb(self):
+        self._data.clear()
+        self._expires.clear()
+        self.dirty = True
+        return True
+
+    def cmd_publish(self, channel, message):
+        channel = _to_key(channel)
+        message = _to_bytes(message)
+        receivers = list(self._channels.get(channel, ()))
+        for pattern, subscribed in self._patterns.items():
+            if fnmatch.fnmatchcase(channel, pattern):
+                receivers.extend(subscribed)
+        for receiver in receivers:
+            receiver.put(channel, message)
+        return len(receivers)
+
+    def cmd_config_get(self, parameter="*"):
+        parameter = _to_key(parameter)
+        return {k: v for k, v in self.config.items() if fnmatch.fnmatchcase(k, parameter)}
+
+    def cmd_config_set(self, parameter, value):
+        parameter = _to_key(parameter)
+        if parameter not in self.config:
+            raise aioredis.ReplyError("ERR Unsupported CONFIG parameter: {}".format(parameter))
+        self.config[parameter] = _to_key(value)
+        return True
+
+
+def _command(name: str):
+    def method(self, *args, **kwargs):
+        return self.execute(name, *args, **kwargs)
+
+    method.__name__ = name
+    return method
+
+
+class _ScanIter:
+    """
+    Async iterator over SCAN results, like `aioredis.Redis.iscan`.
+    """
+
+    def __init__(self, scan):
+        self._scan = scan
+        self._items = None
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if self._items is None:
+            _, items = await self._scan()
+            self._items = iter(items)
+        try:
+            return next(self._items)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class _MemoryPipeline:
+    """
+    Queues commands, and runs them in order on `execute`.
+
+    Every command returns a future, like an aioredis pipeline.
+    """
+
+    def __init__(self, conn: 'MemoryConnection'):
+        self._conn = conn
+        self._calls = []
+
+    def __getattr__(self, name):
+        method = getattr(self._conn, name)
+
+        def queued(*args, **kwargs):
+            fut = asyncio.Future()
+            self._calls.append((method, args, kwargs, fut))
+            return fut
+
+        return queued
+
+    async def execute(self, *, return_exceptions=False):
+        calls, self._calls = self._calls, []
+        results, failed = [], False
+        for method, args, kwargs, fut in calls:
+            try:
+                result = await method(*args, **kwargs)
+            except aioredis.RedisError as e:
+                failed = True
+                fut.set_exception(e)
+                # Mark it as retrieved; the error is reported below.
+                fut.exception()
+                results.append(e)
+            else:
+                fut.set_result(result)
+                results.append(result)
+        if failed and not return_exceptions:
+            raise getattr(aioredis, "PipelineError", aioredis.RedisError)(results)
+        return results
+
+
+class MemoryConnection(aioredis.Redis):
+    """
+    A connection to a `MemoryStore`.
+
+    This subclasses `aioredis.Redis` so it can be used anywhere a redis connection is expected, but it has no socket;
+    every command goes through `execute`, and returns an already completed future.
+    """
+
+    def __init__(self, store: MemoryStore, encoding: str = None):
+        # The parent __init__ isn't called, as there's no connection to wrap.
+        self._store = store
+        self._encoding = encoding
+        self._closed = False
+        self._subscribed = []
+
+    def __repr__(self):
+        return "<MemoryConnection db:{}>".format(self._store.db)
+
+    @property
+    def encoding(self):
+        return self._encoding
+
+    @property
+    def db(self):
+        return self._store.db
+
+    @property
+    def closed(self):
+        return self._closed
+
+    def close(self):
+        for channel in self._subscribed:
+            self._store.unsubscribe(channel)
+        self._subscribed = []
+        self._closed = True
+
+    async def wait_closed(self):
+        pass
+
+    def execute(self, command, *args, encoding=_NOTSET, **kwargs):
+        fut = asyncio.Future()
+        try:
+            result = getattr(self._store, "cmd_" + _to_key(command).lower())(*args, **kwargs)
+        except AttributeError:
+            fut.set_exception(aioredis.ReplyError("ERR unknown command '{}'".format(_to_key(command))))
+        except (aioredis.RedisError, TypeError) as e:
+            fut.set_exception(e)
+        else:
+            fut.set_result(_decode(result, self._encoding if encoding is _NOTSET else encoding))
+        return fut
+
+    ping = _command("ping")
+    get = _command("get")
+    mget = _command("mget")
+    set = _command("set")
+    incr = _command("incr")
+    incrby = _command("incrby")
+    delete = _command("delete")
+    exists = _command("exists")
+    expire = _command("expire")
+    ttl = _command("ttl")
+    sadd = _command("sadd")
+    srem = _command("srem")
+    smembers = _command("smembers")
+    sismember = _command("sismember")
+    scard = _command("scard")
+    hget = _command("hget")
+    hmget = _command("hmget")
+    hgetall = _command("hgetall")
+    hscan = _command("hscan")
+    hlen = _command("hlen")
+    hexists = _command("hexists")
+    hset = _command("hset")
+    hsetnx = _command("hsetnx")
+    hmset = _command("hmset")
+    hdel = _command("hdel")
+    keys = _command("keys")
+    scan = _command("scan")
+    sscan = _command("sscan")
+    flushdb = _command("flushdb")
+    publish = _command("publish")
+    config_get = _command("config_get")
+    config_set = _command("config_set")
+
+    def iscan(self, *, match=None, count=None):
+        return _ScanIter(lambda: self.scan(0, match=match, count=count))
+
+    def isscan(self, key, *, match=None, count=None):
+        return _ScanIter(lambda: self.sscan(key, 0, match=match, count=count))
+
+    def pipeline(self):
+        return _MemoryPipeline(self)
+
+    def multi_exec(self):
+        # Nothing else can run between the commands, so a pipeline is already atomic.
+        return _MemoryPipeline(self)
+
+    async def subscribe(self, channel, *channels):
+        subscribed = [self._store.subscribe(_to_key(c), False, self._encoding) for c in (channel,) + channels]
+        self._subscribed.extend(subscribed)
+        return subscribed
+
+    async def psubscribe(self, pattern, *patterns):
+        subscribed = [self._store.subscribe(_to_key(p), True, self._encoding) for p in (pattern,) + patterns]
+        self._subscribed.extend(subscribed)
+        return subscribed
+
+
+class _PoolContext:
+    def __init__(self, conn: MemoryConnection):
+        self._conn = conn
+
+    async def __aenter__(self):
+        return self._conn
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return False
+
+
+class MemoryPool:
+    """
+    A stand-in for `aioredis.RedisPool`. Connections are free, so every `get` makes a new one.
+    """
+
+    def __init__(self, store: MemoryStore):
+        self._store = store
+
+    def get(self):
+        return _PoolContext(MemoryConnection(self._store))
+
+    def close(self):
+        pass
+
+    async def wait_closed(self):
+        pass
+
+    async def clear(self):
+        pass
+
+
+def _write_snapshot(path: str, data: dict):
+    tmp = path + ".tmp"
+    with open(tmp, "w") as f:
+        json.dump(data, f, separators=(",", ":"))
+    os.replace(tmp, path)
+
+
+class MemoryBackend(Backend):
+    """
+    Stores everything in this process.
+
+    If `snapshot` is set, the data is loaded from that file on startup, and written back to it every
+    `snapshot_interval` seconds if anything changed.
+    """
+
+    shared = False
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        self.store = MemoryStore(db=int(config.get("db", 0)))
+        self.snapshot_path = config.get("snapshot")
+        self.snapshot_interval = float(config.get("snapshot_interval", 60))
+        self._task = None
+
+        if self.snapshot_path and os.path.exists(self.snapshot_path):
+            with open(self.snapshot_path) as f:
+                self.store.load(json.load(f))
+            logger.info("Loaded {} keys from {}.".format(len(self.store._data), self.snapshot_path))
+
+    async def create_pool(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._maintain())
+        return MemoryPool(self.store)
+
+    async def create_connection(self, encoding: str = None):
+        return MemoryConnection(self.store, encoding=encoding)
+
+    async def _maintain(self):
+        while True:
+            await asyncio.sleep(self.snapshot_interval)
+            self.store.purge_expired()
+            if self.snapshot_path and self.store.dirty:
+                try:
+                    await self.save()
+                except OSError:
+                    logger.exception("Could not write a snapshot to {}.".format(self.snapshot_path))
+
+    async def save(self):
+        """
+        Writes a snapshot, if a path is set.
+        """
+        if not self.snapshot_path:
+            return
+        data = self.store.dump()
+        self.store.dirty = False
+        await asyncio.get_event_loop().run_in_executor(None, _write_snapshot, self.snapshot_path, data)
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.save()
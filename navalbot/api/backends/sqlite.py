@@ -0,0 +1,568 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# An embedded SQLite storage backend.
+# Keys live in WITHOUT ROWID tables, which are stored in key order, so the fields of a hash such as `config:{sid}`,
+# or the keys under a prefix, are one sequential range read instead of a SCAN over the whole keyspace.
+# Writes are collected in memory and committed in batches on a background thread; reads see them straight away.
+import asyncio
+import concurrent.futures
+import fnmatch
+import logging
+import re
+import sqlite3
+import time
+
+import aioredis
+
+from navalbot.api.backends import Backend
+from navalbot.api.backends.memory import MemoryConnection, MemoryStore, MemoryPool, _to_bytes, _to_key, \
+    _wrong_type
+
+logger = logging.getLogger("NavalBot")
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value BLOB NOT NULL, expires REAL) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS sets (key TEXT NOT NULL, member BLOB NOT NULL, PRIMARY KEY (key, member)) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS hashes (key TEXT NOT NULL, field BLOB NOT NULL, value BLOB NOT NULL,
+                                   PRIMARY KEY (key, field)) WITHOUT ROWID;
+"""
+
+_TABLES = ("kv", "sets", "hashes")
+
+_glob_chars = re.compile(r"[*?\[\\]")
+
+# Pending write entries.
+# ("str", value, expires) sets a string, ("del",) deletes a key, ("set", added, removed, cleared) changes a set, and
+# ("hash", changes, cleared) changes a hash, where a change to None deletes the field.
+_DELETED = ("del",)
+
+
+def _prefix_range(pattern: str):
+    """
+    Gets the range of keys that can match a glob pattern, as (low, high), or None if any key could.
+    """
+    prefix = _glob_chars.split(pattern, 1)[0]
+    if not prefix:
+        return None
+    # The smallest string greater than everything starting with the prefix.
+    return prefix, prefix[:-1] + chr(ord(prefix[-1]) + 1)
+
+
+def _apply_set(members: set, entry) -> set:
+    if entry is None:
+        return members
+    if entry[0] == "del":
+        return set()
+    if entry[0] != "set":
+        raise _wrong_type()
+    _, added, removed, cleared = entry
+    return (set() if cleared else members - removed) | added
+
+
+def _apply_hash(fields: dict, entry) -> dict:
+    if entry is None:
+        return fields
+    if entry[0] == "del":
+        return {}
+    if entry[0] != "hash":
+        raise _wrong_type()
+    _, changes, cleared = entry
+    fields = {} if cleared else dict(fields)
+    for field, value in changes.items():
+        if value is None:
+            fields.pop(field, None)
+        else:
+            fields[field] = value
+    return fields
+
+
+class SqliteStore(MemoryStore):
+    """
+    Storage in a SQLite database.
+
+    Pub/sub and keyspace notifications come from `MemoryStore`; the data commands are replaced.
+    """
+
+    def __init__(self, path: str, db: int = 0, mmap_size: int = 256 * 1024 * 1024):
+        super().__init__(db=db)
+        self.path = path
+        self.mmap_size = mmap_size
+
+        self._reader = self._connect()
+        self._reader.executescript(_SCHEMA)
+        self._reader.commit()
+
+        # Writes not yet handed to the writer, and writes being committed.
+        self._pending = {}
+        self._flushing = {}
+        self._writer = None
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path)
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        conn.execute("PRAGMA mmap_size={}".format(int(self.mmap_size)))
+        conn.execute("PRAGMA temp_store=MEMORY")
+        return conn
+
+    # Reading.
+    def _entries(self, key: str):
+        # Newest last, so they can be applied in order.
+        return self._flushing.get(key), self._pending.get(key)
+
+    def _latest(self, key: str):
+        entry = self._pending.get(key)
+        if entry is None:
+            entry = self._flushing.get(key)
+        return entry
+
+    def _get_string(self, key: str):
+        entry = self._latest(key)
+        if entry is not None:
+            if entry[0] == "del":
+                return None
+            if entry[0] != "str":
+                raise _wrong_type()
+            _, value, expires = entry
+        else:
+            row = self._reader.execute("SELECT value, expires FROM kv WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                if self._in_table("sets", key) or self._in_table("hashes", key):
+                    raise _wrong_type()
+                return None
+            value, expires = row
+        if expires is not None and expires <= time.time():
+            self._write(key, _DELETED)
+            self._notify(key, "expired")
+            return None
+        return bytes(value)
+
+    def _in_table(self, table: str, key: str) -> bool:
+        return self._reader.execute("SELECT 1 FROM {} WHERE key = ? LIMIT 1".format(table), (key,)).fetchone() \
+            is not None
+
+    def _get_set(self, key: str) -> set:
+        flushing, pending = self._entries(key)
+        if any(e is not None and (e[0] == "del" or (e[0] == "set" and e[3])) for e in (flushing, pending)):
+            members = set()
+        else:
+            members = {bytes(row[0]) for row in
+                       self._reader.execute("SELECT member FROM sets WHERE key = ?", (key,))}
+        return _apply_set(_apply_set(members, flushing), pending)
+
+    def _get_hash(self, key: str) -> dict:
+        flushing, pending = self._entries(key)
+        if any(e is not None and (e[0] == "del" or (e[0] == "hash" and e[2])) for e in (flushing, pending)):
+            fields = {}
+        else:
+            fields = {bytes(field): bytes(value) for field, value in
+                      self._reader.execute("SELECT field, value FROM hashes WHERE key = ?", (key,))}
+        return _apply_hash(_apply_hash(fields, flushing), pending)
+
+    def _get_field(self, key: str, field: bytes):
+        for entry in (self._pending.get(key), self._flushing.get(key)):
+            if entry is None:
+                continue
+            if entry[0] == "del":
+                return None
+            if entry[0] != "hash":
+                raise _wrong_type()
+            _, changes, cleared = entry
+            if field in changes:
+                return changes[field]
+            if cleared:
+                return None
+        row = self._reader.execute("SELECT value FROM hashes WHERE key = ? AND field = ?", (key, field)).fetchone()
+        return None if row is None else bytes(row[0])
+
+    def _exists(self, key: str) -> bool:
+        entry = self._latest(key)
+        if entry is not None:
+            if entry[0] == "str":
+                return entry[2] is None or entry[2] > time.time()
+            if entry[0] == "del":
+                return False
+            if entry[0] == "hash":
+                return bool(self._get_hash(key))
+            return bool(self._get_set(key))
+        row = self._reader.execute("SELECT expires FROM kv WHERE key = ?", (key,)).fetchone()
+        if row is not None:
+            return row[0] is None or row[0] > time.time()
+        return self._in_table("sets", key) or self._in_table("hashes", key)
+
+    # Writing.
+    def _write(self, key: str, entry):
+        self._pending[key] = entry
+        self.dirty = True
+
+    def _change_set(self, key: str, add=(), remove=()):
+        entry = self._pending.get(key)
+        if entry is None or entry[0] == "del":
+            entry = ("set", set(), set(), entry is not None)
+        elif entry[0] != "set":
+            raise _wrong_type()
+        _, added, removed, _ = entry
+        for member in add:
+            added.add(member)
+            removed.discard(member)
+        for member in remove:
+            removed.add(member)
+            added.discard(member)
+        self._pending[key] = entry
+        self.dirty = True
+
+    def _change_hash(self, key: str, changes: dict):
+        entry = self._pending.get(key)
+        if entry is None or entry[0] == "del":
+            entry = ("hash", {}, entry is not None)
+        elif entry[0] != "hash":
+            raise _wrong_type()
+        entry[1].update(changes)
+        self._pending[key] = entry
+        self.dirty = True
+
+    def take_batch(self) -> dict:
+        """
+        Moves the pending writes to the batch being committed. Returns None if there's nothing to do, or the last
+        batch hasn't been committed yet.
+        """
+        if self._flushing or not self._pending:
+            return None
+        self._flushing, self._pending = self._pending, {}
+        return self._flushing
+
+    def commit_batch(self, batch: dict):
+        """
+        Commits a batch of writes. This runs on the writer thread, with its own connection.
+        """
+        if self._writer is None:
+            self._writer = self._connect()
+        conn = self._writer
+        with conn:
+            for key, entry in batch.items():
+                kind = entry[0]
+                # A key only lives in one table, so clear it from the others.
+                for table in _TABLES:
+                    if table != {"str": "kv", "set": "sets", "hash": "hashes"}.get(kind):
+                        conn.execute("DELETE FROM {} WHERE key = ?".format(table), (key,))
+                if kind == "str":
+                    conn.execute("INSERT OR REPLACE INTO kv (key, value, expires) VALUES (?, ?, ?)",
+                                 (key, entry[1], entry[2]))
+                elif kind == "set":
+                    _, added, removed, cleared = entry
+                    if cleared:
+                        conn.execute("DELETE FROM sets WHERE key = ?", (key,))
+                    conn.executemany("DELETE FROM sets WHERE key = ? AND member = ?", [(key, m) for m in removed])
+                    conn.executemany("INSERT OR IGNORE INTO sets (key, member) VALUES (?, ?)",
+                                     [(key, m) for m in added])
+                elif kind == "hash":
+                    _, changes, cleared = entry
+                    if cleared:
+                        conn.execute("DELETE FROM hashes WHERE key = ?", (key,))
+                    conn.executemany("DELETE FROM hashes WHERE key = ? AND field = ?",
+                                     [(key, f) for f, v in changes.items() if v is None])
+                    conn.executemany("INSERT OR REPLACE INTO hashes (key, field, value) VALUES (?, ?, ?)",
+                                     [(key, f, v) for f, v in changes.items() if v is not None])
+
+    def batch_done(self):
+        self._flushing = {}
+
+    def sweep_expired(self):
+        """
+        Deletes expired strings. This runs on the writer thread.
+        """
+        if self._writer is None:
+            self._writer = self._connect()
+        with self._writer:
+            return self._writer.execute("DELETE FROM kv WHERE expires <= ?", (time.time(),)).rowcount
+
+    # Commands.
+    def cmd_get(self, key):
+        return self._get_string(_to_key(key))
+
+    def cmd_mget(self, key, *keys):
+        return [self._get_string(_to_key(k)) for k in (key,) + keys]
+
+    def cmd_set(self, key, value, *, expire=0, pexpire=0, exist=None):
+        key = _to_key(key)
+        if exist is not None:
+            exists = self._exists(key)
+            if exist == getattr(aioredis.Redis, "SET_IF_NOT_EXIST", "SET_IF_NOT_EXIST") and exists:
+                return False
+            if exist == getattr(aioredis.Redis, "SET_IF_EXIST", "SET_IF_EXIST") and not exists:
+                return False
+        expires = time.time() + (expire or pexpire / 1000) if expire or pexpire else None
+        self._write(key, ("str", _to_bytes(value), expires))
+        self._notify(key, "set")
+        return True
+
+    def cmd_incrby(self, key, increment):
+        key = _to_key(key)
+        try:
+            value = int(self._get_string(key) or 0) + increment
+        except ValueError:
+            raise aioredis.ReplyError("ERR value is not an integer or out of range")
+        entry = self._latest(key)
+        expires = entry[2] if entry is not None and entry[0] == "str" else None
+        self._write(key, ("str", _to_bytes(value), expires))
+        self._notify(key, "incrby")
+        return value
+
+    def cmd_delete(self, key, *keys):
+        deleted = 0
+        for k in (key,) + keys:
+            k = _to_key(k)
+            if self._exists(k):
+                self._write(k, _DELETED)
+                self._notify(k, "del")
+                deleted += 1
+        return deleted
+
+    def cmd_exists(self, key):
+        return int(self._exists(_to_key(key)))
+
+    def cmd_expire(self, key, timeout):
+        key = _to_key(key)
+        try:
+            value = self._get_string(key)
+        except aioredis.ReplyError:
+            raise aioredis.ReplyError("ERR the sqlite backend only supports expiry on strings")
+        if value is None:
+            return 0
+        self._write(key, ("str", value, time.time() + timeout))
+        self._notify(key, "expire")
+        return 1
+
+    def cmd_ttl(self, key):
+        key = _to_key(key)
+        if not self._exists(key):
+            return -2
+        entry = self._latest(key)
+        if entry is not None:
+            expires = entry[2] if entry[0] == "str" else None
+        else:
+            row = self._reader.execute("SELECT expires FROM kv WHERE key = ?", (key,)).fetchone()
+            expires = row[0] if row else None
+        return -1 if expires is None else max(0, int(round(expires - time.time())))
+
+    def cmd_sadd(self, key, member, *members):
+        key = _to_key(key)
+        new = {_to_bytes(m) for m in (member,) + members}
+        current = self._get_set(key)
+        added = new - current
+        if added:
+            self._change_set(key, add=added)
+            self._notify(key, "sadd")
+        return len(added)
+
+    def cmd_srem(self, key, member, *members):
+        key = _to_key(key)
+        gone = {_to_bytes(m) for m in (member,) + members} & self._get_set(key)
+        if gone:
+            self._change_set(key, remove=gone)
+            self._notify(key, "srem")
+        return len(gone)
+
+    def cmd_smembers(self, key):
+        return list(self._get_set(_to_key(key)))
+
+    def cmd_sismember(self, key, member):
+        key, member = _to_key(key), _to_bytes(member)
+        for entry in (self._pending.get(key), self._flushing.get(key)):
+            if entry is None:
+                continue
+            if entry[0] == "del":
+                return 0
+            if entry[0] != "set":
+                raise _wrong_type()
+            _, added, removed, cleared = entry
+            if member in added:
+                return 1
+            if member in removed or cleared:
+                return 0
+        row = self._reader.execute("SELECT 1 FROM sets WHERE key = ? AND member = ?", (key, member)).fetchone()
+        return int(row is not None)
+
+    def cmd_scard(self, key):
+        key = _to_key(key)
+        if self._latest(key) is None:
+            return self._reader.execute("SELECT COUNT(*) FROM sets WHERE key = ?", (key,)).fetchone()[0]
+        return len(self._get_set(key))
+
+    def cmd_hget(self, key, field):
+        return self._get_field(_to_key(key), _to_bytes(field))
+
+    def cmd_hmget(self, key, field, *fields):
+        key = _to_key(key)
+        return [self._get_field(key, _to_bytes(f)) for f in (field,) + fields]
+
+    def cmd_hgetall(self, key):
+        return self._get_hash(_to_key(key))
+
+    def cmd_hlen(self, key):
+        return len(self._get_hash(_to_key(key)))
+
+    def cmd_hexists(self, key, field):
+        return int(self._get_field(_to_key(key), _to_bytes(field)) is not None)
+
+    def cmd_hset(self, key, field, value):
+        key, field = _to_key(key), _to_bytes(field)
+        added = int(self._get_field(key, field) is None)
+        self._change_hash(key, {field: _to_bytes(value)})
+        self._notify(key, "hset")
+        return added
+
+    def cmd_hsetnx(self, key, field, value):
+        if self.cmd_hexists(key, field):
+            return 0
+        return self.cmd_hset(key, field, value)
+
+    def cmd_hmset(self, key, field, value, *pairs):
+        if len(pairs) % 2:
+            raise aioredis.ReplyError("ERR wrong number of arguments for 'hmset' command")
+        pairs = (field, value) + pairs
+        key = _to_key(key)
+        self._change_hash(key, {_to_bytes(pairs[i]): _to_bytes(pairs[i + 1]) for i in range(0, len(pairs), 2)})
+        self._notify(key, "hset")
+        return True
+
+    def cmd_hdel(self, key, field, *fields):
+        key = _to_key(key)
+        gone = {_to_bytes(f) for f in (field,) + fields if self._get_field(key, _to_bytes(f)) is not None}
+        if gone:
+            self._change_hash(key, dict.fromkeys(gone))
+            self._notify(key, "hdel")
+        return len(gone)
+
+    def cmd_keys(self, pattern):
+        pattern = _to_key(pattern)
+        key_range = _prefix_range(pattern)
+        if key_range is None:
+            where, params = "", ()
+        else:
+            where, params = " WHERE key >= ? AND key < ?", key_range
+        now = time.time()
+        # Both tables are in key order, so with a prefix these are range reads.
+        keys = {row[0] for row in self._reader.execute(
+            "SELECT key FROM kv" + where + (" AND" if where else " WHERE") + " (expires IS NULL OR expires > ?)",
+            params + (now,))}
+        for table in ("sets", "hashes"):
+            keys.update(row[0] for row in self._reader.execute("SELECT DISTINCT key FROM " + table + where, params))
+        # Writes that haven't been committed yet.
+        for layer in (self._flushing, self._pending):
+            for key in layer:
+                if self._exists(key):
+                    keys.add(key)
+                else:
+                    keys.discard(key)
+        return sorted(key.encode() for key in keys if fnmatch.fnmatchcase(key, pattern))
+
+    def cmd_sscan(self, key, cursor=0, match=None, count=None):
+        members = self.cmd_smembers(key)
+        if match is not None:
+            match = _to_key(match)
+            members = [m for m in members if fnmatch.fnmatchcase(m.decode("latin-1"), match)]
+        return 0, members
+
+    def cmd_flushdb(self):
+        for key in self.cmd_keys("*"):
+            self._write(key.decode(), _DELETED)
+        return True
+
+    def purge_expired(self) -> int:
+        # Expired keys are ignored on read, and swept from disk by the backend.
+        return 0
+
+    def close_writer(self):
+        # Connections belong to the thread that opened them, so this runs on the writer thread.
+        if self._writer is not None:
+            self._writer.close()
+            self._writer = None
+
+    def close(self):
+        self._reader.close()
+
+
+class SqliteBackend(Backend):
+    """
+    Stores everything in a SQLite database file.
+
+    This is for single-node deployments: like the memory backend, it can't be shared between shards.
+    """
+
+    shared = False
+
+    def __init__(self, config: dict):
+        super().__init__(config)
+        self.flush_interval = float(config.get("flush_interval", 0.1))
+        self.store = SqliteStore(config.get("path", "navalbot.db"), db=int(config.get("db", 0)),
+                                 mmap_size=int(config.get("mmap_size", 256 * 1024 * 1024)))
+        # One thread, so batches commit in order, and the writer connection stays on one thread.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+        self._task = None
+
+    async def create_pool(self):
+        if self._task is None:
+            self._task = asyncio.get_event_loop().create_task(self._write_behind())
+        return MemoryPool(self.store)
+
+    async def create_connection(self, encoding: str = None):
+        return MemoryConnection(self.store, encoding=encoding)
+
+    async def flush(self):
+        """
+        Commits the pending writes, waiting for any batch already being committed.
+        """
+        loop = asyncio.get_event_loop()
+        while True:
+            batch = self.store.take_batch()
+            if batch is None:
+                if not self.store._flushing:
+                    return
+                # Retry a batch that failed to commit.
+                batch = self.store._flushing
+            await loop.run_in_executor(self._executor, self.store.commit_batch, batch)
+            self.store.batch_done()
+
+    async def _write_behind(self):
+        sweeps = 0
+        while True:
+            await asyncio.sleep(self.flush_interval)
+            try:
+                await self.flush()
+                sweeps += 1
+                # Sweep expired keys roughly once a minute.
+                if sweeps * self.flush_interval >= 60:
+                    sweeps = 0
+                    await asyncio.get_event_loop().run_in_executor(self._executor, self.store.sweep_expired)
+            except sqlite3.Error:
+                logger.exception("Could not commit writes to {}, retrying.".format(self.store.path))
+
+    async def close(self):
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
+        await self.flush()
+        await asyncio.get_event_loop().run_in_executor(self._executor, self.store.close_writer)
+        self.store.close()
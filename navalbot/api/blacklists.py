@@ -0,0 +1,352 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# In-memory blacklists.
+# Per-server blacklists are loaded once and kept in memory.
+# The global blacklist is kept as a bloom filter, so very large lists only cost a few bits per entry.
+import asyncio
+import hashlib
+import json
+import logging
+import math
+
+import aioredis
+
+from navalbot.api import db
+from navalbot.api import util
+
+logger = logging.getLogger("NavalBot")
+
+GLOBAL_KEY = "global_blacklist"
+SERVER_KEY = "blacklist:{}"
+
+# Channel that add/remove deltas are published on, so other shards can update their copies.
+DELTA_CHANNEL = "navalbot:blacklist"
+
+
+class BloomFilter:
+    """
+    A simple bloom filter.
+
+    Lookups can return false positives, but never false negatives.
+    """
+
+    def __init__(self, capacity: int = 100000, error_rate: float = 0.001):
+        capacity = max(1, capacity)
+        self.capacity = capacity
+        self.error_rate = error_rate
+
+        # Calculate the optimal number of bits and hashes.
+        self.bit_count = max(8, int(math.ceil(-capacity * math.log(error_rate) / (math.log(2) ** 2))))
+        self.hash_count = max(1, int(round(self.bit_count / capacity * math.log(2))))
+
+        self._bits = bytearray((self.bit_count + 7) // 8)
+        self.count = 0
+
+    def _positions(self, item: str):
+        # Double hashing, using two halves of one digest.
+        digest = hashlib.sha1(item.encode()).digest()
+        h1 = int.from_bytes(digest[:8], "little")
+        h2 = int.from_bytes(digest[8:16], "little") | 1
+        for i in range(self.hash_count):
+            yield (h1 + i * h2) % self.bit_count
+
+    def add(self, item: str):
+        for pos in self._positions(item):
+            self._bits[pos >> 3] |= 1 << (pos & 7)
+        self.count += 1
+
+    def __contains__(self, item: str) -> bool:
+        return all(self._bits[pos >> 3] & (1 << (pos & 7)) for pos in self._positions(item))
+
+
+class Blacklists:
+    """
+    Keeps the global and per-server blacklists resident in memory.
+
+    Changes are made through `add` and `remove`, which update redis, apply the change locally, and publish it to
+    the other shards.
+    """
+
+    def __init__(self):
+        self._global_filter = None
+        # Confirmed answers for IDs that hit the bloom filter, so only the first lookup for them goes to redis.
+        self._global_confirmed = {}
+        # Global deltas that arrived while the bloom filter was being loaded, replayed onto it once it's done.
+        self._global_pending = None
+
+        self._servers = {}
+        # Server ID -> in-flight load, so concurrent first lookups share one SMEMBERS.
+        self._loading = {}
+        # Server ID -> deltas that arrived while its blacklist was being loaded, applied once the load finishes.
+        self._pending = {}
+        # Bumped by reset(), so loads started before it don't store their (possibly stale) results.
+        self._generation = 0
+
+        self._load_lock = asyncio.Lock()
+
+    @staticmethod
+    def _key(server_id: str = None) -> str:
+        if server_id is None:
+            return GLOBAL_KEY
+        return SERVER_KEY.format(server_id)
+
+    async def _load_global(self):
+        """
+        Streams the global blacklist from redis into a new bloom filter.
+        """
+        generation = self._generation
+        self._global_pending = []
+        try:
+            pool = await util.get_pool()
+            async with pool.get() as conn:
+                assert isinstance(conn, aioredis.Redis)
+                size = await conn.scard(GLOBAL_KEY)
+                capacity = max(size * 2, util.get_global_config("blacklist", default={}).get("bloom_capacity", 100000))
+                bloom = BloomFilter(capacity, util.get_global_config("blacklist", default={})
+                                    .get("bloom_error_rate", 0.001))
+                async for member in conn.isscan(GLOBAL_KEY):
+                    bloom.add(member.decode())
+        finally:
+            pending, self._global_pending = self._global_pending, None
+
+        if generation != self._generation:
+            # Reset while loading, so this may be missing deltas. Don't keep it.
+            return
+        self._global_confirmed.clear()
+        # The scan may have passed a user before they were added, or read one before they were removed.
+        for op, user_id in pending:
+            self._apply_global(bloom, op, user_id)
+        self._global_filter = bloom
+        logger.info("Loaded {} globally blacklisted users into a {}KiB bloom filter."
+                    .format(bloom.count, len(bloom._bits) // 1024))
+
+    async def _load_server(self, server_id: str) -> set:
+        task = self._loading.get(server_id)
+        if task is None:
+            task = self._loading[server_id] = asyncio.ensure_future(self._fetch_server(server_id))
+            task.add_done_callback(lambda _: self._loading.pop(server_id, None))
+        return await asyncio.shield(task)
+
+    async def _fetch_server(self, server_id: str) -> set:
+        generation = self._generation
+        self._pending.setdefault(server_id, [])
+        try:
+            pool = await util.get_pool()
+            async with pool.get() as conn:
+                members = await conn.smembers(self._key(server_id))
+        except BaseException:
+            self._pending.pop(server_id, None)
+            raise
+        return self._store(server_id, members, generation)
+
+    def _store(self, server_id: str, members, generation: int) -> set:
+        members = {i.decode() for i in members or ()}
+        if generation != self._generation:
+            # Reset while loading, so this may be missing deltas. Don't keep it.
+            return members
+        # Apply anything that changed while the load was in flight.
+        for op, user_id in self._pending.pop(server_id, ()):
+            if op == "add":
+                members.add(user_id)
+            else:
+                members.discard(user_id)
+        self._servers[server_id] = members
+        return members
+
+    async def warm(self, server_ids: list):
+        """
+        Loads the blacklists for many servers, pipelining the SMEMBERS for all of them.
+        Servers that are already loaded are skipped.
+        """
+        server_ids = [server_id for server_id in server_ids
+                      if server_id not in self._servers and server_id not in self._pending]
+        if not server_ids:
+            return
+        generation = self._generation
+        for server_id in server_ids:
+            self._pending[server_id] = []
+        try:
+            pool = await util.get_pool()
+            async with pool.get() as conn:
+                assert isinstance(conn, aioredis.Redis)
+                pipe = conn.pipeline()
+                for server_id in server_ids:
+                    pipe.smembers(self._key(server_id))
+                results = await pipe.execute()
+        except BaseException:
+            for server_id in server_ids:
+                self._pending.pop(server_id, None)
+            raise
+        for server_id, members in zip(server_ids, results):
+            self._store(server_id, members, generation)
+
+    async def load_global(self):
+        """
+        Loads the global blacklist, if it hasn't been already.
+        """
+        # Looped, as a load that raced with a reset isn't kept.
+        while self._global_filter is None:
+            with await self._load_lock:
+                if self._global_filter is None:
+                    await self._load_global()
+
+    async def is_globally_blacklisted(self, user_id: str) -> bool:
+        """
+        Checks if a user is on the global blacklist.
+
+        This only goes to redis if the bloom filter says the user might be on it.
+        """
+        await self.load_global()
+
+        if user_id not in self._global_filter:
+            return False
+
+        try:
+            return self._global_confirmed[user_id]
+        except KeyError:
+            pass
+
+        # Possibly a false positive, check redis.
+        pool = await util.get_pool()
+        async with pool.get() as conn:
+            listed = bool(await conn.sismember(GLOBAL_KEY, user_id))
+        self._global_confirmed[user_id] = listed
+        return listed
+
+    async def is_blacklisted(self, server_id: str, user_id: str) -> bool:
+        """
+        Checks if a user is on a server's blacklist.
+
+        The blacklist is loaded the first time the server is seen.
+        """
+        members = self._servers.get(server_id)
+        if members is None:
+            members = await self._load_server(server_id)
+        return user_id in members
+
+    async def get_members(self, server_id: str = None) -> set:
+        """
+        Gets the members of a server's blacklist, or the global blacklist if no server is given.
+        """
+        if server_id is not None and server_id in self._servers:
+            return set(self._servers[server_id])
+        return await db.get_set(self._key(server_id)) or set()
+
+    def apply(self, op: str, server_id: str, user_id: str):
+        """
+        Applies an add or remove delta to the in-memory copy.
+        """
+        if server_id is None:
+            if self._global_pending is not None:
+                self._global_pending.append((op, user_id))
+            self._apply_global(self._global_filter, op, user_id)
+            return
+
+        members = self._servers.get(server_id)
+        if members is None:
+            if server_id in self._pending:
+                # Being loaded, and the load may have read the set before this change.
+                self._pending[server_id].append((op, user_id))
+            # Otherwise not loaded yet, so this will be picked up when it is.
+            return
+        if op == "add":
+            members.add(user_id)
+        else:
+            members.discard(user_id)
+
+    def _apply_global(self, bloom: BloomFilter, op: str, user_id: str):
+        if op == "add":
+            if bloom is not None:
+                bloom.add(user_id)
+            self._global_confirmed[user_id] = True
+        else:
+            # Bloom filters can't remove, so record the removal as a confirmed negative.
+            self._global_confirmed[user_id] = False
+
+    async def _change(self, op: str, server_id: str, user_id: str):
+        pool = await util.get_pool()
+        async with pool.get() as conn:
+            assert isinstance(conn, aioredis.Redis)
+            if op == "add":
+                await conn.sadd(self._key(server_id), user_id)
+            else:
+                await conn.srem(self._key(server_id), user_id)
+            self.apply(op, server_id, user_id)
+            await conn.publish(DELTA_CHANNEL, json.dumps({"op": op, "server": server_id, "user": user_id}))
+
+    async def add(self, user_id: str, server_id: str = None):
+        """
+        Blacklists a user on a server, or globally if no server is given.
+        """
+        await self._change("add", server_id, user_id)
+
+    async def remove(self, user_id: str, server_id: str = None):
+        """
+        Removes a user from a server's blacklist, or from the global blacklist if no server is given.
+        """
+        await self._change("remove", server_id, user_id)
+
+    def reset(self):
+        """
+        Drops everything held in memory, so it is re-loaded on next use.
+        """
+        self._global_filter = None
+        self._global_confirmed.clear()
+        self._servers.clear()
+        self._pending.clear()
+        self._generation += 1
+
+    async def listen_for_deltas(self):
+        """
+        Applies blacklist deltas published by other shards.
+        """
+        while True:
+            try:
+                conn = await db.create_pubsub_connection()
+            except (OSError, aioredis.RedisError):
+                logger.warning("Could not connect to redis for blacklist updates, retrying in 5 seconds.")
+                await asyncio.sleep(5)
+                continue
+            try:
+                channel, = await conn.subscribe(DELTA_CHANNEL)
+                # We may have missed deltas before subscribing.
+                self.reset()
+                logger.info("Listening for blacklist updates on `{}`.".format(DELTA_CHANNEL))
+                while await channel.wait_message():
+                    try:
+                        delta = json.loads(await channel.get())
+                        self.apply(delta["op"], delta.get("server"), delta["user"])
+                    except (ValueError, KeyError, TypeError):
+                        logger.warning("Ignoring malformed blacklist delta.")
+            except asyncio.CancelledError:
+                conn.close()
+                raise
+            except (OSError, aioredis.RedisError):
+                logger.warning("Lost the blacklist update connection, reconnecting.")
+            conn.close()
+            self.reset()
+            await asyncio.sleep(1)
+
+
+blacklists = Blacklists()
@@ -25,16 +25,15 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 import asyncio
 import copy
 import collections
+import functools
 import importlib
-import json
 import logging
 import os
 import shutil
 import sys
+import time
 import traceback
 
-import aiohttp
-import aioredis
 import discord
 import logbook
 from logbook import StreamHandler
@@ -42,13 +41,22 @@ import yaml
 from raven import Client
 from raven_aiohttp import AioHttpTransport
 
+from navalbot.api import backends
 from navalbot.api import db
+from navalbot.api import executors
+from navalbot.api import lagmonitor
+from navalbot.api import metrics
+from navalbot.api.recorder import GatewayRecorder
 from navalbot.api import util
-from navalbot.api.contexts import OnMessageEventContext
+from navalbot.api.webclient import HTTPClient
+from navalbot.api.blacklists import blacklists
+from navalbot.api.contexts import OnMessageEventContext, MESSAGE_NEEDS
+from navalbot.api.permissions import permission_cache
 from navalbot.api import contexts
-from navalbot.api.locale import get_locale
-from navalbot.api.util import get_pool
+from navalbot.api.scheduler import FairScheduler
+from navalbot.api.warmup import CacheWarmer
 from navalbot.voice import voiceclient
+from navalbot.voice.extraction import extractor
 
 from logbook.compat import redirect_logging
 redirect_logging()
@@ -56,6 +64,27 @@ redirect_logging()
 StreamHandler(sys.stderr).push_application()
 
 
+# Events that go through the per-guild scheduler, rather than getting a task each.
+SCHEDULED_EVENTS = frozenset({"message", "message_edit", "message_delete", "member_join"})
+
+
+def _guild_of(args: tuple) -> str:
+    """
+    Gets the ID of the guild an event belongs to, from its arguments.
+    """
+    for arg in args:
+        if isinstance(arg, discord.Server):
+            return arg.id
+        try:
+            server = getattr(arg, "server", None)
+        except NotImplementedError:
+            # Contexts for events without a server.
+            continue
+        if server is not None:
+            return server.id
+    return None
+
+
 class NavalClient(discord.Client):
     """
     An overridden discord Client.
@@ -77,6 +106,12 @@ class NavalClient(discord.Client):
         self.hooks = collections.defaultdict(lambda *args, **kwargs: {})
 
         self._hook_subclasses = {}
+        # Event name -> tuple of (class name, class, bound handler).
+        # This is rebuilt whenever a hook class is registered.
+        self._hook_dispatch = {}
+
+        # Index of on_recv hooks: (unfiltered, {op: hooks}, {event type: (hook, ops)}).
+        self._raw_index = ((), {}, {})
 
         self.logger = logbook.Logger("NavalBot")
 
@@ -98,9 +133,57 @@ class NavalClient(discord.Client):
         else:
             self._raven_client = None
 
-        self.tb_session = aiohttp.ClientSession()
+        # Shared HTTP client, for all outbound requests.
+        http_cfg = self.config.get("http", {})
+        self.web = HTTPClient(loop=self.loop, limit=int(http_cfg.get("limit", 100)),
+                              limit_per_host=int(http_cfg.get("limit_per_host", 8)),
+                              keepalive_timeout=float(http_cfg.get("keepalive_timeout", 30)),
+                              dns_cache=http_cfg.get("dns_cache", True), timeout=float(http_cfg.get("timeout", 15)),
+                              retries=int(http_cfg.get("retries", 2)), backoff=float(http_cfg.get("backoff", 0.5)))
+
+        # Size the config cache.
+        cache_cfg = self.config.get("config_cache", {})
+        db.config_cache.size = int(cache_cfg.get("size", 4096))
+        db.config_cache.ttl = float(cache_cfg.get("ttl", 60))
+        permission_cache.ttl = float(cache_cfg.get("permissions_ttl", 300))
+        self._invalidation_task = None
+        self._blacklist_task = None
+
+        sched_cfg = self.config.get("scheduler", {})
+        self.scheduler = FairScheduler(loop=self.loop, enabled=sched_cfg.get("enabled", True),
+                                       workers=int(sched_cfg.get("workers", 16)),
+                                       queue_size=int(sched_cfg.get("queue_size", 200)),
+                                       max_per_guild=int(sched_cfg.get("max_per_guild", 4)),
+                                       weights=sched_cfg.get("weights"))
+
+        shed_cfg = self.config.get("load_shedding", {})
+        self.lag = lagmonitor.LagMonitor(loop=self.loop, interval=float(shed_cfg.get("interval", 0.5)),
+                                         thresholds=shed_cfg.get("thresholds", (0.1, 0.25, 0.5)))
+        self._lag_task = None
+
+        warm_cfg = self.config.get("warmup", {})
+        self.warmer = CacheWarmer(loop=self.loop, enabled=warm_cfg.get("enabled", True), lag=self.lag,
+                                  batch_size=int(warm_cfg.get("batch_size", 50)),
+                                  concurrency=int(warm_cfg.get("concurrency", 2)))
+
+        executors.configure(self.config.get("executors") or {})
+
+        ext_cfg = self.config.get("voice_extraction", {})
+        extractor.configure(workers=int(ext_cfg.get("workers", 2)), max_jobs=int(ext_cfg.get("max_jobs", 50)),
+                            timeout=float(ext_cfg.get("timeout", 120)), enabled=ext_cfg.get("enabled", True))
+
+        rec_cfg = self.config.get("recorder", {})
+        self.recorder = GatewayRecorder(self.loop, directory=rec_cfg.get("directory", "recordings"),
+                                        anonymise=rec_cfg.get("anonymise", True))
 
         self.loaded = False
+
+        # Running commands. These run as their own tasks, rather than inside the scheduled message job.
+        self.command_tasks = set()
+        # Called as `on_command(message, task)` for each command started, if set.
+        # Used by the benchmark and replays to wait for the commands a message started.
+        self.on_command = None
+
         self.testing = False
 
         self.logger.level = getattr(logbook, self.config.get("log_level", "INFO"))
@@ -184,42 +267,168 @@ class NavalClient(discord.Client):
         self.connection._add_voice_client(server.id, voice)
         return voice
 
+    def start_command(self, coro, message: discord.Message = None) -> asyncio.Task:
+        """
+        Runs a command invocation as its own task.
+
+        Commands can run for a long time (?play, ?setup, ?repl), so they mustn't hold the scheduler worker that parsed
+        the message. Otherwise a few of them would stop their guild, or every guild, from being processed.
+        """
+        task = self.loop.create_task(coro)
+        self.command_tasks.add(task)
+        task.add_done_callback(self.command_tasks.discard)
+        if self.on_command is not None:
+            self.on_command(message, task)
+        return task
+
+    async def wait_for_commands(self):
+        """
+        Waits until no commands are running.
+        """
+        while self.command_tasks:
+            await asyncio.wait(list(self.command_tasks), loop=self.loop)
+
     def dispatch(self, event, *args, **kwargs):
         """
         Handles dispatching.
 
         This is overriden so we can dispatch to hook-subclasses that handle ALL hooks, regardless of event.
         """
-        super().dispatch(event, *args, **kwargs)
+        if event == "socket_response":
+            if self.recorder.active:
+                self.recorder.record(*args)
+            self._dispatch_raw(*args)
+
+        if event in SCHEDULED_EVENTS:
+            # Run the listeners (wait_for_message, etc) straight away, but queue the handler for its guild.
+            handler = getattr(self, "handle_" + event, None)
+            if handler is not None:
+                handler(*args, **kwargs)
+            self.scheduler.submit(_guild_of(args), self._run_event, "on_" + event, *args)
+        else:
+            super().dispatch(event, *args, **kwargs)
 
         # Handle the hook subclasses.
-        for name, hook_subclass in self._hook_subclasses.items():
-            method = 'on_' + event
-            if hasattr(hook_subclass, method):
-                self.logger.debug("Dispatching to hook class `{}` -> `{}`.".format(name, method))
-                self.loop.create_task(self._n_run_event(method, *args, cls=hook_subclass, **kwargs))
+        # Events that no hook class handles cost a single dict miss.
+        handlers = self._hook_dispatch.get(event)
+        if handlers is None:
+            return
+        guild_id = _guild_of(args)
+        for name, hook_class, handler in handlers:
+            self.scheduler.submit(guild_id, self._run_hook_class, event, name, hook_class, handler, args, kwargs)
 
-    async def _n_run_event(self, event, *args, cls: 'NavalClient'=None, **kwargs):
+    async def _run_hook_class(self, event: str, name: str, hook_class, handler, args: tuple, kwargs: dict):
         """
-        Run an event, delegating to a subclass if appropriate.
+        Run a hook class handler, delegating errors to the hook class' on_error if it has one.
         """
-        if cls is None:
-            cls = self
+        method = 'on_' + event
         try:
-            await getattr(cls, event)(self, *args, **kwargs)
+            with metrics.time_hook(method, name):
+                await handler(*args, **kwargs)
         except asyncio.CancelledError:
             pass
         except Exception:
+            on_error = getattr(hook_class, "on_error", None)
             try:
-                await cls.on_error(self, event, *args, **kwargs)
+                if on_error is not None:
+                    await on_error(self, method, *args, **kwargs)
+                else:
+                    await self.on_error(method, *args, **kwargs)
             except asyncio.CancelledError:
                 pass
 
     # Misc utilities.
 
+    def add_hook(self, event: str, name: str, hook):
+        """
+        Adds (or replaces) a hook for an event.
+        """
+        if event not in self.hooks:
+            self.hooks[event] = {}
+        self.hooks[event][name] = hook
+        if event == "on_recv":
+            self._build_raw_index()
+
+    def _build_raw_index(self):
+        """
+        Indexes the on_recv hooks by their filters, so raw payloads can be matched without scanning every hook.
+        """
+        unfiltered = []
+        by_op = collections.defaultdict(list)
+        by_event = collections.defaultdict(list)
+        for name, hook in self.hooks.get("on_recv", {}).items():
+            ops, events = getattr(hook, "ops", None), getattr(hook, "events", None)
+            if events is not None:
+                for t in events:
+                    by_event[t].append((name, hook, ops))
+            elif ops is not None:
+                for op in ops:
+                    by_op[op].append((name, hook))
+            else:
+                unfiltered.append((name, hook))
+
+        self._raw_index = (tuple(unfiltered),
+                           {op: tuple(hooks) for op, hooks in by_op.items()},
+                           {t: tuple(hooks) for t, hooks in by_event.items()})
+        metrics.counters["raw.unfiltered_subscriptions"] = len(unfiltered)
+
+    def _dispatch_raw(self, raw_data: dict):
+        """
+        Dispatches a raw gateway payload to the on_recv hooks that want it.
+
+        This is synchronous, so payloads nobody has subscribed to never create a coroutine or task.
+        """
+        unfiltered, by_op, by_event = self._raw_index
+        if not (unfiltered or by_op or by_event):
+            return
+
+        if self.lag.sheds(lagmonitor.SHED_RAW):
+            metrics.incr("shed.on_recv")
+            return
+
+        metrics.incr("raw.payloads")
+        op, t = raw_data.get("op"), raw_data.get("t")
+
+        matched = [(name, hook) for name, hook, ops in by_event.get(t, ()) if ops is None or op in ops]
+        matched.extend(by_op.get(op, ()))
+        if matched:
+            metrics.incr("raw.filtered_deliveries", len(matched))
+        if unfiltered:
+            metrics.incr("raw.unfiltered_deliveries", len(unfiltered))
+            matched.extend(unfiltered)
+
+        if not matched:
+            metrics.incr("raw.dropped")
+            return
+
+        for name, hook in matched:
+            self.loop.create_task(self._run_hook("on_recv", name, hook, raw_data))
+
     def register_hook_class(self, cls):
-        self.logger.info("Registered new hook class -> {cls.__class__.__name__}".format(cls=cls))
-        self._hook_subclasses[cls.__class__.__name__] = cls
+        # Hook classes are normally registered with the class itself, so don't use the name of its type.
+        name = getattr(cls, "__name__", cls.__class__.__name__)
+        self.logger.info("Registered new hook class -> {}".format(name))
+        # Registering under the same name replaces the old class, so reloading a plugin rebuilds its handlers.
+        self._hook_subclasses[name] = cls
+        self._build_dispatch_table()
+
+    def _build_dispatch_table(self):
+        """
+        Builds the event -> handlers table used by dispatch() for hook classes.
+        """
+        table = collections.defaultdict(list)
+        for name, hook_class in self._hook_subclasses.items():
+            for attr in dir(hook_class):
+                if not attr.startswith("on_") or attr == "on_error":
+                    continue
+                handler = getattr(hook_class, attr)
+                if not callable(handler):
+                    continue
+                # Hook class methods take the client as their first argument.
+                table[attr[3:]].append((name, hook_class, functools.partial(handler, self)))
+
+        self._hook_dispatch = {event: tuple(handlers) for event, handlers in table.items()}
+        self.logger.debug("Rebuilt hook class dispatch table: {} events handled.".format(len(self._hook_dispatch)))
 
     async def load_plugins(self):
         """
@@ -270,6 +479,90 @@ class NavalClient(discord.Client):
             sys.path.pop(0)
         self.loaded = True
 
+    def _order_hooks(self, event: str, hook_handler: dict) -> list:
+        """
+        Sorts hooks so that every hook comes after the hooks named in its `after`.
+
+        Otherwise, registration order is kept.
+        """
+        ordered = []
+        state = {}
+
+        def visit(name, hook):
+            if state.get(name) == 2:
+                return
+            if state.get(name) == 1:
+                self.logger.warning("Hook {} -> {} has a circular ordering dependency, ignoring it."
+                                    .format(event, name))
+                return
+            state[name] = 1
+            for dep in getattr(hook, "after", ()):
+                if dep in hook_handler:
+                    visit(dep, hook_handler[dep])
+            state[name] = 2
+            ordered.append((name, hook))
+
+        for name, hook in hook_handler.items():
+            visit(name, hook)
+        return ordered
+
+    async def _run_message_hook(self, name: str, hook, ctx: OnMessageEventContext, waits: list, concurrent: bool):
+        """
+        Runs a single on_message hook, once the hooks it is ordered after have finished.
+        """
+        if waits:
+            await asyncio.wait(waits, loop=self.loop)
+
+        needs = getattr(hook, "needs", MESSAGE_NEEDS)
+        timeout = getattr(hook, "timeout", None)
+        if timeout is None:
+            timeout = self.config.get("hooks", {}).get("timeout", 10)
+        # Null or 0 means no timeout.
+        timeout = float(timeout or 0)
+        timed = concurrent and timeout > 0
+
+        start = time.monotonic()
+        try:
+            await ctx.resolve(*needs)
+            if "blacklist" in needs and ctx.blacklisted:
+                self.logger.info("Skipping hook on_message -> {} for blacklisted user {}."
+                                 .format(name, ctx.member.display_name))
+                return
+            with metrics.time_hook("on_message", name):
+                if timed:
+                    await asyncio.wait_for(hook(ctx), timeout, loop=self.loop)
+                else:
+                    await hook(ctx)
+        except asyncio.TimeoutError:
+            if timed and time.monotonic() - start >= timeout:
+                self.logger.warning("Hook on_message -> {} timed out after {}s and was cancelled."
+                                    .format(name, timeout))
+            else:
+                # Raised from inside the hook, not by us.
+                self.logger.error("Caught exception in hook on_message -> {}".format(name))
+                traceback.print_exc()
+        except Exception:
+            self.logger.error("Caught exception in hook on_message -> {}".format(name))
+            traceback.print_exc()
+        else:
+            elapsed = time.monotonic() - start
+            if timeout and elapsed > timeout:
+                self.logger.warning("Hook on_message -> {} overran its {}s budget ({:.2f}s)."
+                                    .format(name, timeout, elapsed))
+
+    async def _run_hook(self, event: str, name: str, hook, *args):
+        """
+        Runs a single hook in the background, timing it and logging any errors.
+        """
+        try:
+            with metrics.time_hook(event, name):
+                await hook(*args)
+        except asyncio.CancelledError:
+            pass
+        except Exception:
+            self.logger.error("Caught exception in hook {} -> {}".format(event, name))
+            traceback.print_exc()
+
     async def _delegate_hooks(self, event: str, ctx: contexts.EventContext, pause=True):
         """
         Delegates hooks to the subhook handlers.
@@ -278,13 +571,29 @@ class NavalClient(discord.Client):
         for name, subhook in hook_handler.items():
             if pause:
                 try:
-                    await subhook(ctx)
+                    with metrics.time_hook(event, name):
+                        await subhook(ctx)
                 except Exception:
                     self.logger.error("Caught exception in hook {} -> {}".format(event, name))
                     traceback.print_exc()
                     return
             else:
-                self.loop.create_task(subhook)
+                self.scheduler.submit(_guild_of((ctx,)), self._run_hook, event, name, subhook, ctx)
+
+    async def close(self):
+        """
+        Closes the storage backend before disconnecting, so in-process data gets written out.
+        """
+        self.warmer.stop()
+        extractor.stop()
+        executors.shutdown()
+        self.web.close()
+        try:
+            await backends.get_backend(self.config.get("redis", {})).close()
+        except Exception:
+            self.logger.error("Couldn't close the storage backend.")
+            traceback.print_exc()
+        await super().close()
 
     # Events.
     async def on_server_join(self, server: discord.Server):
@@ -293,15 +602,14 @@ class NavalClient(discord.Client):
                                                             "protection mode right now to prevent against abusive "
                                                             "users. I am automatically leaving.")
             await self.leave_server(server)
+            return
+        if not self.testing:
+            self.warmer.queue([server.id])
 
-    async def on_socket_response(self, raw_data: json):
-        """
-        Recieves raw JSON data.
-
-        This is only used to dispatch to hooks.
-        """
-        for hook in self.hooks.get("on_recv", {}).values():
-            self.loop.create_task(hook(raw_data))
+    async def on_server_available(self, server: discord.Server):
+        # Servers that were unavailable at READY come in later.
+        if self.loaded and not self.testing:
+            self.warmer.queue([server.id])
 
     async def on_error(self, event_method, *args, **kwargs):
         """
@@ -340,13 +648,32 @@ class NavalClient(discord.Client):
         except FileExistsError:
             pass
 
+        # Start listening for config changes made by other shards.
+        # on_ready fires again on reconnect, so only do this once.
+        # In-process backends can't be changed by anyone else, so they don't need it.
+        shared = backends.get_backend(self.config.get("redis", {})).shared
+        if self.config.get("config_cache", {}).get("invalidation", True) and not self.testing and shared \
+                and self._invalidation_task is None:
+            self._invalidation_task = self.loop.create_task(db.listen_for_invalidations())
+        if not self.testing and shared and self._blacklist_task is None:
+            self._blacklist_task = self.loop.create_task(blacklists.listen_for_deltas())
+        if self.config.get("load_shedding", {}).get("enabled", True) and self._lag_task is None:
+            self._lag_task = self.loop.create_task(self.lag.run())
+
         # Load plugins
         await self.load_plugins()
 
+        # Load the caches for every server in the background, so the first messages don't pay for it.
+        if not self.testing:
+            self.warmer.queue([server.id for server in self.servers if not server.unavailable])
+            # Start the youtube_dl workers now, so the first ?play doesn't wait for them.
+            extractor.start()
+
         # Run on_ready hooks
         for hook in self.hooks.get("on_ready", {}).values():
             try:
-                await hook(self)
+                with metrics.time_hook("on_ready", hook.__name__):
+                    await hook(self)
             except:
                 self.logger.error("Caught exception in hook on_ready -> {}".format(hook.__name__))
                 traceback.print_exc()
@@ -372,15 +699,23 @@ class NavalClient(discord.Client):
             if message.content.startswith("`"):
                 return
 
-        # Load locale.
-        _loc_key = await db.get_config(message.server.id, "lang", default=None)
-        loc = get_locale(_loc_key)
+        # Check for a valid server.
+        if message.server is None:
+            # No DMs
+            if not await blacklists.is_globally_blacklisted(message.author.id):
+                await self.send_message(message.channel, "I don't accept private messages.")
+            return
+
+        # The locale, snapshot and blacklist are all resolved lazily, as hooks need them.
+        # Most messages aren't commands, so this usually means they don't need loading at all.
+        ctx = OnMessageEventContext(self, message)
 
         # Run on_message_before_blacklist
         for hook in self.hooks.get("on_message_before_blacklist", {}).values():
-            ctx = OnMessageEventContext(self, message, loc)
             try:
-                result = await hook(ctx)
+                await ctx.resolve(*getattr(hook, "needs", MESSAGE_NEEDS) - {"blacklist"})
+                with metrics.time_hook("on_message_before_blacklist", hook.__name__):
+                    result = await hook(ctx)
             except:
                 self.logger.error("Caught exception in hook on_message_before_blacklist -> {}".format(hook.__name__))
                 traceback.print_exc()
@@ -390,53 +725,34 @@ class NavalClient(discord.Client):
                 self.logger.info("Hook `on_message_before_blacklist -> {}` forced end of processing.".format(hook.__name__))
                 return
 
-        global_blacklist = await db.get_set("global_blacklist") or set()
-
-        # Check if they are globally blacklist.
-        if message.author.id in global_blacklist:
-            self.logger.info("Ignoring message from globally blacklisted user.")
-            return
-
-        if not isinstance(message.channel, discord.PrivateChannel):
-            # print(Fore.RED + message.server.name, ":", Fore.GREEN + message.channel.name, ":",
-            #      Fore.CYAN + message.author.name , ":", Fore.RESET + message.content)
-            self.logger.info("Recieved message: {message.content} from {message.author.display_name}{bot}"
-                        .format(message=message, bot=" [BOT]" if message.author.bot else ""))
-            self.logger.info(" On channel: #{message.channel.name}".format(message=message))
-
-        # Check for a valid server.
-        if message.server is not None:
-            self.logger.info(" On server: {} ({})".format(message.server.name, message.server.id))
-        else:
-            # No DMs
-            await self.send_message(message.channel, "I don't accept private messages.")
-            return
-
-        # Load set members for blacklist.
-        pool = await get_pool()
-        async with pool.get() as conn:
-            assert isinstance(conn, aioredis.Redis)
-            blacklist = await db.get_set("blacklist:{}".format(message.server.id))
-
-        if blacklist and message.author.id in blacklist:
-            # Ignore the message.
-            self.logger.info("Ignoring message from blacklisted member {message.author.display_name}"
-                        .format(message=message))
-            return
+        self.logger.info("Recieved message: {message.content} from {message.author.display_name}{bot}"
+                         .format(message=message, bot=" [BOT]" if message.author.bot else ""))
+        self.logger.info(" On channel: #{message.channel.name}".format(message=message))
+        self.logger.info(" On server: {} ({})".format(message.server.name, message.server.id))
 
         if len(message.content) == 0:
             self.logger.info("Ignoring (presumably) image-only message.")
             return
 
         # Run on_message hooks.
-        for hook in copy.copy(self.hooks.get("on_message", {})).values():
-            ctx = OnMessageEventContext(self, message, loc)
-            try:
-                await hook(ctx)
-            except Exception:
-                self.logger.error("Caught exception in hook on_message -> {}".format(hook.__name__))
-                traceback.print_exc()
-                continue
+        # Every hook shares the same context.
+        hooks = self._order_hooks("on_message", copy.copy(self.hooks.get("on_message", {})))
+        if self.lag.sheds(lagmonitor.SHED_HOOKS):
+            # Only run the hooks that commands depend on.
+            essential = [(name, hook) for name, hook in hooks if getattr(hook, "essential", False)]
+            metrics.incr("shed.on_message", len(hooks) - len(essential))
+            hooks = essential
+        if self.config.get("hooks", {}).get("concurrent", True):
+            # Start every hook at once. Hooks with an ordering constraint wait on the tasks they come after.
+            tasks = {}
+            for name, hook in hooks:
+                waits = [tasks[dep] for dep in getattr(hook, "after", ()) if dep in tasks]
+                tasks[name] = self.loop.create_task(self._run_message_hook(name, hook, ctx, waits, True))
+            if tasks:
+                await asyncio.wait(tasks.values(), loop=self.loop)
+        else:
+            for name, hook in hooks:
+                await self._run_message_hook(name, hook, ctx, [], False)
 
     async def on_message_delete(self, message: discord.Message):
         """
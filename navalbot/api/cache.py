@@ -0,0 +1,375 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Async result caching.
+# `async_cache` memoizes a coroutine function, with a TTL, LRU eviction and single-flight loading.
+# `TieredCache` puts the same in-process cache in front of redis, so results can be shared between shards.
+import asyncio
+import collections
+import functools
+import json
+import logging
+import math
+import random
+import sys
+import time
+import uuid
+
+import aioredis
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+logger = logging.getLogger("NavalBot")
+
+# Every cache made by `async_cache` (by the qualified name of the function it wraps) or `TieredCache`.
+caches = {}
+
+
+def _make_key(args: tuple, kwargs: dict) -> tuple:
+    # Types are part of the key, so 1 and 1.0 (or "1" and 1) are cached separately.
+    items = tuple(sorted(kwargs.items()))
+    return args + items + tuple(type(v) for v in args) + tuple(type(v) for _, v in items)
+
+
+class AsyncTTLCache:
+    """
+    A cache of coroutine results.
+
+    Entries expire after `ttl` seconds, or `negative_ttl` for negative results (None, by default). If `ttl` is None,
+    entries never expire.
+    The least recently used entries are evicted once there are more than `maxsize` of them, or their total weight
+    (from `weigher`, which defaults to the value's size in bytes) is over `max_weight`.
+    Concurrent misses for the same key share a single load. Exceptions are never cached.
+    """
+
+    def __init__(self, maxsize: int = 128, ttl: float = 60, negative_ttl: float = None, max_weight: int = None,
+                 weigher=None, is_negative=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.negative_ttl = ttl if negative_ttl is None else negative_ttl
+        self.max_weight = max_weight
+        self.weigher = weigher or (sys.getsizeof if max_weight is not None else None)
+        self.is_negative = is_negative or (lambda value: value is None)
+
+        # Key -> (expires, weight, value).
+        self._data = collections.OrderedDict()
+        self._weight = 0
+        self._inflight = {}
+
+        self.hits = 0
+        self.negative_hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.evictions = 0
+        self.expirations = 0
+        self.errors = 0
+        self.bypassed = 0
+
+    def _lookup(self, key):
+        try:
+            expires, _, value = self._data[key]
+        except KeyError:
+            return False, None
+        if expires is not None and expires <= time.monotonic():
+            self._remove(key)
+            self.expirations += 1
+            return False, None
+        self._data.move_to_end(key)
+        return True, value
+
+    def _remove(self, key):
+        _, weight, _ = self._data.pop(key)
+        self._weight -= weight
+
+    def _store(self, key, value):
+        ttl = self.negative_ttl if self.is_negative(value) else self.ttl
+        if ttl is not None and ttl <= 0:
+            return
+        if key in self._data:
+            self._remove(key)
+        weight = self.weigher(value) if self.weigher is not None else 0
+        self._data[key] = (None if ttl is None else time.monotonic() + ttl, weight, value)
+        self._weight += weight
+        while self._data and (len(self._data) > self.maxsize or
+                              (self.max_weight is not None and self._weight > self.max_weight)):
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    async def _load(self, key, loader):
+        try:
+            value = await loader()
+        except Exception:
+            self.errors += 1
+            raise
+        self._store(key, value)
+        return value
+
+    async def get(self, key, loader):
+        """
+        Gets the value for a key, calling `loader()` (a coroutine function) to load it on a miss.
+        """
+        found, value = self._lookup(key)
+        if found:
+            if self.is_negative(value):
+                self.negative_hits += 1
+            else:
+                self.hits += 1
+            return value
+
+        task = self._inflight.get(key)
+        if task is not None:
+            self.coalesced += 1
+        else:
+            self.misses += 1
+            task = self._inflight[key] = asyncio.ensure_future(self._load(key, loader))
+            task.add_done_callback(lambda _: self._inflight.pop(key, None))
+        # Shielded, so one cancelled caller doesn't cancel the load for everyone else.
+        return await asyncio.shield(task)
+
+    def invalidate(self, key):
+        if key in self._data:
+            self._remove(key)
+
+    def clear(self):
+        self._data.clear()
+        self._weight = 0
+
+    def stats(self) -> dict:
+        lookups = self.hits + self.negative_hits + self.misses + self.coalesced
+        return {
+            "size": len(self._data), "max_size": self.maxsize, "weight": self._weight, "max_weight": self.max_weight,
+            "hits": self.hits, "negative_hits": self.negative_hits, "misses": self.misses,
+            "coalesced": self.coalesced, "evictions": self.evictions, "expirations": self.expirations,
+            "errors": self.errors, "bypassed": self.bypassed,
+            "hit_rate": (self.hits + self.negative_hits + self.coalesced) / lookups if lookups else 0.0
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+
+def async_cache(maxsize: int = 128, ttl: float = 60, negative_ttl: float = None, max_weight: int = None,
+                weigher=None, is_negative=None):
+    """
+    Caches the results of a coroutine function. See `AsyncTTLCache` for the arguments.
+
+    Calls with unhashable arguments are not cached.
+    The wrapper has the cache as `.cache`, and `.invalidate(*args, **kwargs)` to drop one entry.
+    """
+    def decorator(fn):
+        cache = AsyncTTLCache(maxsize=maxsize, ttl=ttl, negative_ttl=negative_ttl, max_weight=max_weight,
+                              weigher=weigher, is_negative=is_negative)
+        caches["{}.{}".format(fn.__module__, fn.__qualname__)] = cache
+
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            key = _make_key(args, kwargs)
+            try:
+                hash(key)
+            except TypeError:
+                # Unhashable arguments can't be cached, so just call through.
+                cache.bypassed += 1
+                return await fn(*args, **kwargs)
+            return await cache.get(key, functools.partial(fn, *args, **kwargs))
+
+        wrapper.cache = cache
+        wrapper.invalidate = lambda *args, **kwargs: cache.invalidate(_make_key(args, kwargs))
+        return wrapper
+
+    return decorator
+
+
+def get_stats() -> dict:
+    """
+    Gets the stats of every cache made by `async_cache` or `TieredCache`.
+    """
+    return {name: cache.stats() for name, cache in caches.items()}
+
+
+class JSONSerializer:
+    @staticmethod
+    def dumps(value) -> bytes:
+        return json.dumps(value, separators=(",", ":")).encode()
+
+    @staticmethod
+    def loads(data: bytes):
+        return json.loads(data.decode())
+
+
+class MsgpackSerializer:
+    @staticmethod
+    def dumps(value) -> bytes:
+        return msgpack.packb(value, use_bin_type=True)
+
+    @staticmethod
+    def loads(data: bytes):
+        return msgpack.unpackb(data, raw=False)
+
+
+def get_serializer(name: str):
+    """
+    Gets a serializer by name. msgpack falls back to JSON if it isn't installed.
+    """
+    if name == "msgpack":
+        if msgpack is not None:
+            return MsgpackSerializer
+        logger.warning("msgpack is not installed, falling back to JSON for the shared cache.")
+    elif name != "json":
+        raise ValueError("Unknown cache serializer `{}`".format(name))
+    return JSONSerializer
+
+
+class TieredCache:
+    """
+    A two-tier cache: an in-process `AsyncTTLCache` in front of redis.
+
+    Values are stored in redis as `[value, delta, expires]`, where delta is how long the value took to compute.
+    Hits are refreshed in the background slightly before they expire, with a probability that rises as expiry gets
+    closer and for values that are slow to compute (XFetch), so a popular key never expires under load.
+    Misses take a short redis lock, so only one shard computes a value while the others wait for it.
+    """
+
+    def __init__(self, prefix: str = "cached", local_size: int = 1024, local_ttl: float = 10,
+                 serializer: str = "json", beta: float = 1.0, lock_timeout: float = 10):
+        self.prefix = prefix
+        self.local = AsyncTTLCache(maxsize=local_size, ttl=local_ttl, negative_ttl=local_ttl)
+        self.serializer = get_serializer(serializer)
+        self.beta = beta
+        self.lock_timeout = lock_timeout
+
+        self._refreshing = set()
+
+        self.early_refreshes = 0
+        self.lock_waits = 0
+        self.remote_hits = 0
+        self.remote_misses = 0
+        caches["tiered:{}".format(prefix)] = self
+
+    def _key(self, key: str) -> str:
+        return "{}:{}".format(self.prefix, key)
+
+    async def get(self, key: str, loader, expires: float = 300):
+        """
+        Gets a value, calling `loader()` (a coroutine function) to compute it if neither tier has it.
+        The value must be serializable, and is kept in redis for `expires` seconds.
+        """
+        if self.local.ttl is None or self.local.ttl > 0:
+            return await self.local.get(key, functools.partial(self._fetch, key, loader, expires))
+        return await self._fetch(key, loader, expires)
+
+    def _should_refresh(self, delta: float, expiry: float) -> bool:
+        # XFetch: -log(random()) is exponentially distributed, so early refreshes are rare until close to expiry.
+        return time.time() - delta * self.beta * math.log(random.random() or 1e-12) >= expiry
+
+    async def _fetch(self, key: str, loader, expires: float):
+        from navalbot.api import util
+        pool = await util.get_pool()
+        async with pool.get() as conn:
+            assert isinstance(conn, aioredis.Redis)
+            data = await conn.get(self._key(key))
+
+        if data is not None:
+            try:
+                value, delta, expiry = self.serializer.loads(data)
+            except (ValueError, TypeError):
+                logger.warning("Dropping undecodable cache entry `{}`.".format(self._key(key)))
+            else:
+                self.remote_hits += 1
+                if key not in self._refreshing and self._should_refresh(delta, expiry):
+                    # Serve the current value, and recompute it in the background.
+                    self.early_refreshes += 1
+                    self._refreshing.add(key)
+                    task = asyncio.ensure_future(self._compute(key, loader, expires, wait=False))
+                    task.add_done_callback(functools.partial(self._refreshed, key))
+                return value
+
+        self.remote_misses += 1
+        return await self._compute(key, loader, expires, wait=True)
+
+    def _refreshed(self, key: str, task: asyncio.Future):
+        self._refreshing.discard(key)
+        if not task.cancelled() and task.exception() is not None:
+            logger.warning("Background refresh of `{}` failed: {}".format(self._key(key), task.exception()))
+
+    async def _compute(self, key: str, loader, expires: float, wait: bool):
+        """
+        Computes a value under the redis lock for the key.
+
+        If another shard holds the lock, this waits for its result (or gives up if `wait` is false).
+        If that shard doesn't store a result before the lock times out, the value is computed here anyway.
+        """
+        from navalbot.api import util
+        lock_key = self._key(key) + ":lock"
+        token = uuid.uuid4().hex
+        pool = await util.get_pool()
+        async with pool.get() as conn:
+            assert isinstance(conn, aioredis.Redis)
+            locked = await conn.set(lock_key, token, pexpire=int(self.lock_timeout * 1000),
+                                    exist=conn.SET_IF_NOT_EXIST)
+        if not locked:
+            if not wait:
+                return None
+            self.lock_waits += 1
+            deadline = time.monotonic() + self.lock_timeout
+            while time.monotonic() < deadline:
+                # The connection goes back to the pool while sleeping, so waiters can't starve it.
+                await asyncio.sleep(0.05)
+                async with pool.get() as conn:
+                    data = await conn.get(self._key(key))
+                if data is not None:
+                    try:
+                        return self.serializer.loads(data)[0]
+                    except (ValueError, TypeError):
+                        break
+
+        try:
+            start = time.monotonic()
+            value = await loader()
+            delta = time.monotonic() - start
+            async with pool.get() as conn:
+                await conn.set(self._key(key), self.serializer.dumps([value, delta, time.time() + expires]),
+                               expire=int(math.ceil(expires)))
+        finally:
+            if locked:
+                async with pool.get() as conn:
+                    # Only release the lock if it's still ours. This isn't atomic, but the worst case is another
+                    # shard computing the same value.
+                    if await conn.get(lock_key) == token.encode():
+                        await conn.delete(lock_key)
+        return value
+
+    async def invalidate(self, key: str):
+        from navalbot.api import util
+        self.local.invalidate(key)
+        pool = await util.get_pool()
+        async with pool.get() as conn:
+            await conn.delete(self._key(key))
+
+    def stats(self) -> dict:
+        stats = self.local.stats()
+        stats.update(remote_hits=self.remote_hits, remote_misses=self.remote_misses,
+                     early_refreshes=self.early_refreshes, lock_waits=self.lock_waits)
+        return stats
@@ -19,14 +19,13 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 =================================
 """
 
-import shlex
-
 import discord
 
-from navalbot.api import util, db
+from navalbot.api import util, db, executors, lagmonitor, metrics
 from navalbot.api.contexts import CommandContext, OnMessageEventContext
 from navalbot.api.locale import get_locale
-from navalbot.api.util import has_permissions_with_override, async_lru
+from navalbot.api.permissions import permission_cache
+from navalbot.api.tokens import Tokens
 
 
 class _RoleProxy:
@@ -53,6 +52,29 @@ class NavalRole:
         return got
 
 
+class _Invocation:
+    """
+    State shared between the checks for one invocation of a command.
+    """
+
+    __slots__ = ("prefix", "tokens", "command_name", "args", "_perms")
+
+    def __init__(self, prefix: str, tokens: Tokens):
+        self.prefix = prefix
+        self.tokens = tokens
+        self.command_name = tokens.command
+        self.args = None
+        self._perms = None
+
+    async def get_perms(self, ctx: OnMessageEventContext):
+        """
+        Gets the server's permission snapshot, loading it once per invocation at most.
+        """
+        if self._perms is None:
+            self._perms = await permission_cache.get(ctx.message.server.id)
+        return self._perms
+
+
 class Command(object):
     """
     This represents a command, used by the bot.
@@ -69,6 +91,7 @@ class Command(object):
         self._wrapped_coro = to_wrap
 
         self._parse_kwargs(**kwargs)
+        self._compile_plan()
 
     def _parse_kwargs(self, **kwargs):
         """
@@ -107,6 +130,11 @@ class Command(object):
         else:
             self._force_normal_split = False
 
+        # Low priority commands are refused when the bot is overloaded.
+        self.priority = kwargs.get("priority", "normal")
+        if self.priority not in ("low", "normal"):
+            raise ValueError("Unknown command priority `{}`".format(self.priority))
+
     async def help(self, server: discord.Server) -> str:
         """
         Get the help for a specific function.
@@ -114,16 +142,16 @@ class Command(object):
         # load it from locale
 
         loc = await db.get_config(server.id, "lang", default=None)
-        loc = get_locale(loc)
+        return self._help_text(get_locale(loc))
 
+    def _help_text(self, loc) -> str:
         doc = loc.get("help.{}".format(self._wrapped_coro.__name__))
         if not doc:
             doc = loc["help.None"]
 
         return doc
 
-    async def _construct_arg_error_msg(self, server: discord.Server):
-        prefix = await db.get_config(server.id, "command_prefix", default="?")
+    def _construct_arg_error_msg(self, prefix: str, loc) -> str:
         base = """```{}({})""".format(prefix, '|'.join(self.names))
 
         if self._args_type == 0:
@@ -131,7 +159,7 @@ class Command(object):
         elif self._args_type == 1:
             base += " <{} arguments>\n\n".format(self._args_count)
 
-        base += await self.help(server) + "\n```"
+        base += self._help_text(loc) + "\n```"
 
         return base
 
@@ -154,103 +182,119 @@ class Command(object):
 
         return new_roles
 
+    def _compile_plan(self):
+        """
+        Builds the checks `invoke` runs, in order.
+
+        Checks that only need the message come first, so a command that fails them never touches redis.
+        """
+        plan = []
+        if self.priority == "low":
+            plan.append(("shed", self._check_shed))
+        if self._only_owner:
+            plan.append(("owner", self._check_owner))
+        # Arguments are checked before the permissions, so a bad call to a disabled command, or one the user doesn't
+        # have the roles for, gets the usage message rather than the disabled or bad role message.
+        if hasattr(self, "_args_type"):
+            plan.append(("args", self._check_args))
+        # Don't check if `enable_command` is disabled.
+        # Otherwise, you can disable enabling of commands.
+        if self._wrapped_coro.__name__ != "enable_command":
+            plan.append(("disabled", self._check_disabled))
+        if hasattr(self, "_roles"):
+            plan.append(("roles", self._check_roles))
+        self._plan = tuple(plan)
+        # Stage timings are recorded under this event.
+        self._metrics_event = "command:{}".format(self._wrapped_coro.__name__)
+
+    # Checks.
+    # Each gets the message context and the invocation, and returns False if the command shouldn't run.
+    async def _check_shed(self, ctx: OnMessageEventContext, inv: '_Invocation') -> bool:
+        if ctx.client.lag.sheds(lagmonitor.SHED_COMMANDS):
+            metrics.incr("shed.commands")
+            await ctx.reply("generic.overloaded", command=inv.command_name)
+            return False
+        return True
+
+    async def _check_owner(self, ctx: OnMessageEventContext, inv: '_Invocation') -> bool:
+        owner = util.get_global_config("RCE_ID", default=0, type_=int)
+        if int(ctx.message.author.id) != owner:
+            await ctx.client.send_message(ctx.message.channel, ctx.loc["perms.not_owner"])
+            return False
+        return True
+
+    async def _check_args(self, ctx: OnMessageEventContext, inv: '_Invocation') -> bool:
+        # Split out the args into a list.
+        args = inv.tokens.args(split_words=self._force_normal_split)
+        if self._args_type in [0, 2]:
+            valid = not (self._args_type == 0 and len(args) < 1)
+        else:
+            valid = len(args) == self._args_count
+
+        if not valid:
+            await ctx.client.send_message(ctx.message.channel, self._construct_arg_error_msg(inv.prefix, ctx.loc))
+            return False
+        inv.args = args
+        return True
+
+    async def _check_disabled(self, ctx: OnMessageEventContext, inv: '_Invocation') -> bool:
+        perms = await inv.get_perms(ctx)
+        name = self._wrapped_coro.__name__
+        if perms.is_disabled(name):
+            await ctx.reply("generic.command_disabled", command=inv.command_name)
+            return False
+        if perms.is_disabled(name, ctx.member.id):
+            await ctx.reply("generic.command_user_disabled", command=inv.command_name)
+            return False
+        return True
+
+    async def _check_roles(self, ctx: OnMessageEventContext, inv: '_Invocation') -> bool:
+        # Ignore role checks if we're a self-bot.
+        if ctx.client.config.get("self_bot"):
+            return True
+        if not isinstance(ctx.message.author, discord.Member):
+            await ctx.client.send_message(ctx.message.channel, ctx.loc["perms.cannot_determine_role"])
+            return False
+        if ctx.message.server.owner == ctx.message.author:
+            return True
+
+        # Get the role names for this server, with any overrides.
+        perms = await inv.get_perms(ctx)
+        required, allowed = perms.roles_for(self._wrapped_coro.__name__, self._roles)
+        if not perms.has_any_role(ctx.message.author, allowed):
+            await ctx.client.send_message(ctx.message.channel, ctx.loc['perms.bad_role'].format(roles=set(required)))
+            return False
+        return True
+
     async def invoke(self, ctx: OnMessageEventContext):
         """
         Invoke the function.
         """
         # Load the prefix, again.
         # This is so spaces in prefixes don't break everything.
-        prefix = await db.get_config(ctx.message.server.id, "command_prefix", default="?")
+        # It comes from the snapshot, so it doesn't cost another round trip.
+        snapshot = await ctx.get_snapshot()
+        prefix = snapshot.get_config("command_prefix", default="?")
 
-        command_name = ctx.message.content[len(prefix):].split(" ")[0]
+        tokens = ctx.get_tokens(prefix)
+        inv = _Invocation(prefix, tokens)
 
         # Do the checks before running the coroutine.
-        # Owner check.
-
-        if self._only_owner:
-            owner = util.get_global_config("RCE_ID", default=0, type_=int)
-            u_id = int(ctx.message.author.id)
-            # Check if it is in the ids specified.
-            if not u_id == owner:
-                # await client.send_message(message.channel, ":no_entry: This command is restricted to bot owners.")
-                await ctx.client.send_message(ctx.message.channel, ctx.loc["perms.not_owner"])
-                return
-
-        # Check if the command is disabled.
-        # Don't do this check on `enable_command`.
-        # Otherwise, you can disable enabling of commands.
-        if self._wrapped_coro.__name__ != "enable_command":
-            disabled = await db.get_config(ctx.message.server.id, "disabled:{}".format(self._wrapped_coro.__name__),
-                                           default=False, type_=bool)
-            if not disabled:
-                user_disabled = await db.get_config(ctx.message.server.id,
-                                                    "disabled:{}:{}".format(self._wrapped_coro.__name__, ctx.member.id),
-                                                    default=False, type_=bool)
-            else:
-                user_disabled = False
-            if disabled: key = "generic.command_disabled"
-            elif user_disabled: key = "generic.command_user_disabled"
-            if disabled or user_disabled:
-                await ctx.reply(key, command=command_name)
-                return
-
-        # Get the user's roles.
-        # Ignore role checks if we're a self-bot.
-        if not ctx.client.config.get("self_bot"):
-            if hasattr(self, "_roles"):
-                try:
-                    assert isinstance(ctx.message.author, discord.Member)
-                except AssertionError:
-                    await ctx.client.send_message(ctx.message.channel, ctx.loc["perms.cannot_determine_role"])
+        for stage, check in self._plan:
+            with metrics.time_hook(self._metrics_event, stage):
+                if not await check(ctx, inv):
                     return
 
-                # Load roles correctly.
-                new_roles = await self._load_roles(ctx.message.server)
-
-                if not ctx.message.server.owner == ctx.message.author:
-                    if not await has_permissions_with_override(ctx.message.author, new_roles, ctx.message.server.id,
-                                                               self._wrapped_coro.__name__):
-                        # await client.send_message(
-                        #    message.channel,
-                        #    ":no_entry: You do not have any of the required roles: `{}`!"
-                        #        .format({role.val for role in allowed_roles})
-                        ss = ctx.loc['perms.bad_role'].format(roles={role for role in new_roles})
-                        await ctx.client.send_message(ctx.message.channel, ss)
-                        return
-
-        # Arguments check.
-        if hasattr(self, "_args_type"):
-            if self._args_type in [0, 2]:
-                # Get the content, with the content split.
-
-                ctt = ctx.message.content[len(prefix):]
-
-                # Split out the args into a list.
-                if not self._force_normal_split:
-                    try:
-                        args = shlex.split(ctt)[1:]
-                    except ValueError:
-                        args = ctt.split(" ")[1:]
-                else:
-                    args = ctt.split(" ")[1:]
-                if self._args_type == 0 and len(args) < 1:
-                    await ctx.client.send_message(
-                        ctx.message.channel, await self._construct_arg_error_msg(ctx.message.server)
-                    )
-                    return
-            elif self._args_type == 1:
-                ctt = ctx.message.content[len(prefix):]
-                args = shlex.split(ctt)[1:]
-                if len(args) != self._args_count:
-                    await ctx.client.send_message(ctx.message.channel,
-                                                  await self._construct_arg_error_msg(ctx.message.server))
-                    return
         # Create the context.
-        ctx = CommandContext(ctx.client, ctx.message, locale=ctx.loc)
-        ctx.command_name = command_name
+        ctx = CommandContext(ctx.client, ctx.message, locale=ctx.loc, snapshot=snapshot, tokens=tokens)
+        ctx.command_name = inv.command_name
 
         # Now that we've gotten all of the returns out of the way, invoke the coroutine.
-        if hasattr(self, "_args_type"):
-            ctx.args = args
-
-        await self._wrapped_coro(ctx)  # Await the sub command.
\ No newline at end of file
+        if inv.args is not None:
+            ctx.args = inv.args
+
+        with metrics.time_hook(self._metrics_event, "run"):
+            try:
+                await self._wrapped_coro(ctx)  # Await the sub command.
+            except executors.ExecutorOverloaded:
+                await ctx.reply("generic.overloaded", command=inv.command_name)
\ No newline at end of file
@@ -1,6 +1,7 @@
 """
 Contexts - contains files for contexts, such as CommandContext or EventContext.
 """
+import asyncio
 import typing
 
 import aioredis
@@ -8,9 +9,15 @@ import aioredis
 import discord
 from navalbot.api import db
 from navalbot.api import botcls
+from navalbot.api.blacklists import blacklists
 from navalbot.api.locale import LocaleLoader, get_locale
+from navalbot.api.tokens import Tokens
 from navalbot.api.util import get_pool
 
+# Things a message hook can ask to have resolved before it runs.
+# Hooks get all of them unless they say otherwise.
+MESSAGE_NEEDS = frozenset({"locale", "blacklist"})
+
 
 class Context:
     """
@@ -110,12 +117,20 @@ class OnMessageEventContext(EventContext):
 
     event = "ON_MESSAGE"
 
-    def __init__(self, client: 'botcls.NavalClient', message: discord.Message, locale: LocaleLoader = None):
+    def __init__(self, client: 'botcls.NavalClient', message: discord.Message, locale: LocaleLoader = None,
+                 snapshot: db.GuildSnapshot = None, tokens: Tokens = None):
         super().__init__(client)
 
         self._message = message
         self._locale = locale
 
+        self._snapshot = snapshot
+        self._tokens = tokens
+        self._blacklisted = None
+
+        # Hooks share a context and run concurrently, so only one of them should resolve at once.
+        self._resolve_lock = asyncio.Lock()
+
     @property
     def server(self):
         return self._message.server
@@ -136,6 +151,59 @@ class OnMessageEventContext(EventContext):
     def loc(self):
         return self._locale
 
+    @property
+    def snapshot(self) -> db.GuildSnapshot:
+        return self._snapshot
+
+    @property
+    def blacklisted(self) -> bool:
+        """
+        If the author is blacklisted, either globally or on this server.
+
+        This is None until the blacklist has been resolved.
+        """
+        return self._blacklisted
+
+    async def resolve(self, *needs: str) -> 'OnMessageEventContext':
+        """
+        Resolves the lazily loaded parts of this context.
+
+        `locale` loads the server's locale, and `blacklist` checks the author against the blacklists.
+        Anything already resolved is not loaded again.
+        """
+        with await self._resolve_lock:
+            if "locale" in needs and self._locale is None:
+                self._locale = get_locale((await self.get_snapshot()).get_config("lang"))
+            if "blacklist" in needs and self._blacklisted is None:
+                self._blacklisted = (await blacklists.is_globally_blacklisted(self.member.id)
+                                     or await blacklists.is_blacklisted(self.server.id, self.member.id))
+        return self
+
+    async def get_snapshot(self) -> db.GuildSnapshot:
+        """
+        Gets the guild snapshot for this message, loading it if it wasn't passed in.
+        """
+        if self._snapshot is None:
+            self._snapshot = await db.get_guild_snapshot(self.server.id)
+        return self._snapshot
+
+    async def get_prefix(self) -> str:
+        """
+        Gets the command prefix for this server from the snapshot.
+        """
+        return (await self.get_snapshot()).get_config("command_prefix", default="?")
+
+    def get_tokens(self, prefix: str) -> Tokens:
+        """
+        Gets the message content after the prefix, tokenized.
+
+        This is only tokenized again if the content has changed, i.e for factoid commands.
+        """
+        text = self._message.content[len(prefix):]
+        if self._tokens is None or self._tokens.text != text:
+            self._tokens = Tokens(text)
+        return self._tokens
+
     async def reply(self, key: str, **fmt):
         """
         Wrapper around self.locale["key"] and self.client.send_message(self.message.channel, whatever)
@@ -198,8 +266,8 @@ class CommandContext(OnMessageEventContext):
     """
 
     def __init__(self, client: 'botcls.NavalClient', message: discord.Message, locale: LocaleLoader,
-                 args: list = None):
-        super().__init__(client, message, locale)
+                 args: list = None, snapshot: db.GuildSnapshot = None, tokens: Tokens = None):
+        super().__init__(client, message, locale, snapshot=snapshot, tokens=tokens)
         self.args = args
 
         self.command_name = ""
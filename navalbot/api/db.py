@@ -21,29 +21,342 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 """
 
 # This handles aioredis DB stuff.
+import asyncio
+import collections
+import logging
+import time
+
 import aioredis
 
+from navalbot.api import backends
 from navalbot.api import util
 
+logger = logging.getLogger("NavalBot")
+
+# Server config is stored as one hash per server, `config:{sid}`, with a field for each key.
+# Older versions stored a string per key, as `config:{sid}:{key}`. Until those have been converted with
+# `tools/migrate_config_hashes.py`, `redis.config_dual_read` makes keys missing from the hash fall back to them.
+
+# Config keys that are loaded into every guild snapshot.
+SNAPSHOT_KEYS = ("lang", "command_prefix", "autodelete")
+
+# Keyspace notification classes needed for invalidation: K = keyspace, $ = string commands, g = DEL/EXPIRE/RENAME,
+# h = hash commands, s = set commands (for command role overrides).
+_NOTIFY_FLAGS = "K$ghs"
+
+_MISSING = object()
+
+
+class ConfigCache:
+    """
+    A bounded, read-through LRU cache for server config keys.
+
+    Entries are keyed by `config:{sid}:{key}`, and store the raw value (or None, if the key isn't set) alongside an
+    expiry time.
+    Coherence between shards is handled by `listen_for_invalidations`, which drops keys as redis reports changes.
+    """
+
+    def __init__(self, size: int = 4096, ttl: float = 60):
+        self.size = size
+        self.ttl = ttl
+
+        self._data = collections.OrderedDict()
+        # Cached keys for each server, so a whole server can be dropped at once.
+        self._servers = collections.defaultdict(set)
+
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.invalidations = 0
+
+    def get(self, key: str):
+        """
+        Gets a raw value from the cache, or _MISSING if it isn't cached or has expired.
+        """
+        try:
+            expires, value = self._data[key]
+        except KeyError:
+            self.misses += 1
+            return _MISSING
+
+        if expires < time.monotonic():
+            self._remove(key)
+            self.misses += 1
+            return _MISSING
+
+        self._data.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key: str, value):
+        """
+        Stores a raw value in the cache, evicting the least recently used entry if it is full.
+        """
+        if self.size <= 0:
+            return
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        self._servers[_server_of(key)].add(key)
+        while len(self._data) > self.size:
+            self._remove(next(iter(self._data)))
+            self.evictions += 1
+
+    def _remove(self, key: str) -> bool:
+        if self._data.pop(key, _MISSING) is _MISSING:
+            return False
+        server_id = _server_of(key)
+        keys = self._servers[server_id]
+        keys.discard(key)
+        if not keys:
+            del self._servers[server_id]
+        return True
+
+    def invalidate(self, key: str):
+        if self._remove(key):
+            self.invalidations += 1
+
+    def invalidate_server(self, server_id: str):
+        """
+        Drops every cached key for a server.
+        """
+        for key in list(self._servers.get(server_id, ())):
+            self.invalidate(key)
+
+    def clear(self):
+        self._data.clear()
+        self._servers.clear()
+
+    def stats(self) -> dict:
+        return {
+            "size": len(self._data), "max_size": self.size, "hits": self.hits, "misses": self.misses,
+            "evictions": self.evictions, "invalidations": self.invalidations
+        }
+
+    def __len__(self):
+        return len(self._data)
+
+
+config_cache = ConfigCache()
+
+# Functions called as `func(server_id, key)` when server config changes, here or on another shard.
+# `key` is None if any key may have changed, and `server_id` is None if any server may have.
+_change_listeners = []
+
+
+def add_change_listener(func):
+    """
+    Registers a function to be told about config changes, i.e to drop data derived from the config.
+    """
+    _change_listeners.append(func)
+
+
+def _changed(server_id: str = None, key: str = None):
+    for func in _change_listeners:
+        func(server_id, key)
+
+
+def _build_key(server_id: str, key: str) -> str:
+    return "config:{sid}:{key}".format(sid=server_id, key=key)
+
+
+def _hash_key(server_id: str) -> str:
+    return "config:{sid}".format(sid=server_id)
+
+
+def _server_of(key: str) -> str:
+    return key.split(":", 2)[1]
+
+
+def _dual_read() -> bool:
+    return util.get_global_config("redis", default={}).get("config_dual_read", True)
+
+
+def _coerce(data: bytes, default, type_: type):
+    """
+    Converts a raw redis value into the type requested.
+    """
+    if not data:
+        return default
+    try:
+        if type_ == bool:
+            return data.decode().lower() == "true"
+        else:
+            return type_(data.decode())
+    except (ValueError, AttributeError):
+        return default
+
+
+class GuildSnapshot:
+    """
+    A snapshot of the per-server data needed to process a single message.
+
+    This is loaded in one round trip, and hangs off the message context so hooks and commands don't need to go to
+    redis themselves.
+    """
+
+    def __init__(self, server_id: str, config: dict):
+        self.server_id = server_id
+
+        self._config = config
+
+    def get_config(self, key: str, default=None, type_: type = str):
+        """
+        Gets a config value from the snapshot.
+
+        This has the same semantics as `db.get_config`.
+        """
+        return _coerce(self._config.get(key), default, type_)
+
+    async def fetch(self, *keys: str):
+        """
+        Loads extra config keys into the snapshot, using a single HMGET for all of them.
+        """
+        missing = [key for key in keys if key not in self._config]
+        if not missing:
+            return
+        pool = await util.get_pool()
+        async with pool.get() as conn:
+            self._config.update(await _mget_cached(conn, self.server_id, missing))
+
+    def __repr__(self):
+        return "<GuildSnapshot for server {} ({} keys)>".format(self.server_id, len(self._config))
+
+
+async def get_guild_snapshot(server_id: str, extra_keys: tuple = ()) -> GuildSnapshot:
+    """
+    Loads a GuildSnapshot for the specified server.
+
+    If all the keys are cached, this doesn't go to redis. Otherwise, the missing keys are loaded with a single HMGET.
+    The hash also holds the server's factoids, so it is never loaded whole here.
+    Blacklists are not part of the snapshot, they are kept in memory by `navalbot.api.blacklists`.
+    """
+    keys = SNAPSHOT_KEYS + tuple(extra_keys)
+    cached = {}
+    for key in keys:
+        value = config_cache.get(_build_key(server_id, key))
+        if value is _MISSING:
+            break
+        cached[key] = value
+    else:
+        return GuildSnapshot(server_id, cached)
+
+    pool = await util.get_pool()
+    async with pool.get() as conn:
+        config = await _mget_cached(conn, server_id, keys)
+    return GuildSnapshot(server_id, config)
+
+
+async def _mget_legacy(conn: aioredis.Redis, server_id: str, keys) -> dict:
+    """
+    Loads config keys stored in the old string-per-key layout.
+    """
+    return dict(zip(keys, await conn.mget(*[_build_key(server_id, key) for key in keys])))
+
+
+async def _hmget(conn: aioredis.Redis, server_id: str, keys) -> dict:
+    """
+    Loads config keys from a server's config hash, falling back to the old layout if dual reads are on.
+    """
+    found = dict(zip(keys, await conn.hmget(_hash_key(server_id), *keys)))
+    if _dual_read():
+        legacy = [key for key, value in found.items() if value is None]
+        if legacy:
+            found.update(await _mget_legacy(conn, server_id, legacy))
+    return found
+
+
+async def _mget_cached(conn: aioredis.Redis, server_id: str, keys) -> dict:
+    """
+    Loads config keys through the config cache, using a single HMGET for any that are not cached.
+    """
+    found = {}
+    missing = []
+    for key in keys:
+        value = config_cache.get(_build_key(server_id, key))
+        if value is _MISSING:
+            missing.append(key)
+        else:
+            found[key] = value
+
+    if missing:
+        for key, value in (await _hmget(conn, server_id, missing)).items():
+            config_cache.put(_build_key(server_id, key), value)
+            found[key] = value
+
+    return found
+
+
+async def warm_configs(server_ids: list, keys) -> int:
+    """
+    Loads config keys for many servers into the config cache, pipelining an HMGET for each of them.
+
+    Returns the number of servers loaded.
+    """
+    keys = tuple(keys)
+    pool = await util.get_pool()
+    async with pool.get() as conn:
+        assert isinstance(conn, aioredis.Redis)
+        pipe = conn.pipeline()
+        for server_id in server_ids:
+            pipe.hmget(_hash_key(server_id), *keys)
+        configs = [dict(zip(keys, values)) for values in await pipe.execute()]
+
+        if _dual_read():
+            pipe = conn.pipeline()
+            legacy = []
+            for server_id, config in zip(server_ids, configs):
+                missing = [key for key in keys if config[key] is None]
+                if missing:
+                    pipe.mget(*[_build_key(server_id, key) for key in missing])
+                    legacy.append((config, missing))
+            if legacy:
+                for (config, missing), values in zip(legacy, await pipe.execute()):
+                    config.update(zip(missing, values))
+
+    for server_id, config in zip(server_ids, configs):
+        for key in keys:
+            config_cache.put(_build_key(server_id, key), config.get(key))
+    return len(configs)
+
 
 async def get_config(server_id: str, key: str, default=None, type_: type = str) -> str:
     """
     Gets a config from the redis DB.
+
+    This is read through the config cache.
+    """
+    # Get the pool first, so a new client's pool has already cleared the cache.
+    pool = await util.get_pool()
+    built = _build_key(server_id, key)
+    data = config_cache.get(built)
+    if data is _MISSING:
+        async with pool.get() as conn:
+            data = await conn.hget(_hash_key(server_id), key)
+            if data is None and _dual_read():
+                data = await conn.get(built)
+        config_cache.put(built, data)
+    return _coerce(data, default, type_)
+
+
+async def get_all_config(server_id: str, legacy_match: str = None) -> dict:
+    """
+    Gets every config key set on a server, as a dict of key -> raw value.
+
+    This is one HGETALL, and doesn't go through the config cache.
+    Keys only stored in the old layout are not included, unless `legacy_match` is given and dual reads are on. Then
+    keys matching that glob are SCANned for, which walks the whole keyspace, so never do it on a hot path.
     """
     pool = await util.get_pool()
-    # Get the value of config:server_id:key.
-    built = "config:{sid}:{key}".format(sid=server_id, key=key)
     async with pool.get() as conn:
-        data = await conn.get(built)
-        if not data:
-            return default
-        try:
-            if type_ == bool:
-                return data.decode().lower() == "true"
-            else:
-                return type_(data.decode())
-        except (ValueError, AttributeError):
-            return default
+        assert isinstance(conn, aioredis.Redis)
+        config = {field.decode(): value for field, value in (await conn.hgetall(_hash_key(server_id))).items()}
+        if legacy_match is not None and _dual_read():
+            prefix = _build_key(server_id, "")
+            legacy = [key.decode()[len(prefix):] async for key in conn.iscan(match=prefix + legacy_match)]
+            legacy = [key for key in legacy if key not in config]
+            if legacy:
+                config.update(await _mget_legacy(conn, server_id, legacy))
+    return {key: value for key, value in config.items() if value is not None}
 
 
 async def set_config(server_id: str, key: str, value: str):
@@ -51,10 +364,18 @@ async def set_config(server_id: str, key: str, value: str):
     Sets a config in the redis DB.
     """
     pool = await util.get_pool()
-    # Set config:server_id:key.
-    built = "config:{sid}:{key}".format(sid=server_id, key=key)
+    built = _build_key(server_id, key)
     async with pool.get() as conn:
-        conn.set(built, value)
+        assert isinstance(conn, aioredis.Redis)
+        pipe = conn.pipeline()
+        pipe.hset(_hash_key(server_id), key, value)
+        if _dual_read():
+            # Drop the old copy, so it can't show through if this is deleted later.
+            pipe.delete(built)
+        await pipe.execute()
+    # Other shards are told about this through keyspace notifications.
+    config_cache.invalidate(built)
+    _changed(server_id, key)
 
 
 async def delete_config(server_id: str, key: str):
@@ -62,10 +383,115 @@ async def delete_config(server_id: str, key: str):
     Deletes a val in the redis DB.
     """
     pool = await util.get_pool()
-    # Set config:server_id:key.
-    built = "config:{sid}:{key}".format(sid=server_id, key=key)
+    built = _build_key(server_id, key)
     async with pool.get() as conn:
-        return await conn.delete(built)
+        deleted = await conn.hdel(_hash_key(server_id), key)
+        if _dual_read():
+            deleted += await conn.delete(built)
+    config_cache.invalidate(built)
+    _changed(server_id, key)
+    return deleted
+
+
+async def _enable_keyspace_events(conn: aioredis.Redis):
+    """
+    Makes sure redis is publishing the keyspace events we need, without clobbering any that are already enabled.
+    """
+    try:
+        current = await conn.config_get("notify-keyspace-events")
+        flags = (current.get("notify-keyspace-events") or "") if isinstance(current, dict) else ""
+        if "A" in flags:
+            needed = "K"
+        else:
+            needed = _NOTIFY_FLAGS
+        missing = "".join(f for f in needed if f not in flags)
+        if missing:
+            await conn.config_set("notify-keyspace-events", flags + missing)
+    except aioredis.ReplyError:
+        # CONFIG is often disabled on managed redis instances.
+        logger.warning("Could not enable keyspace notifications. Make sure `notify-keyspace-events` contains `{}`, "
+                       "or config changes on other shards will take up to {}s to be seen."
+                       .format(_NOTIFY_FLAGS, config_cache.ttl))
+
+
+async def create_pubsub_connection() -> aioredis.Redis:
+    """
+    Creates a dedicated connection for subscribing to channels.
+
+    Subscribed connections can't run normal commands, so these can't come from the pool.
+    """
+    backend = backends.get_backend(util.get_global_config("redis", default={}))
+    return await backend.create_connection(encoding="utf-8")
+
+
+def reset_caches():
+    """
+    Drops everything cached from the config, i.e when it may have changed without us seeing it.
+    """
+    config_cache.clear()
+    _changed()
+
+
+def _config_notification(key: str):
+    if key.count(":") == 1:
+        server_id = _server_of(key)
+        config_cache.invalidate_server(server_id)
+        _changed(server_id)
+    else:
+        config_cache.invalidate(key)
+        _, server_id, name = key.split(":", 2)
+        _changed(server_id, name)
+
+
+def _override_notification(key: str):
+    # Overrides are stored as `override:{sid}:{command}`.
+    _, server_id, name = key.split(":", 2)
+    _changed(server_id, "override:" + name)
+
+
+async def _drain(channel, prefix_len: int, handler):
+    while await channel.wait_message():
+        name, _ = await channel.get()
+        if isinstance(name, bytes):
+            name = name.decode()
+        handler(name[prefix_len:])
+
+
+async def listen_for_invalidations():
+    """
+    Subscribes to keyspace notifications for config keys, and drops them from the config cache when they change.
+    Hash notifications don't say which field changed, so a change to a config hash drops the whole server.
+    Command role overrides are watched too, for anything derived from them.
+
+    This keeps the cache coherent when a config is changed on another shard.
+    """
+    db_num = int(util.get_global_config("redis", default={}).get("db", 0))
+    prefix = "__keyspace@{}__:".format(db_num)
+    patterns = (prefix + "config:*", prefix + "override:*")
+    while True:
+        try:
+            conn = await create_pubsub_connection()
+        except (OSError, aioredis.RedisError):
+            logger.warning("Could not connect to redis for cache invalidation, retrying in 5 seconds.")
+            await asyncio.sleep(5)
+            continue
+        try:
+            await _enable_keyspace_events(conn)
+            config_channel, override_channel = await conn.psubscribe(*patterns)
+            # Anything cached before we subscribed may have been missed.
+            reset_caches()
+            logger.info("Listening for config invalidations on `{}`.".format("`, `".join(patterns)))
+            await asyncio.gather(_drain(config_channel, len(prefix), _config_notification),
+                                 _drain(override_channel, len(prefix), _override_notification))
+        except asyncio.CancelledError:
+            conn.close()
+            raise
+        except (OSError, aioredis.RedisError):
+            logger.warning("Lost the cache invalidation connection, reconnecting.")
+        conn.close()
+        # We may have missed events while disconnected.
+        reset_caches()
+        await asyncio.sleep(1)
 
 
 async def get_key(key: str) -> str:
@@ -0,0 +1,177 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Named executor pools for blocking work.
+# Each kind of work gets its own bounded thread pool, so a flood of web lookups can't hold up voice extraction.
+import asyncio
+import concurrent.futures
+import logging
+import threading
+import time
+
+from navalbot.api import metrics
+
+logger = logging.getLogger("NavalBot")
+
+# Pool name -> (workers, queue size), used when a pool isn't configured.
+DEFAULT_POOLS = {
+    "voice-extraction": (4, 16),
+    "web-scrape": (8, 32),
+    "cpu": (2, 16),
+}
+
+
+class ExecutorOverloaded(Exception):
+    """
+    Raised when a job is submitted to a pool whose queue is full.
+    """
+
+    def __init__(self, name: str):
+        super().__init__("Executor pool `{}` is overloaded".format(name))
+        self.name = name
+
+
+class BoundedExecutor:
+    """
+    A thread pool with a limit on how many jobs can be waiting for a worker.
+
+    Jobs submitted past the limit are rejected with `ExecutorOverloaded`, instead of queueing without bound.
+    Time spent waiting for a worker and running are recorded as histograms in `metrics`, under `executor:<name>`.
+    """
+
+    def __init__(self, name: str, workers: int = 4, queue_size: int = 16):
+        self.name = name
+        self.workers = max(1, workers)
+        self.queue_size = max(0, queue_size)
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=self.workers,
+                                                               thread_name_prefix="navalbot-{}".format(name))
+
+        self.pending = 0
+        self.active = 0
+        self.completed = 0
+        self.rejected = 0
+        self._lock = threading.Lock()
+
+        self._wait_timings = metrics.hook_timings[("executor:{}".format(name), "wait")]
+        self._run_timings = metrics.hook_timings[("executor:{}".format(name), "run")]
+
+    @property
+    def queued(self) -> int:
+        return self.pending - self.active
+
+    def _call(self, func, started: list):
+        # Runs on a worker thread, so only the active count is touched here.
+        started.append(time.monotonic())
+        with self._lock:
+            self.active += 1
+        try:
+            return func()
+        finally:
+            with self._lock:
+                self.active -= 1
+
+    async def run(self, func, loop: asyncio.AbstractEventLoop = None):
+        """
+        Runs `func()` on the pool, and returns its result.
+        """
+        if self.pending >= self.workers + self.queue_size:
+            self.rejected += 1
+            metrics.incr("executor.{}.rejected".format(self.name))
+            raise ExecutorOverloaded(self.name)
+
+        loop = loop or asyncio.get_event_loop()
+        submitted = time.monotonic()
+        started = []
+        error = False
+        self.pending += 1
+        try:
+            return await loop.run_in_executor(self._executor, self._call, func, started)
+        except asyncio.CancelledError:
+            # The job may still be running, but it no longer counts against the queue.
+            started = None
+            raise
+        except Exception:
+            error = True
+            raise
+        finally:
+            self.pending -= 1
+            self.completed += 1
+            if started:
+                self._wait_timings.record(started[0] - submitted)
+                self._run_timings.record(time.monotonic() - started[0], error=error)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.workers, "queue_size": self.queue_size, "active": self.active, "queued": self.queued,
+            "completed": self.completed, "rejected": self.rejected,
+            "wait_p95": self._wait_timings.percentile(95), "run_p95": self._run_timings.percentile(95)
+        }
+
+    def shutdown(self, wait: bool = False):
+        self._executor.shutdown(wait=wait)
+
+
+pools = {}
+
+
+def configure(config: dict):
+    """
+    Creates the pools from the `executors` config section, which maps pool names to `workers` and `queue_size`.
+    Pools that already exist are replaced.
+    """
+    for name in set(DEFAULT_POOLS) | set(config):
+        workers, queue_size = DEFAULT_POOLS.get(name, (4, 16))
+        cfg = config.get(name) or {}
+        old = pools.get(name)
+        pools[name] = BoundedExecutor(name, cfg.get("workers", workers), cfg.get("queue_size", queue_size))
+        if old is not None:
+            old.shutdown()
+
+
+def get_executor(name: str) -> BoundedExecutor:
+    """
+    Gets a pool by name, creating it with the default size if it hasn't been configured.
+    """
+    try:
+        return pools[name]
+    except KeyError:
+        workers, queue_size = DEFAULT_POOLS.get(name, (4, 16))
+        pool = pools[name] = BoundedExecutor(name, workers, queue_size)
+        return pool
+
+
+async def run(name: str, func):
+    """
+    Runs `func()` on the named pool.
+    """
+    return await get_executor(name).run(func)
+
+
+def get_stats() -> dict:
+    return {name: pool.stats() for name, pool in pools.items()}
+
+
+def shutdown():
+    for pool in pools.values():
+        pool.shutdown()
+    pools.clear()
@@ -30,7 +30,7 @@ import typing
 import discord
 
 from navalbot.api.botcls import NavalClient
-from navalbot.api.contexts import EventContext
+from navalbot.api.contexts import EventContext, MESSAGE_NEEDS
 
 logger = logging.getLogger("NavalBot")
 
@@ -54,21 +54,45 @@ def on_message(func: typing.Callable[[EventContext], None]) -> types.FunctionTyp
     return on_event("on_message")(func)
 
 
-def on_generic_event(func: typing.Callable[[EventContext], None]) -> types.FunctionType:
+def on_generic_event(func: typing.Callable[[dict], None] = None, *, ops: typing.Iterable[int] = None,
+                     events: typing.Iterable[str] = None):
     """
-    Registers a hook to be ran on every event.
+    Registers a hook to be ran on raw gateway payloads.
+
+    `ops` filters by gateway opcode, and `events` by dispatch type, e.g `@on_generic_event(events=["GUILD_CREATE"])`.
+    The filters are checked before any coroutine is created, so prefer them to checking inside the hook.
+    Used without arguments, the hook recieves every payload.
     """
+    if func is not None:
+        return on_event("on_recv")(func)
 
-    return on_event("on_recv")(func)
+    return on_event("on_recv", ops=ops, events=events)
 
 
-def on_event(name: str, err_func=None):
+def on_event(name: str, err_func=None, needs: typing.Iterable[str] = MESSAGE_NEEDS,
+             after: typing.Iterable[str] = (), timeout: float = None,
+             ops: typing.Iterable[int] = None, events: typing.Iterable[str] = None, essential: bool = False):
     """
     Registers a hook to be run on a any event you specify.
 
     You can optionally provide an err function.
     In the event of an error, this function is called with the error object.
+
+    For message hooks, `needs` declares what should be resolved on the context before the hook runs.
+    `locale` loads the server locale, and `blacklist` skips the hook for blacklisted users.
+    Hooks that don't need either should pass an empty tuple, and use `ctx.resolve()` themselves if required.
+
+    Message hooks run concurrently. `after` is a list of hook names that must finish before this one starts, and
+    `timeout` is how long the hook may run for before it is cancelled.
+    If timeout is None, the `hooks.timeout` config value is used. A timeout of 0 means no limit.
+
+    `ops` and `events` filter raw `on_recv` payloads, see `on_generic_event`.
+
+    Essential `on_message` hooks keep running when the bot is overloaded; other hooks are skipped.
     """
+    needs = frozenset(needs)
+    if not needs <= MESSAGE_NEEDS:
+        raise ValueError("Unknown hook needs: {}".format(", ".join(needs - MESSAGE_NEEDS)))
 
     def _inner(func: typing.Callable[[EventContext], None]):
         try:
@@ -95,10 +119,16 @@ def on_event(name: str, err_func=None):
                     raise e
 
         __event_wrapper.__name__ = func.__name__
+        __event_wrapper.needs = needs
+        __event_wrapper.after = tuple(after)
+        __event_wrapper.timeout = timeout
+        __event_wrapper.ops = frozenset(ops) if ops is not None else None
+        __event_wrapper.events = frozenset(events) if events is not None else None
+        __event_wrapper.essential = essential
 
         # Use func.__name__ as the key.
         # This prevents multiple messages on a reload.
-        instance.hooks[name][func.__name__] = __event_wrapper
+        instance.add_hook(name, func.__name__, __event_wrapper)
         logger.info("Registered hook for `{}` -> `{}`".format(name, func.__name__))
 
         return func
@@ -0,0 +1,109 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Event loop lag monitoring and load shedding.
+# When the loop falls behind, non-essential work is shed in levels, so the important things stay responsive.
+import asyncio
+import logging
+
+from navalbot.api import metrics
+
+logger = logging.getLogger("NavalBot")
+
+# Shedding levels.
+# Each level also sheds everything the levels below it shed.
+SHED_NONE = 0
+# Raw `on_recv` hooks are skipped.
+SHED_RAW = 1
+# Non-essential `on_message` hooks are skipped; commands still run.
+SHED_HOOKS = 2
+# Low priority commands are refused.
+SHED_COMMANDS = 3
+
+LEVEL_NAMES = {
+    SHED_NONE: "normal",
+    SHED_RAW: "shedding raw event hooks",
+    SHED_HOOKS: "shedding message hooks",
+    SHED_COMMANDS: "shedding low priority commands"
+}
+
+
+class LagMonitor:
+    """
+    Samples how late the event loop runs a sleep, and sets the shedding level from that.
+
+    The lag is smoothed with an exponential moving average, so one slow callback doesn't flip the level.
+    A level is only left once the lag drops below `recover_ratio` of the threshold that raised it.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None, interval: float = 0.5,
+                 thresholds=(0.1, 0.25, 0.5), recover_ratio: float = 0.5, smoothing: float = 0.3):
+        self.loop = loop or asyncio.get_event_loop()
+        self.interval = interval
+        self.thresholds = tuple(sorted(thresholds))[:SHED_COMMANDS]
+        self.recover_ratio = recover_ratio
+        self.smoothing = smoothing
+
+        self.lag = 0.0
+        self.max_lag = 0.0
+        self.level = SHED_NONE
+        self.transitions = 0
+
+    def update(self, sample: float):
+        """
+        Adds a lag sample, and moves the shedding level if needed.
+        """
+        self.lag += self.smoothing * (sample - self.lag)
+        if sample > self.max_lag:
+            self.max_lag = sample
+
+        level = self.level
+        # Go up as far as the lag says.
+        while level < len(self.thresholds) and self.lag >= self.thresholds[level]:
+            level += 1
+        # Come down one step at a time, once well under the threshold.
+        while level > SHED_NONE and self.lag < self.thresholds[level - 1] * self.recover_ratio:
+            level -= 1
+
+        if level != self.level:
+            log = logger.warning if level > self.level else logger.info
+            log("Event loop lag is {:.0f}ms, moving from level {} ({}) to level {} ({})."
+                .format(self.lag * 1000, self.level, LEVEL_NAMES[self.level], level, LEVEL_NAMES[level]))
+            self.level = level
+            self.transitions += 1
+            metrics.incr("shed.transitions")
+
+    def sheds(self, level: int) -> bool:
+        """
+        Checks if work at the specified level is currently being shed.
+        """
+        return self.level >= level
+
+    async def run(self):
+        """
+        Samples the loop lag forever.
+        """
+        while True:
+            start = self.loop.time()
+            await asyncio.sleep(self.interval)
+            self.update(max(0.0, self.loop.time() - start - self.interval))
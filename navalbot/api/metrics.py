@@ -0,0 +1,141 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# In-process metrics.
+# These are aggregated in memory, and can be read with ?hookstats or exported as JSON.
+import asyncio
+import collections
+import json
+import math
+import time
+
+from navalbot.api import cache
+
+
+def _nearest_rank(ordered: list, pct: float) -> float:
+    if not ordered:
+        return 0.0
+    return ordered[max(0, int(math.ceil(pct / 100 * len(ordered))) - 1)]
+
+
+class Histogram:
+    """
+    Keeps a sliding window of recent samples, plus running totals.
+
+    Percentiles are calculated from the window, so they reflect recent behaviour rather than all-time.
+    """
+
+    def __init__(self, window: int = 1024):
+        self._samples = collections.deque(maxlen=window)
+
+        self.count = 0
+        self.errors = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, value: float, error: bool = False):
+        self._samples.append(value)
+        self.count += 1
+        self.total += value
+        if value > self.max:
+            self.max = value
+        if error:
+            self.errors += 1
+
+    def percentile(self, pct: float) -> float:
+        """
+        Gets a percentile (0-100) from the current window, using nearest-rank.
+        """
+        return _nearest_rank(sorted(self._samples), pct)
+
+    def to_dict(self) -> dict:
+        ordered = sorted(self._samples)
+        return {
+            "count": self.count, "errors": self.errors, "total": self.total, "max": self.max,
+            "p50": _nearest_rank(ordered, 50), "p95": _nearest_rank(ordered, 95), "p99": _nearest_rank(ordered, 99)
+        }
+
+
+class _Timed:
+    """
+    Context manager that records how long its body took into a histogram.
+
+    Exceptions (other than cancellation) are counted as errors.
+    """
+
+    def __init__(self, histogram: Histogram):
+        self._histogram = histogram
+        self._start = None
+
+    def __enter__(self):
+        self._start = time.monotonic()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        error = exc_type is not None and not issubclass(exc_type, asyncio.CancelledError)
+        self._histogram.record(time.monotonic() - self._start, error=error)
+        return False
+
+
+# Hook timings, keyed by (event, hook name).
+hook_timings = collections.defaultdict(Histogram)
+
+# Simple event counters.
+counters = collections.Counter()
+
+
+def incr(name: str, amount: int = 1):
+    counters[name] += amount
+
+
+def time_hook(event: str, name: str) -> _Timed:
+    """
+    Times a hook invocation.
+
+    Usage: `with metrics.time_hook("on_message", hook.__name__): await hook(ctx)`
+    """
+    return _Timed(hook_timings[(event, name)])
+
+
+def get_hook_stats() -> dict:
+    """
+    Gets the aggregated hook stats, as a dict of `event -> hook name -> stats`.
+    """
+    stats = collections.defaultdict(dict)
+    for (event, name), histogram in list(hook_timings.items()):
+        stats[event][name] = histogram.to_dict()
+    return dict(stats)
+
+
+def export_json() -> str:
+    """
+    Exports the hook and cache stats as JSON.
+    """
+    return json.dumps({"generated": time.time(), "hooks": get_hook_stats(), "counters": dict(counters),
+                       "caches": cache.get_stats()},
+                      indent=2, sort_keys=True)
+
+
+def reset():
+    hook_timings.clear()
+    counters.clear()
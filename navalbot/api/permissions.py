@@ -0,0 +1,302 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Per-server permission snapshots.
+# Everything a command's permission checks need (role names, disabled commands and role overrides) is loaded once per
+# server and compiled, so checking permissions on the hot path doesn't touch redis.
+import asyncio
+import time
+
+import aioredis
+import discord
+
+from navalbot.api import db
+from navalbot.api import util
+
+OVERRIDE_KEY = "override:{}:{}"
+# The command functions with role overrides on a server, so loads only fetch the override sets that exist.
+OVERRIDE_INDEX_KEY = "overrides:{}"
+
+ROLE_FIELDS = ("role:admin", "role:bot_commander", "role:voice")
+
+
+async def add_override(server_id: str, name: str, role: str):
+    """
+    Adds a role override to a command function.
+    """
+    pool = await util.get_pool()
+    async with pool.get() as conn:
+        assert isinstance(conn, aioredis.Redis)
+        pipe = conn.pipeline()
+        pipe.sadd(OVERRIDE_KEY.format(server_id, name), role)
+        pipe.sadd(OVERRIDE_INDEX_KEY.format(server_id), name)
+        await pipe.execute()
+    permission_cache.invalidate(server_id)
+
+
+async def remove_override(server_id: str, name: str, role: str):
+    """
+    Removes a role override from a command function.
+    """
+    pool = await util.get_pool()
+    async with pool.get() as conn:
+        assert isinstance(conn, aioredis.Redis)
+        await conn.srem(OVERRIDE_KEY.format(server_id, name), role)
+        if not await conn.scard(OVERRIDE_KEY.format(server_id, name)):
+            await conn.srem(OVERRIDE_INDEX_KEY.format(server_id), name)
+    permission_cache.invalidate(server_id)
+
+
+class PermissionSnapshot:
+    """
+    The compiled permissions for a server.
+    """
+
+    def __init__(self, server_id: str, config: dict, overrides: dict):
+        self.server_id = server_id
+
+        # Role names, by role proxy name (i.e `admin`).
+        self.role_names = {}
+        # Command functions disabled for everybody, and (command function, user ID) pairs disabled for one user.
+        self.disabled = set()
+        self.user_disabled = set()
+        for key, value in config.items():
+            if key.startswith("role:"):
+                self.role_names[key[len("role:"):]] = value.decode()
+            elif key.startswith("disabled:") and value.decode().lower() == "true":
+                parts = key.split(":")
+                if len(parts) == 2:
+                    self.disabled.add(parts[1])
+                elif len(parts) == 3:
+                    self.user_disabled.add((parts[1], parts[2]))
+
+        # Extra roles allowed to run each command function.
+        self.overrides = overrides
+
+        # Command function -> (required role names, allowed role names), filled in as commands are used.
+        self._compiled = {}
+
+    def is_disabled(self, name: str, user_id: str = None) -> bool:
+        """
+        Checks if a command function is disabled, for everybody or just for this user.
+        """
+        return name in self.disabled or (user_id is not None and (name, user_id) in self.user_disabled)
+
+    def role_name(self, role) -> str:
+        """
+        Gets the name of a `NavalRole` on this server.
+        """
+        return self.role_names.get(role.name.lower(), role.val)
+
+    def roles_for(self, name: str, roles) -> tuple:
+        """
+        Gets the role names needed for a command function, as (required, allowed).
+
+        `required` are the command's own roles; `allowed` also includes the server's overrides.
+        """
+        try:
+            return self._compiled[name]
+        except KeyError:
+            required = frozenset(self.role_name(role) for role in roles)
+            compiled = self._compiled[name] = (required, required | self.overrides.get(name, frozenset()))
+            return compiled
+
+    @staticmethod
+    def has_any_role(member: discord.Member, allowed: frozenset) -> bool:
+        return any(role.name in allowed for role in member.roles)
+
+    def __repr__(self):
+        return "<PermissionSnapshot for server {} ({} overrides, {} disabled)>".format(
+            self.server_id, len(self.overrides), len(self.disabled) + len(self.user_disabled))
+
+
+class PermissionCache:
+    """
+    Holds a `PermissionSnapshot` for each server.
+
+    Snapshots are dropped when anything they were built from changes, and otherwise kept for `ttl` seconds.
+    Concurrent loads for the same server share one load.
+    """
+
+    def __init__(self, ttl: float = 300):
+        self.ttl = ttl
+
+        self._snapshots = {}
+        self._loading = {}
+        # Bumped on every invalidation, so a load that raced with one isn't stored.
+        self._generations = {}
+        self._epoch = 0
+
+        self.loads = 0
+
+    def _generation(self, server_id: str) -> tuple:
+        return self._epoch, self._generations.get(server_id, 0)
+
+    async def _load_many(self, server_ids: list) -> list:
+        """
+        Loads the permissions for some servers.
+
+        The role names are HMGET from the config hash, and the disabled commands are found with an HSCAN of the
+        `disabled:*` fields, so factoids and other settings are never transferred. Override sets are only fetched for
+        the commands in the server's override index.
+        """
+        generations = [self._generation(server_id) for server_id in server_ids]
+        dual_read = db._dual_read()
+        configs = [{} for _ in server_ids]
+        names = []
+
+        pool = await util.get_pool()
+        async with pool.get() as conn:
+            assert isinstance(conn, aioredis.Redis)
+            pipe = conn.pipeline()
+            for server_id in server_ids:
+                pipe.hmget(db._hash_key(server_id), *ROLE_FIELDS)
+                pipe.hscan(db._hash_key(server_id), match="disabled:*", count=1000)
+                pipe.smembers(OVERRIDE_INDEX_KEY.format(server_id))
+            results = iter(await pipe.execute())
+            for server_id, config in zip(server_ids, configs):
+                config.update((field, value) for field, value in zip(ROLE_FIELDS, next(results)) if value is not None)
+                cursor, fields = next(results)
+                while True:
+                    config.update((field.decode(), value) for field, value in fields)
+                    if not cursor:
+                        break
+                    cursor, fields = await conn.hscan(db._hash_key(server_id), cursor, match="disabled:*", count=1000)
+                names.append({name.decode() for name in next(results)})
+
+            if dual_read:
+                await self._load_legacy(conn, server_ids, configs, names)
+
+            pipe = conn.pipeline()
+            for server_id, server_names in zip(server_ids, names):
+                for name in sorted(server_names):
+                    pipe.smembers(OVERRIDE_KEY.format(server_id, name))
+            results = iter(await pipe.execute())
+
+        snapshots = []
+        for server_id, generation, config, server_names in zip(server_ids, generations, configs, names):
+            overrides = {}
+            for name in sorted(server_names):
+                roles = next(results)
+                if roles:
+                    overrides[name] = frozenset(role.decode() for role in roles)
+
+            snapshot = PermissionSnapshot(server_id, config, overrides)
+            self.loads += 1
+            if self._generation(server_id) == generation:
+                self._snapshots[server_id] = (time.monotonic() + self.ttl, snapshot)
+            snapshots.append(snapshot)
+        return snapshots
+
+    async def _load_legacy(self, conn: aioredis.Redis, server_ids: list, configs: list, names: list):
+        """
+        Adds the permissions still stored in the old layout, while dual reads are on.
+
+        The old disabled keys (`config:{sid}:disabled:*`) and unindexed override sets (`override:{sid}:*`) are found
+        with one SCAN per server. Overrides found this way are added to the index, so it fills itself in.
+        Once `tools/migrate_config_hashes.py` has been run and dual reads are off, this is skipped.
+        """
+        legacy = []
+        found = []
+        for server_id, server_names in zip(server_ids, names):
+            config_prefix = db._build_key(server_id, "")
+            override_prefix = OVERRIDE_KEY.format(server_id, "")
+            keys = list(ROLE_FIELDS)
+            async for key in conn.iscan(match="*:{}:*".format(server_id), count=1000):
+                key = key.decode()
+                if key.startswith(config_prefix + "disabled:"):
+                    keys.append(key[len(config_prefix):])
+                elif key.startswith(override_prefix) and key[len(override_prefix):] not in server_names:
+                    server_names.add(key[len(override_prefix):])
+                    found.append((server_id, key[len(override_prefix):]))
+            legacy.append(keys)
+
+        pipe = conn.pipeline()
+        for server_id, keys in zip(server_ids, legacy):
+            pipe.mget(*[db._build_key(server_id, key) for key in keys])
+        for server_id, name in found:
+            pipe.sadd(OVERRIDE_INDEX_KEY.format(server_id), name)
+        results = await pipe.execute()
+
+        for config, keys, values in zip(configs, legacy, results):
+            # Values in the hash win over the old copies.
+            for key, value in zip(keys, values):
+                if value is not None:
+                    config.setdefault(key, value)
+
+    async def _load(self, server_id: str) -> PermissionSnapshot:
+        return (await self._load_many([server_id]))[0]
+
+    async def warm(self, server_ids: list):
+        """
+        Loads the snapshots for some servers that don't have one yet, in one round trip.
+        """
+        server_ids = [server_id for server_id in server_ids
+                      if server_id not in self._snapshots and server_id not in self._loading]
+        if server_ids:
+            await self._load_many(server_ids)
+
+    async def get(self, server_id: str) -> PermissionSnapshot:
+        """
+        Gets the permission snapshot for a server, loading it if needed.
+        """
+        try:
+            expires, snapshot = self._snapshots[server_id]
+        except KeyError:
+            pass
+        else:
+            if expires > time.monotonic():
+                return snapshot
+
+        task = self._loading.get(server_id)
+        if task is None:
+            task = self._loading[server_id] = asyncio.ensure_future(self._load(server_id))
+            task.add_done_callback(lambda _: self._loading.pop(server_id, None))
+        # Shielded, so one cancelled caller doesn't cancel the load for everyone else.
+        return await asyncio.shield(task)
+
+    def invalidate(self, server_id: str = None, key: str = None):
+        """
+        Drops a server's snapshot, or every snapshot if no server is given.
+
+        If a config key is given, the snapshot is only dropped if it depends on that key.
+        """
+        if key is not None and not key.startswith(("role:", "disabled:", "override:")):
+            return
+        if server_id is None:
+            self._snapshots.clear()
+            self._generations.clear()
+            self._epoch += 1
+            return
+        self._snapshots.pop(server_id, None)
+        self._generations[server_id] = self._generations.get(server_id, 0) + 1
+
+    def clear(self):
+        self.invalidate()
+
+    def __len__(self):
+        return len(self._snapshots)
+
+
+permission_cache = PermissionCache()
+db.add_change_listener(permission_cache.invalidate)
@@ -0,0 +1,197 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Gateway traffic recording.
+# Raw gateway payloads are written to a gzipped, append-only file of length-prefixed frames, for replaying later.
+# See `navalbot.testing.replay` for reading them back.
+import concurrent.futures
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import os
+import re
+import struct
+import time
+
+logger = logging.getLogger("NavalBot")
+
+# Frame header: seconds since the recording started, and the length of the JSON payload.
+FRAME_HEADER = struct.Struct("<dI")
+
+# Keys holding names or free text, which are replaced when anonymising.
+_NAME_KEYS = {"username", "name", "nick", "topic", "title", "description"}
+# Keys that are dropped entirely when anonymising.
+_DROP_KEYS = {"avatar", "icon", "splash", "email", "token", "session_id", "url", "proxy_url", "game",
+              "attachments", "embeds", "_trace"}
+# Keys holding lists of IDs.
+_ID_LIST_KEYS = {"roles", "mention_roles"}
+
+_snowflake = re.compile(r"\d{15,21}")
+
+
+def write_frames(path: str, frames: list):
+    """
+    Appends frames to a recording.
+
+    Every call appends a new gzip member, which readers see as one continuous stream.
+    """
+    with gzip.open(path, "ab") as f:
+        f.write(b"".join(frames))
+
+
+def read_frames(path: str):
+    """
+    Reads the frames from a recording, yielding `(offset, payload)`.
+    """
+    with gzip.open(path, "rb") as f:
+        while True:
+            header = f.read(FRAME_HEADER.size)
+            if len(header) < FRAME_HEADER.size:
+                return
+            offset, length = FRAME_HEADER.unpack(header)
+            data = f.read(length)
+            if len(data) < length:
+                # Truncated by a crash mid-write.
+                logger.warning("Recording {} ends with a truncated frame.".format(path))
+                return
+            yield offset, json.loads(data.decode())
+
+
+class Anonymiser:
+    """
+    Replaces IDs, names and message content in gateway payloads.
+
+    IDs are replaced with a keyed hash, so the same ID maps to the same fake ID throughout a recording and
+    relationships (guild -> default channel, author -> member) survive.
+    The leading command word of message content is kept, so commands still replay as commands.
+    """
+
+    def __init__(self, key: bytes = None):
+        self._key = key or os.urandom(16)
+
+    def anon_id(self, value: str) -> str:
+        digest = hmac.new(self._key, value.encode(), hashlib.sha1).digest()
+        # Keep it looking like a snowflake.
+        return str(100000000000000000 + int.from_bytes(digest[:8], "little") % 900000000000000000)
+
+    def anon_content(self, content: str) -> str:
+        content = _snowflake.sub(lambda m: self.anon_id(m.group(0)), content)
+        words = content.split(" ")
+        # Keep a leading command word, i.e `?play`.
+        keep = 1 if words and words[0][:1] and not words[0][:1].isalnum() else 0
+        return " ".join(words[:keep] + [w if w.startswith("<") else "x" * len(w) for w in words[keep:]])
+
+    def anon(self, data, key: str = None):
+        if isinstance(data, dict):
+            return {k: self.anon(v, k) for k, v in data.items() if k not in _DROP_KEYS}
+        elif isinstance(data, list):
+            if key in _ID_LIST_KEYS:
+                return [self.anon_id(str(i)) for i in data]
+            return [self.anon(i) for i in data]
+        elif isinstance(data, str):
+            if key == "id" or (key and key.endswith("_id")):
+                return self.anon_id(data) if data.isdigit() else data
+            if key == "content":
+                return self.anon_content(data)
+            if key in _NAME_KEYS:
+                return "{}-{}".format(key, self.anon_id(data)[-6:])
+        return data
+
+
+class GatewayRecorder:
+    """
+    Records raw gateway payloads.
+
+    `record` is called from dispatch for every payload, so it only encodes the frame; frames are written out in
+    batches on a background thread.
+    """
+
+    def __init__(self, loop, directory: str = "recordings", anonymise: bool = True, flush_size: int = 256 * 1024,
+                 flush_interval: float = 5.0):
+        self.loop = loop
+        self.directory = directory
+        self.anonymise = anonymise
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+
+        self.path = None
+        self.frames = 0
+        self._start = 0.0
+        self._anonymiser = None
+        self._buffer = []
+        self._buffered = 0
+        self._last_flush = 0.0
+        # One thread, so batches are written in order.
+        self._executor = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+
+    @property
+    def active(self) -> bool:
+        return self.path is not None
+
+    def start(self, path: str = None, anonymise: bool = None) -> str:
+        """
+        Starts recording to a new file, stopping any current recording.
+        """
+        if self.active:
+            self.stop()
+        if path is None:
+            os.makedirs(self.directory, exist_ok=True)
+            path = os.path.join(self.directory, "gateway-{}.rec.gz".format(time.strftime("%Y%m%d-%H%M%S")))
+        anonymise = self.anonymise if anonymise is None else anonymise
+        self._anonymiser = Anonymiser() if anonymise else None
+        self._start = self._last_flush = time.monotonic()
+        self.frames = 0
+        self.path = path
+        logger.info("Recording gateway traffic to {}{}.".format(path, " (anonymised)" if anonymise else ""))
+        return path
+
+    def stop(self) -> str:
+        """
+        Stops recording, flushing anything buffered.
+        """
+        if not self.active:
+            return None
+        self.flush()
+        path, self.path = self.path, None
+        logger.info("Stopped recording gateway traffic, {} frames written to {}.".format(self.frames, path))
+        return path
+
+    def record(self, payload: dict):
+        if self._anonymiser is not None:
+            payload = self._anonymiser.anon(payload)
+        data = json.dumps(payload, separators=(",", ":")).encode()
+        now = time.monotonic()
+        self._buffer.append(FRAME_HEADER.pack(now - self._start, len(data)) + data)
+        self._buffered += len(data)
+        self.frames += 1
+        if self._buffered >= self.flush_size or now - self._last_flush >= self.flush_interval:
+            self.flush()
+
+    def flush(self):
+        if not self._buffer:
+            return
+        frames, self._buffer, self._buffered = self._buffer, [], 0
+        self._last_flush = time.monotonic()
+        self.loop.run_in_executor(self._executor, write_frames, self.path, frames)
@@ -0,0 +1,207 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Fair scheduling of event handlers.
+# Each guild gets its own bounded queue, and a fixed pool of workers drains the queues in turn.
+# This means a flood in one guild can only fill that guild's queue, instead of starving everyone else.
+import asyncio
+import collections
+import logging
+import traceback
+
+from navalbot.api import metrics
+
+logger = logging.getLogger("NavalBot")
+
+
+class FairScheduler:
+    """
+    Runs jobs on a fixed pool of workers, draining per-guild queues round-robin.
+
+    A guild with a weight of N gets up to N jobs per turn.
+    Jobs submitted to a full queue are dropped and counted.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None, workers: int = 16, queue_size: int = 200,
+                 max_per_guild: int = 4, weights: dict = None, enabled: bool = True):
+        self.loop = loop or asyncio.get_event_loop()
+        self.enabled = enabled
+        self.worker_count = max(1, workers)
+        self.queue_size = max(1, queue_size)
+        self.max_per_guild = max(1, max_per_guild)
+        self.weights = {str(k): max(1, int(v)) for k, v in (weights or {}).items()}
+
+        # Guild ID -> deque of (func, args).
+        self._queues = {}
+        # Guilds that have queued jobs and are under their concurrency limit, in the order they will be served.
+        self._ready = collections.deque()
+        self._in_ready = set()
+        # Jobs left in the current turn of the guild at the front of `_ready`.
+        self._turn = {}
+        self._running = collections.Counter()
+        # Guilds that have dropped jobs since their queue last emptied, so overflows are only logged once.
+        self._overflowing = set()
+
+        self._wakeup = asyncio.Event()
+        self._workers = []
+
+        self.processed = 0
+        self.dropped = collections.Counter()
+
+        # Called as `on_done(func, args, error)` after each job, if set. Used by replays to time jobs.
+        self.on_done = None
+
+    def start(self):
+        """
+        Starts the worker pool.
+        """
+        if self._workers:
+            return
+        self._workers = [self.loop.create_task(self._worker()) for _ in range(self.worker_count)]
+
+    def stop(self):
+        """
+        Cancels the worker pool. Queued jobs are kept, and will run if the pool is started again.
+        """
+        for worker in self._workers:
+            worker.cancel()
+        self._workers = []
+
+    def submit(self, guild_id: str, func, *args) -> bool:
+        """
+        Queues `func(*args)` to be ran for a guild.
+
+        `func` must be a coroutine function; the coroutine isn't created until a worker picks the job up, so dropped
+        jobs cost nothing.
+        Returns False if the job was dropped.
+        """
+        if not self.enabled:
+            self.loop.create_task(self._run_job(func, args))
+            return True
+
+        if not self._workers:
+            self.start()
+
+        queue = self._queues.get(guild_id)
+        if queue is None:
+            queue = self._queues[guild_id] = collections.deque()
+
+        if len(queue) >= self.queue_size:
+            self.dropped[guild_id] += 1
+            metrics.incr("scheduler.dropped")
+            if guild_id not in self._overflowing:
+                self._overflowing.add(guild_id)
+                logger.warning("Event queue for guild {} is full ({} jobs), dropping new events."
+                               .format(guild_id, len(queue)))
+            return False
+
+        queue.append((func, args))
+        self._mark_ready(guild_id)
+        return True
+
+    def _mark_ready(self, guild_id: str):
+        if guild_id in self._in_ready or self._running[guild_id] >= self.max_per_guild:
+            return
+        if not self._queues.get(guild_id):
+            return
+        self._ready.append(guild_id)
+        self._in_ready.add(guild_id)
+        self._wakeup.set()
+
+    def _take(self):
+        """
+        Takes the next job, moving the guild on if its turn is over.
+        """
+        if not self._ready:
+            return None
+
+        guild_id = self._ready[0]
+        queue = self._queues[guild_id]
+        job = queue.popleft()
+        self._running[guild_id] += 1
+
+        turn = self._turn.get(guild_id, self.weights.get(guild_id, 1)) - 1
+        if not queue or self._running[guild_id] >= self.max_per_guild:
+            # Nothing left, or at the limit; it's re-added once a job finishes or a new one arrives.
+            self._ready.popleft()
+            self._in_ready.discard(guild_id)
+            self._turn.pop(guild_id, None)
+            if not queue:
+                del self._queues[guild_id]
+                self._overflowing.discard(guild_id)
+        elif turn <= 0:
+            self._ready.rotate(-1)
+            self._turn.pop(guild_id, None)
+        else:
+            self._turn[guild_id] = turn
+
+        return guild_id, job
+
+    async def _run_job(self, func, args: tuple):
+        error = False
+        try:
+            await func(*args)
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            error = True
+            logger.error("Caught exception in scheduled job {}".format(getattr(func, "__name__", func)))
+            traceback.print_exc()
+        finally:
+            if self.on_done is not None:
+                self.on_done(func, args, error)
+
+    async def _worker(self):
+        while True:
+            picked = self._take()
+            if picked is None:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            guild_id, (func, args) = picked
+            try:
+                await self._run_job(func, args)
+            finally:
+                self.processed += 1
+                self._running[guild_id] -= 1
+                if self._running[guild_id] <= 0:
+                    del self._running[guild_id]
+                self._mark_ready(guild_id)
+
+    def depths(self) -> dict:
+        """
+        Gets the number of queued jobs per guild.
+        """
+        return {guild_id: len(queue) for guild_id, queue in self._queues.items()}
+
+    def stats(self) -> dict:
+        depths = self.depths()
+        return {
+            "workers": len(self._workers),
+            "queued": sum(depths.values()),
+            "running": sum(self._running.values()),
+            "processed": self.processed,
+            "dropped": sum(self.dropped.values()),
+            "guilds": len(depths)
+        }
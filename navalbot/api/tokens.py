@@ -0,0 +1,93 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Message tokenizing.
+# A message is split once, and the result kept on its context, so everything that needs its words shares one parse.
+import re
+import shlex
+
+# What `shlex.split` counts as whitespace.
+_SHELL_WORD = re.compile(r"[^ \t\r\n]+")
+
+_NOT_PARSED = object()
+
+
+class Tokens:
+    """
+    The words of a message's content, with the prefix removed.
+
+    `words` splits on single spaces, like `str.split(" ")`. `shell` splits like `shlex.split`, so quoted arguments
+    stay together. Both are worked out the first time they're used.
+    """
+
+    __slots__ = ("text", "_words", "_shell")
+
+    def __init__(self, text: str):
+        self.text = text
+
+        self._words = None
+        self._shell = _NOT_PARSED
+
+    @property
+    def words(self) -> list:
+        if self._words is None:
+            self._words = self.text.split(" ")
+        return self._words
+
+    @property
+    def command(self) -> str:
+        """
+        The command word, as typed.
+        """
+        return self.words[0]
+
+    @property
+    def shell(self) -> list:
+        """
+        The words, split like a shell would. This is None if the quotes don't balance.
+        """
+        if self._shell is _NOT_PARSED:
+            text = self.text
+            if "'" not in text and '"' not in text and "\\" not in text:
+                # Without quotes or escapes, shlex just splits on whitespace, which a regex does much faster.
+                self._shell = _SHELL_WORD.findall(text)
+            else:
+                try:
+                    self._shell = shlex.split(text)
+                except ValueError:
+                    self._shell = None
+        return self._shell
+
+    def args(self, split_words: bool = False) -> list:
+        """
+        Gets the arguments after the command word.
+
+        These are split like a shell would, unless `split_words` is set or the quotes don't balance, in which case
+        they are split on spaces.
+        """
+        if split_words or self.shell is None:
+            return self.words[1:]
+        return self.shell[1:]
+
+    def __repr__(self):
+        return "<Tokens {!r}>".format(self.text)
@@ -21,7 +21,6 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 =================================
 """
 
-import asyncio
 import datetime
 import hashlib
 import logging
@@ -30,8 +29,6 @@ import os
 import shutil
 import time
 import typing
-from collections import OrderedDict
-from concurrent import futures
 from math import floor
 import functools
 import re
@@ -40,7 +37,10 @@ import aiohttp
 import aioredis
 import discord
 
+from navalbot.api import backends
+from navalbot.api import cache
 from navalbot.api import db
+from navalbot.api import executors
 from navalbot.api import botcls
 
 startup = datetime.datetime.fromtimestamp(time.time())
@@ -48,10 +48,13 @@ startup = datetime.datetime.fromtimestamp(time.time())
 # Some useful variables
 msgcount = 0
 
-threaded = futures.ThreadPoolExecutor()
-
 # Declare redis pool
 redis_pool = None
+# The client the caches were last reset for.
+_pool_client = None
+
+# Shared two-tier cache, see get_shared_cache().
+shared_cache = None
 
 # Load config.
 if not os.path.exists("config.yml"):
@@ -60,12 +63,13 @@ if not os.path.exists("config.yml"):
 logger = logging.getLogger("NavalBot")
 
 
-async def with_threading(func):
+async def with_threading(func, pool: str = "web-scrape"):
     """
-    Runs a func inside a Threaded executor.
+    Runs a func inside one of the named executor pools.
+
+    Raises `executors.ExecutorOverloaded` if the pool's queue is full.
     """
-    loop = asyncio.get_event_loop()
-    return await loop.run_in_executor(threaded, func)
+    return await executors.run(pool, func)
 
 
 def format_timedelta(value, time_format="{days} days, {hours2}:{minutes2}:{seconds2}"):
@@ -111,16 +115,18 @@ def format_timedelta(value, time_format="{days} days, {hours2}:{minutes2}:{secon
 
 async def get_pool() -> aioredis.RedisPool:
     """
-    Gets the redis connection pool.
+    Gets the redis connection pool, from the configured storage backend.
     """
-    global redis_pool
-    global_config = botcls.NavalClient.get_navalbot().config
-    if botcls.NavalClient.get_navalbot().testing or not redis_pool:
-        redis_pool = await aioredis.create_pool(
-            (global_config["redis"]["ip"], global_config["redis"]["port"]),
-            db=int(global_config["redis"].get("db", 0)),
-            password=global_config["redis"].get("password")
-        )
+    global redis_pool, _pool_client
+    client = botcls.NavalClient.get_navalbot()
+    # The test client gets a new pool per call, as each test has its own event loop.
+    if client.testing or not redis_pool:
+        redis_pool = await backends.get_backend(client.config["redis"]).create_pool()
+        if _pool_client is not client:
+            # Anything cached may have come from a different client's store, so drop it.
+            # This only happens once per client, so the caches still work under the test client.
+            _pool_client = client
+            db.reset_caches()
     return redis_pool
 
 
@@ -167,22 +173,28 @@ def get_global_config(key, default=0, type_: type = None):
         return global_config.get(key, default)
 
 
+def get_http_client():
+    """
+    Gets the shared HTTP client.
+    """
+    return botcls.NavalClient.get_navalbot().web
+
+
 async def get_file(client: tuple, url, name):
     """
     Get a file from the web using aiohttp, and save it
     """
-    with aiohttp.ClientSession() as sess:
-        async with sess.get(url) as get:
-            assert isinstance(get, aiohttp.ClientResponse)
-            if int(get.headers["content-length"]) > 1024 * 1024 * 8:
-                # 1gib
-                await client[0].send_message(client[1].channel, "File {} is too big to DL".format(name))
-                return
-            else:
-                data = await get.read()
-                with open(os.path.join(os.getcwd(), 'files', name), 'wb') as f:
-                    f.write(data)
-                print("--> Saved file to {}".format(name))
+    async with get_http_client().get(url) as get:
+        assert isinstance(get, aiohttp.ClientResponse)
+        if int(get.headers["content-length"]) > 1024 * 1024 * 8:
+            # 1gib
+            await client[0].send_message(client[1].channel, "File {} is too big to DL".format(name))
+            return
+        else:
+            data = await get.read()
+            with open(os.path.join(os.getcwd(), 'files', name), 'wb') as f:
+                f.write(data)
+            print("--> Saved file to {}".format(name))
 
 
 async def get_image(url: str) -> typing.Union[str, None]:
@@ -191,37 +203,37 @@ async def get_image(url: str) -> typing.Union[str, None]:
 
     Then, return the file name with the appropriate extension.
     """
-    with aiohttp.ClientSession() as sess:
-        async with sess.head(url) as hh:
-            assert isinstance(hh, aiohttp.ClientResponse)
-            if "image" not in hh.headers.get("Content-Type", ""):
-                # Not an image, return.
-                return
-
-        # Get the image.
-        async with sess.get(url) as got:
-            assert isinstance(got, aiohttp.ClientResponse)
-            # Don't download big files.
-            if int(got.headers["content-length"]) > 1024 * 1024 * 8:
-                return None
-            # Generate the file name using the hash of the URL.
-            name = hashlib.sha224(url.encode()).hexdigest()
-            # Guess the extension.
-            ext = mimetypes.guess_extension(got.headers.get("Content-Type", ""))
-            if ext == ".jpe":
-                # .jpe is bad
-                ext = ".jpg"
-            if not ext:
-                # AAAA what
-                # Skip the file.
-                return
-            # Create the final file name.
-            final = name + ext
-            # Download the file.
-            with open(os.path.join(os.getcwd(), 'files', final), 'wb') as f:
-                f.write(await got.read())
-            # Return the name.
-            return final
+    sess = get_http_client()
+    async with sess.head(url) as hh:
+        assert isinstance(hh, aiohttp.ClientResponse)
+        if "image" not in hh.headers.get("Content-Type", ""):
+            # Not an image, return.
+            return
+
+    # Get the image.
+    async with sess.get(url) as got:
+        assert isinstance(got, aiohttp.ClientResponse)
+        # Don't download big files.
+        if int(got.headers["content-length"]) > 1024 * 1024 * 8:
+            return None
+        # Generate the file name using the hash of the URL.
+        name = hashlib.sha224(url.encode()).hexdigest()
+        # Guess the extension.
+        ext = mimetypes.guess_extension(got.headers.get("Content-Type", ""))
+        if ext == ".jpe":
+            # .jpe is bad
+            ext = ".jpg"
+        if not ext:
+            # AAAA what
+            # Skip the file.
+            return
+        # Create the final file name.
+        final = name + ext
+        # Download the file.
+        with open(os.path.join(os.getcwd(), 'files', final), 'wb') as f:
+            f.write(await got.read())
+        # Return the name.
+        return final
 
 
 def sanitize(param):
@@ -230,23 +242,27 @@ def sanitize(param):
     return ret
 
 
-async def with_cache(data, expires=300, miss=lambda data: None):
+def get_shared_cache() -> cache.TieredCache:
     """
-    Caches the result of a function.
+    Gets the shared two-tier cache, creating it from the `shared_cache` config section.
     """
-    pool = await get_pool()
-    async with pool.get() as conn:
-        # Get the cached key.
-        content = await conn.get("cached:{}".format(data))
-        if content:
-            logger.info("Cache hit for {}.".format(data))
-            return content.decode()
-        logger.info("Cache miss for {}.".format(data))
-        # Call miss(data), and set the data in the cache.
-        result = await miss(data)
-        await conn.set("cached:{}".format(data), result)
-        await conn.expire("cached:{}".format(data), expires)
-        return result
+    global shared_cache
+    if shared_cache is None:
+        cfg = get_global_config("shared_cache", default={})
+        shared_cache = cache.TieredCache(local_size=cfg.get("local_size", 1024), local_ttl=cfg.get("local_ttl", 10),
+                                         serializer=cfg.get("serializer", "json"), beta=cfg.get("beta", 1.0),
+                                         lock_timeout=cfg.get("lock_timeout", 10))
+    return shared_cache
+
+
+async def with_cache(data, expires=300, miss=lambda data: None, namespace: str = None):
+    """
+    Caches the result of `miss(data)` in the shared cache, for `expires` seconds.
+
+    The result can be anything the configured serializer can handle.
+    """
+    key = "{}:{}".format(namespace, data) if namespace else str(data)
+    return await get_shared_cache().get(key, functools.partial(miss, data), expires=expires)
 
 
 def has_perm(perms: discord.Permissions, attr: str) -> bool:
@@ -266,20 +282,9 @@ def get_regex(reg: str):
 
 
 def async_lru(size=100):
-    cache = OrderedDict()
-
-    def decorator(fn):
-        @functools.wraps(fn)
-        async def memoizer(*args, **kwargs):
-            key = str((args, kwargs))
-            try:
-                cache[key] = cache.pop(key)
-            except KeyError:
-                if len(cache) >= size:
-                    cache.popitem(last=False)
-                cache[key] = await fn(*args, **kwargs)
-            return cache[key]
-
-        return memoizer
-
-    return decorator
\ No newline at end of file
+    """
+    Caches the results of a coroutine function, without expiry.
+
+    Kept for compatibility; use `navalbot.api.cache.async_cache` for new code.
+    """
+    return cache.async_cache(maxsize=size, ttl=None)
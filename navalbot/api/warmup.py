@@ -0,0 +1,129 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Cache warm-up.
+# After a restart every cache is cold, so the first message in each server would pay for its config and blacklist
+# loads. This loads them, and each server's permission snapshot, in the background instead, in pipelined batches.
+import asyncio
+import collections
+import logging
+import time
+
+from navalbot.api import db
+from navalbot.api import lagmonitor
+from navalbot.api import metrics
+from navalbot.api.blacklists import blacklists
+from navalbot.api.commands.cmdclass import NavalRole
+from navalbot.api.permissions import permission_cache
+
+logger = logging.getLogger("NavalBot")
+
+# Config keys loaded for every server: the snapshot keys, the locale, and the role name overrides.
+WARM_KEYS = db.SNAPSHOT_KEYS + ("locale",) + tuple(
+    "role:{}".format(role.name.lower()) for role in (NavalRole.ADMIN, NavalRole.BOT_COMMANDER, NavalRole.VOICE))
+
+
+class CacheWarmer:
+    """
+    Loads server caches in the background.
+
+    Servers are queued with `queue`, and loaded `batch_size` at a time by at most `concurrency` batches at once.
+    While the lag monitor is shedding message hooks, loading pauses, so it never competes with live traffic.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None, batch_size: int = 50, concurrency: int = 2,
+                 lag: lagmonitor.LagMonitor = None, enabled: bool = True):
+        self.loop = loop or asyncio.get_event_loop()
+        self.batch_size = max(1, batch_size)
+        self.concurrency = max(1, concurrency)
+        self.lag = lag
+        self.enabled = enabled
+
+        # Used as an ordered set.
+        self._queue = collections.OrderedDict()
+        self._task = None
+
+        self.warmed = 0
+
+    def queue(self, server_ids):
+        """
+        Queues servers to be warmed, starting the warm-up if it isn't running.
+        """
+        if not self.enabled:
+            return
+        for server_id in server_ids:
+            self._queue[server_id] = None
+        if self._queue and (self._task is None or self._task.done()):
+            self._task = self.loop.create_task(self._run())
+
+    def _take_batch(self) -> list:
+        batch = []
+        while self._queue and len(batch) < self.batch_size:
+            batch.append(self._queue.popitem(last=False)[0])
+        return batch
+
+    async def _warm_batch(self, batch: list):
+        with metrics.time_hook("warmup", "batch"):
+            await asyncio.gather(db.warm_configs(batch, WARM_KEYS), blacklists.warm(batch),
+                                 permission_cache.warm(batch))
+
+    async def _worker(self, progress: dict):
+        while self._queue:
+            # Back off while the bot is struggling to keep up.
+            while self.lag is not None and self.lag.sheds(lagmonitor.SHED_HOOKS):
+                await asyncio.sleep(1)
+            batch = self._take_batch()
+            if not batch:
+                break
+            try:
+                await self._warm_batch(batch)
+            except Exception:
+                logger.exception("Failed to warm caches for {} servers.".format(len(batch)))
+                continue
+            self.warmed += len(batch)
+            progress["done"] += len(batch)
+            if time.monotonic() - progress["logged"] >= 5:
+                progress["logged"] = time.monotonic()
+                logger.info("Warming caches: {done}/{total} servers.".format(
+                    done=progress["done"], total=progress["done"] + len(self._queue)))
+
+    async def _run(self):
+        start = time.monotonic()
+        capacity = db.config_cache.size // len(WARM_KEYS)
+        if len(self._queue) > capacity:
+            logger.warning("The config cache can only hold {} servers' worth of keys, so not all of the {} servers "
+                           "will stay warm. Raise `config_cache.size` to fix this.".format(capacity, len(self._queue)))
+
+        progress = {"done": 0, "logged": start}
+        try:
+            await blacklists.load_global()
+        except Exception:
+            logger.exception("Failed to load the global blacklist.")
+        await asyncio.gather(*[self._worker(progress) for _ in range(self.concurrency)])
+        logger.info("Warmed caches for {} servers in {:.2f}s.".format(progress["done"], time.monotonic() - start))
+
+    def stop(self):
+        self._queue.clear()
+        if self._task is not None:
+            self._task.cancel()
+            self._task = None
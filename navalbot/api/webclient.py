@@ -0,0 +1,207 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# Shared HTTP client.
+# All outbound HTTP goes through one pooled session, so connections and DNS lookups are reused between requests.
+import asyncio
+import email.utils
+import logging
+import time
+import urllib.parse
+
+import aiohttp
+
+from navalbot.api import metrics
+
+logger = logging.getLogger("NavalBot")
+
+# Statuses that are worth retrying, for idempotent requests.
+RETRY_STATUSES = {429, 502, 503, 504}
+RETRY_METHODS = {"GET", "HEAD", "OPTIONS"}
+# A Retry-After longer than this isn't waited for, and the response is returned instead.
+MAX_RETRY_AFTER = 60
+
+
+def _retry_after(response: aiohttp.ClientResponse) -> float:
+    """
+    Gets a response's Retry-After, in seconds. It can be given in seconds or as an HTTP date.
+    Returns None if there isn't a valid one.
+    """
+    value = response.headers.get("Retry-After")
+    if value is None:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    parsed = email.utils.parsedate_tz(value)
+    if parsed is None:
+        return None
+    return max(0.0, email.utils.mktime_tz(parsed) - time.time())
+
+
+class _RequestContext:
+    """
+    Returned by `HTTPClient.request`, for use as `async with client.get(url) as response:`.
+
+    The host's connection slot is held until the block exits.
+    """
+
+    def __init__(self, client: 'HTTPClient', method: str, url: str, kwargs: dict):
+        self._client = client
+        self._method = method
+        self._url = url
+        self._kwargs = kwargs
+        self._response = None
+        self._host = urllib.parse.urlsplit(url).hostname
+
+    async def __aenter__(self) -> aiohttp.ClientResponse:
+        semaphore = self._client._host_semaphore(self._host)
+        try:
+            await semaphore.acquire()
+        except BaseException:
+            self._client._release_host(self._host, acquired=False)
+            raise
+        try:
+            self._response = await self._client._request(self._method, self._url, **self._kwargs)
+        except BaseException:
+            self._client._release_host(self._host)
+            raise
+        return self._response
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        try:
+            await self._response.__aexit__(exc_type, exc_val, exc_tb)
+        finally:
+            self._client._release_host(self._host)
+
+
+class HTTPClient:
+    """
+    A managed aiohttp session.
+
+    Connections are kept alive and limited both overall and per host, and DNS lookups are cached by the connector.
+    Requests time out after `timeout` seconds (waiting for the response headers), and idempotent requests that fail to
+    connect, time out or get a 429, 502, 503 or 504 are retried up to `retries` times with exponential backoff.
+    If the response has a Retry-After, the retry waits at least that long.
+    Request latency is recorded per host in `metrics`, under the `http` event.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None, limit: int = 100, limit_per_host: int = 8,
+                 keepalive_timeout: float = 30, dns_cache: bool = True, timeout: float = 15, retries: int = 2,
+                 backoff: float = 0.5, user_agent: str = "NavalBot"):
+        self.loop = loop or asyncio.get_event_loop()
+        self.limit = limit
+        self.limit_per_host = max(1, limit_per_host)
+        self.keepalive_timeout = keepalive_timeout
+        self.dns_cache = dns_cache
+        self.timeout = timeout
+        self.retries = max(0, retries)
+        self.backoff = backoff
+        self.user_agent = user_agent
+
+        self._session = None
+        # Hostname -> [semaphore, requests holding or waiting for it].
+        # Hosts come from user supplied URLs, so entries are dropped once nothing is using them.
+        self._hosts = {}
+
+    @property
+    def session(self) -> aiohttp.ClientSession:
+        """
+        The underlying session, created on first use.
+        """
+        if self._session is None or self._session.closed:
+            connector = aiohttp.TCPConnector(loop=self.loop, limit=self.limit, resolve=self.dns_cache,
+                                             keepalive_timeout=self.keepalive_timeout)
+            self._session = aiohttp.ClientSession(loop=self.loop, connector=connector,
+                                                  headers={"User-Agent": self.user_agent})
+        return self._session
+
+    def _host_semaphore(self, host: str) -> asyncio.Semaphore:
+        entry = self._hosts.get(host)
+        if entry is None:
+            entry = self._hosts[host] = [asyncio.Semaphore(self.limit_per_host), 0]
+        entry[1] += 1
+        return entry[0]
+
+    def _release_host(self, host: str, acquired: bool = True):
+        entry = self._hosts[host]
+        if acquired:
+            entry[0].release()
+        entry[1] -= 1
+        if not entry[1]:
+            del self._hosts[host]
+
+    async def _request(self, method: str, url: str, **kwargs) -> aiohttp.ClientResponse:
+        host = urllib.parse.urlsplit(url).hostname
+        timings = metrics.hook_timings[("http", host)]
+        retries = self.retries if method.upper() in RETRY_METHODS else 0
+
+        retry_after = None
+        for attempt in range(retries + 1):
+            if attempt:
+                metrics.incr("http.retries")
+                await asyncio.sleep(max(self.backoff * 2 ** (attempt - 1), retry_after or 0))
+                retry_after = None
+            start = time.monotonic()
+            try:
+                response = await asyncio.wait_for(self.session.request(method, url, **kwargs), self.timeout)
+            except (aiohttp.ClientError, asyncio.TimeoutError, OSError) as e:
+                timings.record(time.monotonic() - start, error=True)
+                if attempt == retries:
+                    raise
+                logger.warning("{} {} failed ({!r}), retrying.".format(method, url, e))
+                continue
+
+            timings.record(time.monotonic() - start, error=response.status >= 500)
+            if response.status not in RETRY_STATUSES or attempt == retries:
+                return response
+            retry_after = _retry_after(response)
+            if retry_after is not None and retry_after > MAX_RETRY_AFTER:
+                return response
+            logger.warning("{} {} returned {}, retrying.".format(method, url, response.status))
+            response.close()
+
+    def request(self, method: str, url: str, **kwargs) -> _RequestContext:
+        """
+        Makes a request. Use as `async with client.request("GET", url) as response:`.
+        Keyword arguments are passed to `aiohttp.ClientSession.request`.
+        """
+        return _RequestContext(self, method, url, kwargs)
+
+    def get(self, url: str, **kwargs) -> _RequestContext:
+        return self.request("GET", url, **kwargs)
+
+    def head(self, url: str, **kwargs) -> _RequestContext:
+        return self.request("HEAD", url, **kwargs)
+
+    def post(self, url: str, **kwargs) -> _RequestContext:
+        return self.request("POST", url, **kwargs)
+
+    def close(self):
+        """
+        Closes the session and its pooled connections.
+        """
+        if self._session is not None:
+            self._session.close()
+            self._session = None
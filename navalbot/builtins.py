@@ -32,6 +32,7 @@ from navalbot.api import db
 from navalbot.api.commands import commands, command, Command
 from navalbot.api.contexts import CommandContext
 from navalbot.api.locale import get_locale
+from navalbot.api.tokens import Tokens
 
 from navalbot import version
 
@@ -60,16 +61,18 @@ async def help(ctx: CommandContext):
 
 
 # region factoids
-async def default(client: discord.Client, message: discord.Message):
+async def default(client: discord.Client, message: discord.Message, snapshot: db.GuildSnapshot = None,
+                  tokens: Tokens = None):
     """
     Default command.
 
     Delegates to factoids.delegate().
     """
+    if snapshot is None:
+        snapshot = await db.get_guild_snapshot(message.server.id)
     # Create a new context.
-    loc = await db.get_config(message.server.id, "lang", default=None)
-    loc = get_locale(loc)
+    loc = get_locale(snapshot.get_config("lang"))
 
-    ctx = CommandContext(client, message, loc)
+    ctx = CommandContext(client, message, loc, snapshot=snapshot, tokens=tokens)
     # Delegate factoids to handler to handle it.
     await factoids.delegate(ctx)
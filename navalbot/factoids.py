@@ -26,7 +26,6 @@ import hashlib
 import os
 import random
 import re
-import shlex
 import string
 
 import discord
@@ -46,7 +45,7 @@ async def delegate(ctx: CommandContext):
     """
     Factoid delegate handler.
     """
-    prefix = await ctx.get_config("command_prefix", "?")
+    prefix = await ctx.get_prefix()
     data = ctx.message.content[len(prefix):]
     # Match it.
     matches = factoid_matcher.match(data)
@@ -87,7 +86,7 @@ async def get_factoid(ctx: CommandContext, data: str):
     """
     Loads a factoid from the DB.
     """
-    prefix = await ctx.get_config("command_prefix", "?")
+    prefix = await ctx.get_prefix()
     # Split data apart and load that factoid, because fuck spaces.
     # Try data.split(" ")[0]
     ff = data.split(" ")[0]
@@ -117,12 +116,8 @@ async def get_factoid(ctx: CommandContext, data: str):
 
         # Load out the command.
 
-        # Load up the old arguments and content
-        old_content = ctx.message.content
-        try:
-            old_args = shlex.split(old_content[len(prefix):])[1:]
-        except ValueError:
-            old_args = old_content[len(prefix):].split(" ")[1:]
+        # Load up the old arguments
+        old_args = ctx.get_tokens(prefix).args()
 
         if not ('{' in content and '}' in content):
             # Just replace the data with the factoid data, instead of parsing out args.
@@ -0,0 +1,194 @@
+"""
+Synthetic message-flood benchmarks.
+
+Replays a mix of traffic through the full `on_message` path on a `FakeTransportClient`, and reports throughput,
+latency percentiles per kind of message and per hook, and the redis commands issued per message.
+
+Run it with `python tools/bench.py`.
+"""
+import asyncio
+import collections
+import random
+import time
+
+# fakes imports the client, which has to be imported before the rest of the API.
+from . import fakes
+from ..api import db, metrics, util
+
+MIXES = fakes.MIXES
+
+
+class CountingPool:
+    """
+    Wraps a redis pool, counting every command sent on its connections.
+    """
+
+    def __init__(self, pool):
+        self._pool = pool
+        self.ops = collections.Counter()
+
+    def __getattr__(self, item):
+        return getattr(self._pool, item)
+
+    def _instrument(self, redis):
+        conn = getattr(redis, "_conn", redis)
+        if getattr(conn, "_bench_counted", False):
+            return
+        execute = conn.execute
+
+        def counted_execute(command, *args, **kwargs):
+            name = command.decode() if isinstance(command, bytes) else str(command)
+            self.ops[name.upper()] += 1
+            return execute(command, *args, **kwargs)
+
+        conn.execute = counted_execute
+        conn._bench_counted = True
+
+    def get(self):
+        return _CountingContext(self, self._pool.get())
+
+    def reset(self):
+        self.ops.clear()
+
+
+class _CountingContext:
+    def __init__(self, pool: CountingPool, ctx):
+        self._pool = pool
+        self._ctx = ctx
+
+    async def __aenter__(self):
+        conn = await self._ctx.__aenter__()
+        self._pool._instrument(conn)
+        return conn
+
+    async def __aexit__(self, exc_type, exc_val, exc_tb):
+        return await self._ctx.__aexit__(exc_type, exc_val, exc_tb)
+
+
+class Benchmark:
+    """
+    A message-flood benchmark.
+    """
+
+    def __init__(self, client: fakes.FakeTransportClient, guilds: int = 10, members: int = 50, mix: str = "default",
+                 seed: int = 0, prefix: str = "?"):
+        self.client = client
+        self.mix = MIXES[mix]
+        self.prefix = prefix
+        self.random = random.Random(seed)
+
+        self.servers = [fakes.make_guild(members=members) for _ in range(guilds)]
+        self.pool = None
+
+    async def setup(self):
+        """
+        Seeds redis with the data the traffic needs, and installs the counting pool.
+        """
+        # The pool is only re-created per call when testing, which would make every op a new connection.
+        self.client.testing = False
+        self.pool = CountingPool(await util.get_pool())
+        util.redis_pool = self.pool
+
+        if not self.client.loaded:
+            await self.client.load_plugins()
+        if self.client.user is None:
+            self.client.user = list(self.servers[0].members)[0]
+
+        for server in self.servers:
+            await db.set_config(server.id, "fac:{}".format(fakes.FACTOID_NAME), "This is a benchmark factoid.")
+            # The first few members want PMs when they are mentioned.
+            for member in list(server.members)[1:4]:
+                await db.set_config(server.id, "{}:pmmentions".format(member.id), "on")
+
+    def make_traffic(self, count: int) -> list:
+        """
+        Builds the messages up front, so building them isn't part of the timing.
+        """
+        traffic = []
+        for _ in range(count):
+            kind = fakes.weighted_choice(self.random, self.mix)
+            server = self.random.choice(self.servers)
+            members = list(server.members)
+            author = self.random.choice(members[4:] or members)
+            mentions = [self.random.choice(members[1:4] or members)] if kind == "mention" else ()
+            content = fakes.random_content(kind, self.random, self.prefix)
+            traffic.append((kind, fakes.make_message(server, content, author=author, mentions=mentions)))
+        return traffic
+
+    async def run(self, count: int = 1000, concurrency: int = 1, warmup: int = 100) -> dict:
+        """
+        Runs the benchmark, returning the results.
+        """
+        if self.pool is None:
+            await self.setup()
+
+        # Warm up the caches, so this measures steady state rather than first contact.
+        for _, message in self.make_traffic(warmup):
+            await self.client.on_message(message)
+        await self.client.wait_for_commands()
+
+        traffic = self.make_traffic(count)
+        metrics.reset()
+        self.pool.reset()
+        self.client.api_calls.clear()
+        kinds = collections.defaultdict(lambda: metrics.Histogram(window=count))
+        errors = 0
+        sem = asyncio.Semaphore(concurrency)
+        # Commands run as their own tasks, so on_message returns before they do. Each message waits for its own.
+        started = collections.defaultdict(list)
+
+        async def fire(kind, message):
+            nonlocal errors
+            with (await sem):
+                start = time.perf_counter()
+                try:
+                    await self.client.on_message(message)
+                    await asyncio.gather(*started.pop(id(message), ()))
+                except Exception:
+                    errors += 1
+                kinds[kind].record(time.perf_counter() - start)
+
+        self.client.on_command = lambda message, task: started[id(message)].append(task)
+        start = time.perf_counter()
+        try:
+            await asyncio.gather(*[fire(kind, message) for kind, message in traffic])
+            await self.client.wait_for_commands()
+        finally:
+            self.client.on_command = None
+        elapsed = time.perf_counter() - start
+
+        ops = sum(self.pool.ops.values())
+        return {
+            "messages": count,
+            "concurrency": concurrency,
+            "elapsed": elapsed,
+            "msgs_per_sec": count / elapsed if elapsed else 0.0,
+            "errors": errors,
+            "redis_ops": dict(self.pool.ops),
+            "redis_ops_per_message": ops / count if count else 0.0,
+            "api_calls": dict(self.client.api_calls),
+            "kinds": {kind: histogram.to_dict() for kind, histogram in kinds.items()},
+            "stages": {"{} -> {}".format(event, name): stats
+                       for event, hooks in metrics.get_hook_stats().items() for name, stats in hooks.items()}
+        }
+
+
+def format_report(result: dict) -> str:
+    """
+    Formats benchmark results as a table.
+    """
+    lines = [
+        "{messages} messages in {elapsed:.2f}s at concurrency {concurrency}: {msgs_per_sec:.1f} msgs/sec, "
+        "{errors} errors".format(**result),
+        "Redis: {:.2f} ops/message ({})".format(
+            result["redis_ops_per_message"],
+            ", ".join("{} {}".format(k, v) for k, v in sorted(result["redis_ops"].items(), key=lambda i: -i[1]))),
+        "",
+        "{:<40} {:>8} {:>9} {:>9} {:>9}".format("latency (ms)", "count", "p50", "p95", "p99")
+    ]
+    rows = [("kind: " + k, v) for k, v in sorted(result["kinds"].items())]
+    rows += [("stage: " + k, v) for k, v in sorted(result["stages"].items())]
+    for name, stats in rows:
+        lines.append("{:<40} {:>8} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+            name, stats["count"], stats["p50"] * 1000, stats["p95"] * 1000, stats["p99"] * 1000))
+    return "\n".join(lines)
@@ -0,0 +1,345 @@
+"""
+A local stand-in for Discord's gateway and REST API.
+
+It speaks enough of both for a real `NavalClient` to log in, receive synthetic guilds and message floods, and have
+its REST calls answered with configurable latency and rate limits, all without a network connection.
+
+Run the server with `python tools/fake_discord.py serve`, and the bot against it with
+`python tools/fake_discord.py bot`.
+"""
+import asyncio
+import collections
+import email.utils
+import json
+import logging
+import random
+import re
+import time
+
+import aiohttp
+from aiohttp import web
+
+from . import fakes
+
+logger = logging.getLogger("NavalBot")
+
+API_PREFIX = "/api/v6"
+
+# Gateway opcodes.
+OP_DISPATCH = 0
+OP_HEARTBEAT = 1
+OP_IDENTIFY = 2
+OP_STATUS_UPDATE = 3
+OP_VOICE_STATE_UPDATE = 4
+OP_RESUME = 6
+OP_REQUEST_MEMBERS = 8
+OP_HELLO = 10
+OP_HEARTBEAT_ACK = 11
+
+_snowflake = re.compile(r"\d{15,21}")
+
+
+def patch_discord_urls(base: str):
+    """
+    Points discord.py's REST endpoints at another server.
+
+    The endpoints are built from the base URL when discord.py is imported, so each one has to be replaced.
+    """
+    from discord import http
+
+    targets = [http.HTTPClient]
+    try:
+        from discord import endpoints
+        targets.append(endpoints)
+    except ImportError:
+        pass
+
+    for target in targets:
+        real = getattr(target, "BASE", "https://discordapp.com")
+        for name, value in list(vars(target).items()):
+            if isinstance(value, str) and value.startswith(real):
+                setattr(target, name, base.rstrip("/") + value[len(real):])
+
+
+class _Bucket:
+    """
+    A fixed-window rate limit bucket.
+    """
+
+    def __init__(self, limit: int, per: float):
+        self.limit = limit
+        self.per = per
+        self.remaining = limit
+        self.reset = time.time() + per
+
+    def hit(self) -> float:
+        """
+        Takes a request from the bucket, returning how long to retry after if it's empty.
+        """
+        now = time.time()
+        if now >= self.reset:
+            self.remaining = self.limit
+            self.reset = now + self.per
+        if self.remaining <= 0:
+            return self.reset - now
+        self.remaining -= 1
+        return 0.0
+
+
+class _GatewaySession:
+    """
+    One connected gateway client.
+    """
+
+    def __init__(self, ws: web.WebSocketResponse):
+        self.ws = ws
+        self.seq = 0
+        self.flood_task = None
+
+    def send(self, op: int, d=None, t: str = None):
+        payload = {"op": op, "d": d}
+        if op == OP_DISPATCH:
+            self.seq += 1
+            payload["s"] = self.seq
+            payload["t"] = t
+        self.ws.send_str(json.dumps(payload, separators=(",", ":")))
+
+
+class FakeDiscord:
+    """
+    The fake Discord server.
+
+    `rate` messages per second are sent to every identified client for `duration` seconds (0 means forever), spread
+    over the synthetic guilds using a traffic mix from `fakes.MIXES`.
+    REST calls take `latency` seconds, give or take `jitter` of that, and each route is limited to `rate_limit`
+    requests per `rate_limit_per` seconds.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None, host: str = "127.0.0.1", port: int = 8765,
+                 guilds: int = 10, members: int = 50, rate: float = 50.0, duration: float = 0.0,
+                 mix: str = "default", latency: float = 0.05, jitter: float = 0.5, rate_limit: int = 5,
+                 rate_limit_per: float = 5.0, echo: bool = True, seed: int = 0):
+        self.loop = loop or asyncio.get_event_loop()
+        self.host = host
+        self.port = port
+        self.rate = rate
+        self.duration = duration
+        self.mix = fakes.MIXES[mix]
+        self.latency = latency
+        self.jitter = jitter
+        self.rate_limit = rate_limit
+        self.rate_limit_per = rate_limit_per
+        self.echo = echo
+        self.random = random.Random(seed)
+
+        self.bot_user = fakes.user_payload(name="NavalBot", bot=True)
+        self.guilds = [fakes.guild_payload(members=members) for _ in range(guilds)]
+        for guild in self.guilds:
+            guild["members"].append({"user": self.bot_user, "roles": [], "joined_at": fakes._timestamp(),
+                                     "deaf": False, "mute": False})
+        self.channels = {c["id"]: guild for guild in self.guilds for c in guild["channels"]}
+        # Recent messages per channel, for fetching history.
+        self.history = collections.defaultdict(lambda: collections.deque(maxlen=100))
+
+        self.sessions = []
+        self.buckets = {}
+        self.stats = collections.Counter()
+
+        self.app = web.Application(loop=self.loop)
+        self.app.router.add_route("GET", "/gateway", self.gateway)
+        self.app.router.add_route("GET", "/_stats", self.get_stats)
+        self.app.router.add_route("*", API_PREFIX + "/{route:.*}", self.rest)
+        self._handler = None
+        self._server = None
+
+    @property
+    def url(self) -> str:
+        return "http://{}:{}".format(self.host, self.port)
+
+    async def start(self):
+        self._handler = self.app.make_handler()
+        self._server = await self.loop.create_server(self._handler, self.host, self.port)
+        logger.info("Fake Discord listening on {}, with {} guilds.".format(self.url, len(self.guilds)))
+
+    async def stop(self):
+        for session in list(self.sessions):
+            if session.flood_task is not None:
+                session.flood_task.cancel()
+            await session.ws.close()
+        if self._server is not None:
+            self._server.close()
+            await self._server.wait_closed()
+        if self._handler is not None:
+            await self._handler.finish_connections(1.0)
+
+    # Gateway.
+    async def gateway(self, request):
+        ws = web.WebSocketResponse()
+        await ws.prepare(request)
+        session = _GatewaySession(ws)
+        self.sessions.append(session)
+        self.stats["gateway.connections"] += 1
+
+        session.send(OP_HELLO, {"heartbeat_interval": 41250, "_trace": ["fake-discord"]})
+        try:
+            while True:
+                msg = await ws.receive()
+                if msg.tp != aiohttp.MsgType.text:
+                    break
+                payload = json.loads(msg.data)
+                self.stats["gateway.op.{}".format(payload.get("op"))] += 1
+                self._handle_op(session, payload.get("op"), payload.get("d"))
+        finally:
+            if session.flood_task is not None:
+                session.flood_task.cancel()
+            self.sessions.remove(session)
+        return ws
+
+    def _handle_op(self, session: _GatewaySession, op: int, d):
+        if op == OP_HEARTBEAT:
+            session.send(OP_HEARTBEAT_ACK)
+        elif op in (OP_IDENTIFY, OP_RESUME):
+            self._ready(session)
+        elif op == OP_VOICE_STATE_UPDATE and d:
+            # Answer the gateway half of a voice connection.
+            # There's no voice server, so the connection itself won't complete.
+            session.send(OP_DISPATCH, {"user_id": self.bot_user["id"], "guild_id": d.get("guild_id"),
+                                       "channel_id": d.get("channel_id"), "session_id": "fake-session",
+                                       "deaf": False, "mute": False, "self_deaf": d.get("self_deaf", False),
+                                       "self_mute": d.get("self_mute", False), "suppress": False},
+                         "VOICE_STATE_UPDATE")
+            if d.get("channel_id"):
+                session.send(OP_DISPATCH, {"guild_id": d.get("guild_id"), "token": "fake-token",
+                                           "endpoint": "{}:{}".format(self.host, self.port)},
+                             "VOICE_SERVER_UPDATE")
+
+    def _ready(self, session: _GatewaySession):
+        session.send(OP_DISPATCH, {
+            "v": 6, "user": self.bot_user, "session_id": "fake-session", "private_channels": [],
+            "guilds": [{"id": guild["id"], "unavailable": True} for guild in self.guilds],
+            "heartbeat_interval": 41250, "_trace": ["fake-discord"]
+        }, "READY")
+        for guild in self.guilds:
+            session.send(OP_DISPATCH, guild, "GUILD_CREATE")
+        if self.rate > 0 and session.flood_task is None:
+            session.flood_task = self.loop.create_task(self.flood(session))
+
+    async def flood(self, session: _GatewaySession):
+        """
+        Sends synthetic messages to a client.
+        """
+        # Give the client time to finish handling GUILD_CREATE.
+        await asyncio.sleep(3)
+        logger.info("Flooding at {} messages/sec.".format(self.rate))
+        interval = 1 / self.rate
+        start = self.loop.time()
+        sent = 0
+        while not self.duration or self.loop.time() - start < self.duration:
+            guild = self.random.choice(self.guilds)
+            channel = self.random.choice(guild["channels"])
+            members = guild["members"][:-1]
+            author = self.random.choice(members[4:] or members)["user"]
+            kind = fakes.weighted_choice(self.random, self.mix)
+            mentions = [self.random.choice(members[1:4] or members)["user"]] if kind == "mention" else ()
+            payload = fakes.message_payload(channel["id"], author, fakes.random_content(kind, self.random),
+                                            mentions=mentions)
+            payload["guild_id"] = guild["id"]
+            self.history[channel["id"]].append(payload)
+            session.send(OP_DISPATCH, payload, "MESSAGE_CREATE")
+            self.stats["flood.messages"] += 1
+            sent += 1
+            # Pace against the start time, so slow sends don't lower the rate.
+            delay = start + sent * interval - self.loop.time()
+            if delay > 0:
+                await asyncio.sleep(delay)
+        logger.info("Flood finished, sent {} messages.".format(sent))
+
+    # REST.
+    def _bucket_key(self, method: str, route: str) -> str:
+        # Like Discord, the first ID in the route (the channel or guild) is part of the bucket.
+        ids = _snowflake.findall(route)
+        return "{} {} {}".format(method, _snowflake.sub("{id}", route), ids[0] if ids else "")
+
+    def _headers(self, bucket: _Bucket) -> dict:
+        return {
+            "X-RateLimit-Limit": str(bucket.limit),
+            "X-RateLimit-Remaining": str(bucket.remaining),
+            "X-RateLimit-Reset": str(int(bucket.reset)),
+            "Date": email.utils.formatdate(usegmt=True)
+        }
+
+    async def rest(self, request):
+        route = request.match_info["route"]
+        key = self._bucket_key(request.method, route)
+        self.stats["rest." + key] += 1
+
+        if self.latency:
+            await asyncio.sleep(max(0.0, self.random.uniform(self.latency * (1 - self.jitter),
+                                                             self.latency * (1 + self.jitter))))
+
+        bucket = self.buckets.get(key)
+        if bucket is None:
+            bucket = self.buckets[key] = _Bucket(self.rate_limit, self.rate_limit_per)
+        retry_after = bucket.hit()
+        headers = self._headers(bucket)
+        if retry_after:
+            self.stats["rest.429"] += 1
+            headers["Retry-After"] = str(int(retry_after * 1000))
+            return web.Response(status=429, headers=headers, content_type="application/json",
+                                text=json.dumps({"message": "You are being rate limited.",
+                                                 "retry_after": int(retry_after * 1000), "global": False}))
+
+        body = None
+        if request.has_body:
+            try:
+                body = await request.json()
+            except ValueError:
+                # Multipart uploads, i.e send_file.
+                body = {}
+        result = self._answer(request.method, route.split("/"), request.GET, body or {})
+        if result is None:
+            return web.Response(status=204, headers=headers)
+        return web.Response(status=200, headers=headers, content_type="application/json", text=json.dumps(result))
+
+    def _answer(self, method: str, parts: list, query, body: dict):
+        """
+        Builds the response for a REST call, or None for an empty response.
+        """
+        if parts[0] == "gateway":
+            return {"url": "ws://{}:{}/gateway".format(self.host, self.port)}
+        if parts[:2] == ["users", "@me"] and len(parts) == 2:
+            return self.bot_user
+        if parts == ["users", "@me", "channels"] and method == "POST":
+            # Opening a DM.
+            recipient = {"id": body.get("recipient_id"), "username": "user", "discriminator": "0001", "avatar": None}
+            return {"id": fakes.next_id(), "type": 1, "is_private": True, "recipient": recipient,
+                    "recipients": [recipient], "last_message_id": None}
+        if parts[:3] == ["oauth2", "applications", "@me"]:
+            return {"id": self.bot_user["id"], "name": "NavalBot", "description": "", "icon": None,
+                    "rpc_origins": None, "owner": fakes.user_payload(name="owner")}
+
+        if parts[0] == "channels" and len(parts) >= 3 and parts[2] == "messages":
+            channel_id = parts[1]
+            if len(parts) == 3 and method == "POST":
+                payload = fakes.message_payload(channel_id, self.bot_user, body.get("content") or "")
+                self.history[channel_id].append(payload)
+                if self.echo:
+                    # Discord sends our own messages back over the gateway.
+                    for session in self.sessions:
+                        session.send(OP_DISPATCH, payload, "MESSAGE_CREATE")
+                return payload
+            if len(parts) == 3 and method == "GET":
+                limit = int(query.get("limit", 50))
+                return list(reversed(self.history[channel_id]))[:limit]
+            if len(parts) == 4 and method == "PATCH":
+                payload = fakes.message_payload(channel_id, self.bot_user, body.get("content") or "")
+                payload["id"] = parts[3]
+                return payload
+            return None
+
+        # Everything else (deletes, typing, roles, bans, ...) succeeds with no content.
+        return None
+
+    async def get_stats(self, request):
+        return web.Response(status=200, content_type="application/json",
+                            text=json.dumps(dict(self.stats), indent=2, sort_keys=True))
@@ -0,0 +1,235 @@
+"""
+Synthetic Discord data, and a client with a fake transport.
+
+Nothing here talks to Discord, so it can be used for benchmarks and tests without a connection or a data dump.
+"""
+import datetime
+import itertools
+import random
+
+import discord
+
+from ..api.botcls import NavalClient
+from .test_client import TestClient
+
+# Traffic mixes, as kind -> relative weight.
+MIXES = {
+    "default": {"chat": 70, "command": 15, "factoid_hit": 5, "factoid_miss": 5, "mention": 5},
+    "chat": {"chat": 100},
+    "commands": {"command": 60, "factoid_hit": 20, "factoid_miss": 20},
+    "mentions": {"chat": 50, "mention": 50},
+}
+
+# Commands that don't need anything outside of the bot.
+COMMANDS = ["fullwidth some benchmark text", "choice red green blue", "fullwidth abc"]
+
+FACTOID_NAME = "benchfact"
+
+_WORDS = "the quick brown fox jumps over lazy dog navalbot redis discord benchmark message".split()
+
+# Snowflake-ish IDs, so they look like the real thing.
+_ids = itertools.count(200000000000000000)
+
+
+def next_id() -> str:
+    return str(next(_ids))
+
+
+def _timestamp() -> str:
+    return datetime.datetime.utcnow().isoformat()
+
+
+def user_payload(name: str = None, bot: bool = False) -> dict:
+    uid = next_id()
+    return {"id": uid, "username": name or "user{}".format(uid[-6:]), "discriminator": "0001", "avatar": None,
+            "bot": bot}
+
+
+def guild_payload(members: int = 50, channels: int = 5, name: str = None) -> dict:
+    """
+    Creates a GUILD_CREATE payload for a synthetic guild.
+    """
+    gid = next_id()
+    users = [user_payload() for _ in range(members)]
+    return {
+        "id": gid,
+        "name": name or "Guild {}".format(gid[-6:]),
+        "owner_id": users[0]["id"],
+        "region": "us-east",
+        "icon": None,
+        "afk_timeout": 300,
+        "afk_channel_id": None,
+        "verification_level": 0,
+        "features": [],
+        "emojis": [],
+        "large": members > 250,
+        "unavailable": False,
+        "member_count": members,
+        # The @everyone role has the same ID as the guild.
+        "roles": [{"id": gid, "name": "@everyone", "permissions": 104324161, "position": 0, "color": 0,
+                   "hoist": False, "managed": False, "mentionable": False}],
+        # The default channel also has the same ID as the guild.
+        "channels": [{"id": gid if i == 0 else next_id(), "name": "channel-{}".format(i), "type": 0, "position": i,
+                      "topic": None, "permission_overwrites": []} for i in range(channels)],
+        "members": [{"user": u, "roles": [], "joined_at": _timestamp(), "deaf": False, "mute": False}
+                    for u in users],
+        "presences": [],
+        "voice_states": []
+    }
+
+
+def message_payload(channel_id: str, author: dict, content: str, mentions=()) -> dict:
+    """
+    Creates a MESSAGE_CREATE payload.
+
+    The author and mentions are user payloads.
+    """
+    return {
+        "id": next_id(),
+        "channel_id": channel_id,
+        "content": content,
+        "author": author,
+        "timestamp": _timestamp(),
+        "edited_timestamp": None,
+        "tts": False,
+        "mention_everyone": False,
+        "mentions": list(mentions),
+        "mention_roles": [],
+        "attachments": [],
+        "embeds": [],
+        "pinned": False,
+        "type": 0
+    }
+
+
+def random_content(kind: str, rng: random.Random, prefix: str = "?") -> str:
+    """
+    Creates message content for a kind of traffic.
+
+    Commands only use commands that don't need anything outside of the bot.
+    """
+    if kind == "chat" or kind == "mention":
+        return " ".join(rng.choice(_WORDS) for _ in range(rng.randint(3, 12)))
+    elif kind == "command":
+        return prefix + rng.choice(COMMANDS)
+    elif kind == "factoid_hit":
+        return prefix + FACTOID_NAME
+    elif kind == "factoid_miss":
+        return prefix + "nofactoid{}".format(rng.randint(0, 10000))
+    raise ValueError("Unknown traffic kind `{}`".format(kind))
+
+
+def weighted_choice(rng: random.Random, weights: dict) -> str:
+    """
+    Picks a key from a dict of key -> relative weight.
+    """
+    point = rng.uniform(0, sum(weights.values()))
+    for key, weight in weights.items():
+        point -= weight
+        if point <= 0:
+            return key
+    return key
+
+
+def _user_of(member) -> dict:
+    return {"id": member.id, "username": member.name, "discriminator": member.discriminator, "avatar": member.avatar}
+
+
+def make_guild(members: int = 50, channels: int = 5, name: str = None) -> discord.Server:
+    """
+    Creates a synthetic guild.
+    """
+    return discord.Server(**guild_payload(members=members, channels=channels, name=name))
+
+
+def make_message(server: discord.Server, content: str, author: discord.Member = None,
+                 channel: discord.Channel = None, mentions=()) -> discord.Message:
+    """
+    Creates a synthetic message in a guild.
+
+    The author and channel are picked at random if not given.
+    """
+    channel = channel or random.choice([c for c in server.channels if c.type == discord.ChannelType.text])
+    author = author or random.choice(list(server.members))
+    payload = message_payload(channel.id, _user_of(author), content, mentions=[_user_of(m) for m in mentions])
+    message = discord.Message(channel=channel, **payload)
+    # Set these directly, as there's no connection state to look them up in.
+    message.server = server
+    message.channel = channel
+    message.author = author
+    message.mentions = list(mentions)
+    return message
+
+
+class _FakeLogs:
+    """
+    Async iterator standing in for `logs_from`.
+    """
+
+    def __init__(self, messages):
+        self._messages = iter(messages)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        try:
+            return next(self._messages)
+        except StopIteration:
+            raise StopAsyncIteration
+
+
+class FakeTransportClient(TestClient):
+    """
+    A test client where every Discord API call is answered locally.
+
+    Sent messages are counted rather than collected, so it can run for a long time.
+    """
+
+    def __init__(self, user: discord.User = None, *args, **kwargs):
+        super().__init__(user, *args, **kwargs)
+        NavalClient._instance = self
+
+        # Calls made to the fake transport, by method name.
+        self.api_calls = {}
+        # The last messages sent per channel, used for `logs_from`.
+        self._history = {}
+
+    def _count(self, name: str):
+        self.api_calls[name] = self.api_calls.get(name, 0) + 1
+
+    def _fake_message(self, destination, content: str) -> discord.Message:
+        channel = getattr(destination, "channel", destination)
+        server = getattr(channel, "server", None)
+        if server is None or self.user is None:
+            return discord.Object(id=next_id())
+        message = make_message(server, content or "", author=getattr(server, "me", None) or self.user,
+                               channel=channel)
+        history = self._history.setdefault(channel.id, [])
+        history.append(message)
+        del history[:-20]
+        return message
+
+    async def send_message(self, destination, content=None, *, tts=False, embed=None):
+        self._count("send_message")
+        return self._fake_message(destination, content)
+
+    async def send_file(self, destination, fp, *, filename=None, content=None, tts=False):
+        self._count("send_file")
+        return self._fake_message(destination, content)
+
+    async def edit_message(self, message, new_content=None, *, embed=None):
+        self._count("edit_message")
+        message.content = new_content
+        return message
+
+    async def delete_message(self, message):
+        self._count("delete_message")
+
+    async def send_typing(self, destination):
+        self._count("send_typing")
+
+    def logs_from(self, channel, limit=100, *, before=None, after=None, around=None, reverse=False):
+        self._count("logs_from")
+        history = self._history.get(channel.id, [])[-limit:]
+        return _FakeLogs(history if reverse else reversed(history))
@@ -0,0 +1,233 @@
+"""
+Replays recorded gateway traffic against a client with no network.
+
+Recordings are made with `?record`, or `NavalClient.recorder`. Servers and messages are rebuilt from the payloads
+the same way the test suite builds them from `guild_data_dump`.
+
+Run it with `python tools/replay.py <recording>`.
+"""
+import asyncio
+import collections
+import time
+
+import discord
+
+from . import fakes
+from ..api import metrics
+from ..api.recorder import read_frames
+
+DISPATCH = 0
+
+
+class Replay:
+    """
+    Replays a recording at a speed factor, timing how long each event takes to handle.
+
+    A speed of 1 replays in real time, 10 replays ten times as fast, and 0 replays as fast as possible.
+    An event is handled once its scheduled job and any commands it started have finished.
+    At speed 0 each event is handled before the next is fired, so replays are deterministic.
+    """
+
+    def __init__(self, client: fakes.FakeTransportClient, path: str, speed: float = 1.0):
+        self.client = client
+        self.path = path
+        self.speed = speed
+
+        self.servers = {}
+        self.channels = {}
+        # Recent messages, for edits and deletes.
+        self.messages = collections.OrderedDict()
+
+        self.latency = collections.defaultdict(metrics.Histogram)
+        self.skipped = collections.Counter()
+        self.errors = collections.Counter()
+        self.dropped = collections.Counter()
+
+        # id(last event argument) -> future resolved when the event's scheduled job finishes.
+        self._waiting = {}
+        # id(message) -> the command tasks it started.
+        self._commands = collections.defaultdict(list)
+
+    def _add_server(self, data: dict):
+        server = discord.Server(**data)
+        self.servers[server.id] = server
+        for channel in server.channels:
+            self.channels[channel.id] = channel
+
+    def _build_message(self, data: dict) -> discord.Message:
+        channel = self.channels.get(data.get("channel_id"))
+        if channel is None:
+            return None
+        message = discord.Message(channel=channel, **data)
+        message.server = channel.server
+        message.channel = channel
+        member = channel.server.get_member(data.get("author", {}).get("id"))
+        if member is not None:
+            message.author = member
+        self.messages[message.id] = message
+        if len(self.messages) > 1000:
+            self.messages.popitem(last=False)
+        return message
+
+    def _event(self, t: str, data: dict):
+        """
+        Turns a dispatch payload into the event name and arguments to dispatch, or None if it isn't replayed.
+        """
+        if t == "READY":
+            self.client.user = discord.User(**data["user"])
+            for guild in data.get("guilds", []):
+                if not guild.get("unavailable"):
+                    self._add_server(guild)
+        elif t == "GUILD_CREATE":
+            self._add_server(data)
+        elif t == "MESSAGE_CREATE":
+            message = self._build_message(data)
+            if message is not None:
+                return "message", (message,)
+        elif t == "MESSAGE_UPDATE":
+            before = self.messages.get(data.get("id"))
+            if before is not None and "content" in data:
+                after = self._build_message(dict(before_payload(before), **data))
+                if after is not None:
+                    return "message_edit", (before, after)
+        elif t == "MESSAGE_DELETE":
+            message = self.messages.pop(data.get("id"), None)
+            if message is not None:
+                return "message_delete", (message,)
+        elif t == "GUILD_MEMBER_ADD":
+            server = self.servers.get(data.get("guild_id"))
+            if server is not None:
+                member = discord.Member(**data)
+                member.server = server
+                return "member_join", (member,)
+        return None
+
+    def _job_done(self, func, args: tuple, error: bool):
+        if func != self.client._run_event:
+            return
+        done = self._waiting.pop(id(args[-1]), None)
+        if done is not None and not done.done():
+            done.set_result(error)
+
+    def _command_started(self, message: discord.Message, task: asyncio.Task):
+        self._commands[id(message)].append(task)
+
+    def _dispatch(self, event: str, args: tuple) -> asyncio.Future:
+        """
+        Dispatches an event the way the gateway would, returning a future for when its scheduled job finishes.
+        Resolves to None if the scheduler dropped the job.
+        """
+        done = asyncio.Future(loop=self.client.loop)
+        self._waiting[id(args[-1])] = done
+        dropped = sum(self.client.scheduler.dropped.values())
+        self.client.dispatch(event, *args)
+        if sum(self.client.scheduler.dropped.values()) > dropped and not done.done():
+            # The guild's queue was full.
+            self._waiting.pop(id(args[-1]), None)
+            done.set_result(None)
+        return done
+
+    async def _timed(self, t: str, args: tuple, done: asyncio.Future, scheduled: float):
+        error = await done
+        if error is None:
+            self.dropped[t] += 1
+            return
+        # Commands run as their own tasks, started by the job, so they're waited for too.
+        commands = self._commands.pop(id(args[-1]), ())
+        if commands:
+            await asyncio.wait(commands)
+            error = error or any(not task.cancelled() and task.exception() is not None for task in commands)
+        if error:
+            self.errors[t] += 1
+        # Measured from when the event was due, so time spent queued in the scheduler counts.
+        self.latency[t].record(time.perf_counter() - scheduled)
+
+    async def run(self) -> dict:
+        """
+        Runs the replay, returning the results.
+        """
+        # The pool is only re-created per call when testing, which would make every op a new connection.
+        self.client.testing = False
+        if not self.client.loaded:
+            await self.client.load_plugins()
+
+        self.client.scheduler.on_done = self._job_done
+        self.client.on_command = self._command_started
+        pending = []
+        events = 0
+        start = time.perf_counter()
+        for offset, payload in read_frames(self.path):
+            scheduled = start + offset / self.speed if self.speed else time.perf_counter()
+            if self.speed:
+                delay = scheduled - time.perf_counter()
+                if delay > 0:
+                    await asyncio.sleep(delay)
+
+            # Raw hooks see every payload, as they would live.
+            self.client._dispatch_raw(payload)
+            if payload.get("op") != DISPATCH:
+                continue
+
+            t = payload.get("t")
+            event = self._event(t, payload.get("d") or {})
+            if event is None:
+                self.skipped[t] += 1
+                continue
+            events += 1
+            done = self._dispatch(*event)
+            if self.speed:
+                pending.append(self.client.loop.create_task(self._timed(t, event[1], done, scheduled)))
+            else:
+                await self._timed(t, event[1], done, scheduled)
+
+        if pending:
+            await asyncio.wait(pending)
+        await self.client.wait_for_commands()
+        elapsed = time.perf_counter() - start
+        self.client.scheduler.on_done = None
+        self.client.on_command = None
+
+        return {
+            "events": events,
+            "elapsed": elapsed,
+            "events_per_sec": events / elapsed if elapsed else 0.0,
+            "speed": self.speed,
+            "errors": dict(self.errors),
+            "dropped": dict(self.dropped),
+            "skipped": dict(self.skipped),
+            "latency": {t: histogram.to_dict() for t, histogram in self.latency.items()}
+        }
+
+
+def before_payload(message: discord.Message) -> dict:
+    """
+    Rebuilds the fields of a message payload that MESSAGE_UPDATE leaves out.
+    """
+    return {
+        "id": message.id, "channel_id": message.channel.id, "content": message.content,
+        "author": {"id": message.author.id, "username": message.author.name,
+                   "discriminator": message.author.discriminator, "avatar": message.author.avatar},
+        "timestamp": message.timestamp.isoformat() if message.timestamp else None,
+        "mentions": [], "mention_roles": [], "attachments": [], "embeds": [], "tts": False,
+        "mention_everyone": False, "pinned": False, "type": 0
+    }
+
+
+def format_report(result: dict) -> str:
+    """
+    Formats replay results as a table.
+    """
+    lines = [
+        "{events} events in {elapsed:.2f}s at speed {speed}: {events_per_sec:.1f} events/sec".format(**result),
+        "{:<24} {:>8} {:>7} {:>9} {:>9} {:>9}".format("latency (ms)", "count", "errors", "p50", "p95", "p99")
+    ]
+    for t, stats in sorted(result["latency"].items()):
+        lines.append("{:<24} {:>8} {:>7} {:>9.3f} {:>9.3f} {:>9.3f}".format(
+            t, stats["count"], result["errors"].get(t, 0), stats["p50"] * 1000, stats["p95"] * 1000,
+            stats["p99"] * 1000))
+    if result["dropped"]:
+        lines.append("Dropped by the scheduler: " + ", ".join("{} ({})".format(t, n)
+                                                            for t, n in sorted(result["dropped"].items())))
+    if result["skipped"]:
+        lines.append("Not replayed: " + ", ".join("{} ({})".format(t, n) for t, n in sorted(result["skipped"].items())))
+    return "\n".join(lines)
@@ -59,6 +59,8 @@ class TestClient(NavalClient):
         coro = getattr(self, event_name)(*args, **kwargs)
         try:
             result = await coro
+            # Commands run as their own tasks, so wait for them too.
+            await self.wait_for_commands()
             self.errored = False
             return result
         except Exception as e:
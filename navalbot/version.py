@@ -20,7 +20,6 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 
 import re
 
-import aiohttp
 # =============== Commands
 from navalbot.api.commands import command
 from navalbot.api.contexts import CommandContext
@@ -51,9 +50,8 @@ async def version(ctx: CommandContext):
     await ctx.reply("core.version.base", ver=VERSION + VERSUFF)
 
     # Download the latest version
-    async with aiohttp.ClientSession() as sess:
-        s = await sess.get("https://raw.githubusercontent.com/NavalBot/NavalBot-core/develop/navalbot/version.py")
-        assert isinstance(s, aiohttp.ClientResponse)
+    async with ctx.client.web.get("https://raw.githubusercontent.com/NavalBot/NavalBot-core/develop/navalbot/version.py") \
+            as s:
         data = await s.read()
         data = data.decode().split('\n')
 
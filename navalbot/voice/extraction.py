@@ -0,0 +1,325 @@
+"""
+=================================
+
+This file is part of NavalBot.
+Copyright (C) 2016 Isaac Dickinson
+Copyright (C) 2016 Nils Theres
+
+This program is free software: you can redistribute it and/or modify
+it under the terms of the GNU General Public License as published by
+the Free Software Foundation, either version 3 of the License, or
+(at your option) any later version.
+
+This program is distributed in the hope that it will be useful,
+but WITHOUT ANY WARRANTY; without even the implied warranty of
+MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+GNU General Public License for more details.
+
+You should have received a copy of the GNU General Public License
+along with this program.  If not, see <http://www.gnu.org/licenses/>
+
+=================================
+"""
+
+# youtube_dl extraction in worker processes.
+# extract_info holds the GIL for long stretches, which stalls the event loop and audio when it runs in a thread.
+# Instead, it runs in a small pool of worker processes, each with youtube_dl imported and a YoutubeDL built ahead of time.
+import asyncio
+import collections
+import concurrent.futures
+import functools
+import logging
+import multiprocessing
+import signal
+
+from navalbot.api import executors
+from navalbot.api import metrics
+
+logger = logging.getLogger("NavalBot::Voice")
+
+# Options used by ?play. The playlist length is added per server.
+PLAYBACK_OPTIONS = {"format": "best", "ignoreerrors": True, "default_search": "ytsearch",
+                    "source_address": "0.0.0.0"}
+# Options used to re-resolve a track's URL just before it plays.
+FIXUP_OPTIONS = {"format": "webm[abr>0]/bestaudio/best", "ignoreerrors": True, "source_address": "0.0.0.0"}
+
+# Option sets that workers build a YoutubeDL for on startup.
+WARM_OPTIONS = (dict(PLAYBACK_OPTIONS, playlistend=99), FIXUP_OPTIONS)
+
+# How many YoutubeDL instances (one per set of options) a worker keeps.
+MAX_INSTANCES = 8
+
+
+class ExtractionError(Exception):
+    """
+    Raised when youtube_dl fails to extract a URL, or the worker dies.
+    """
+
+
+class ExtractionTimeout(ExtractionError):
+    pass
+
+
+class ExtractionCancelled(ExtractionError):
+    """
+    Raised when an extraction is cancelled with `ExtractionService.cancel`, such as by ?reset.
+    """
+
+
+def _options_key(options: dict) -> tuple:
+    return tuple(sorted(options.items()))
+
+
+def _worker_main(conn, max_jobs: int, warm_options: tuple):
+    """
+    The worker process loop. Each request is `(url, options)`, and each reply is `(ok, info or error message)`.
+    A request of None, or reaching `max_jobs`, exits the worker.
+    """
+    # Ctrl-C is for the bot, which will stop the workers itself.
+    signal.signal(signal.SIGINT, signal.SIG_IGN)
+    import youtube_dl
+
+    instances = collections.OrderedDict()
+
+    def get_instance(options: dict):
+        key = _options_key(options)
+        try:
+            instances.move_to_end(key)
+            return instances[key]
+        except KeyError:
+            pass
+        if len(instances) >= MAX_INSTANCES:
+            instances.popitem(last=False)
+        ydl = instances[key] = youtube_dl.YoutubeDL(options)
+        return ydl
+
+    for options in warm_options:
+        get_instance(options)
+
+    jobs = 0
+    while not max_jobs or jobs < max_jobs:
+        try:
+            request = conn.recv()
+        except (EOFError, OSError):
+            break
+        if request is None:
+            break
+        url, options = request
+        try:
+            info = get_instance(options).extract_info(url, download=False)
+            conn.send((True, info))
+        except Exception as e:
+            conn.send((False, "{}: {}".format(type(e).__name__, e)))
+        jobs += 1
+    conn.close()
+
+
+class _Worker:
+    def __init__(self, context, max_jobs: int, warm_options: tuple):
+        self.conn, child_conn = context.Pipe()
+        self.process = context.Process(target=_worker_main, args=(child_conn, max_jobs, warm_options),
+                                       name="navalbot-ytdl", daemon=True)
+        self.process.start()
+        child_conn.close()
+        self.jobs = 0
+
+    def call(self, url: str, options: dict, timeout: float):
+        """
+        Sends a request and waits for the reply. This blocks, so it's ran on a thread.
+        """
+        self.conn.send((url, options))
+        if not self.conn.poll(timeout):
+            raise ExtractionTimeout("Extraction of {} timed out after {} seconds".format(url, timeout))
+        return self.conn.recv()
+
+    def alive(self) -> bool:
+        return self.process.is_alive()
+
+    def kill(self):
+        self.process.terminate()
+        self.conn.close()
+
+    def retire(self):
+        """
+        Asks the worker to exit once it's idle, and waits for it. This blocks, so it's ran on a thread.
+        """
+        try:
+            self.conn.send(None)
+        except OSError:
+            pass
+        self.process.join(5)
+        if self.process.is_alive():
+            self.process.terminate()
+        self.conn.close()
+
+
+class ExtractionService:
+    """
+    Runs youtube_dl extraction on a pool of pre-warmed worker processes.
+
+    Each job gets a whole worker. Workers that time out, die or are cancelled are killed and replaced, and workers are
+    recycled after `max_jobs` jobs to bound their memory.
+    If the service is disabled, extraction runs on the `voice-extraction` thread pool instead.
+    """
+
+    def __init__(self, loop: asyncio.AbstractEventLoop = None, workers: int = 2, max_jobs: int = 50,
+                 timeout: float = 120, enabled: bool = True):
+        self.loop = loop
+        self.configure(workers=workers, max_jobs=max_jobs, timeout=timeout, enabled=enabled)
+
+        # Workers aren't forked from the bot, as they'd inherit its event loop, sockets and any locks held by other
+        # threads. The forkserver starts them from a clean process with youtube_dl already imported.
+        if "forkserver" in multiprocessing.get_all_start_methods():
+            self._context = multiprocessing.get_context("forkserver")
+            self._context.set_forkserver_preload(["youtube_dl"])
+        else:
+            self._context = multiprocessing.get_context("spawn")
+        self._idle = None
+        # How many callers are waiting for an idle worker.
+        self._waiting = 0
+        self._threads = None
+        # Group (server ID) -> futures of running jobs.
+        self._jobs = collections.defaultdict(set)
+        self._cancelled = set()
+
+        self.recycled = 0
+        self.killed = 0
+
+    def configure(self, workers: int = 2, max_jobs: int = 50, timeout: float = 120, enabled: bool = True):
+        """
+        Changes the settings. This only affects workers started after it is called.
+        """
+        self.worker_count = max(1, workers)
+        self.max_jobs = max(0, max_jobs)
+        self.timeout = timeout
+        self.enabled = enabled
+
+    @property
+    def started(self) -> bool:
+        return self._idle is not None
+
+    def _spawn(self) -> _Worker:
+        return _Worker(self._context, self.max_jobs, WARM_OPTIONS)
+
+    def start(self):
+        """
+        Starts the worker processes.
+        """
+        if self.started or not self.enabled:
+            return
+        self.loop = self.loop or asyncio.get_event_loop()
+        self._idle = asyncio.Queue()
+        self._threads = concurrent.futures.ThreadPoolExecutor(max_workers=self.worker_count * 2)
+        for _ in range(self.worker_count):
+            self._idle.put_nowait(self._spawn())
+        logger.info("Started {} youtube_dl workers.".format(self.worker_count))
+
+    def stop(self):
+        """
+        Kills the worker processes. Running jobs fail with `ExtractionError`.
+        """
+        if not self.started:
+            return
+        while not self._idle.empty():
+            self._idle.get_nowait().kill()
+        # Wake up anybody waiting for a worker, so they fail instead of waiting forever.
+        for _ in range(self._waiting):
+            self._idle.put_nowait(None)
+        for futures in self._jobs.values():
+            for fut in futures:
+                self._cancelled.add(fut)
+                fut.cancel()
+        self._threads.shutdown(wait=False)
+        self._idle = None
+        self._threads = None
+
+    def _release(self, worker: _Worker, broken: bool):
+        if broken:
+            self.killed += 1
+            worker.kill()
+            worker = self._spawn()
+        elif self.max_jobs and worker.jobs >= self.max_jobs:
+            # The worker exits by itself at this point, so just wait for it.
+            self.recycled += 1
+            self.loop.run_in_executor(self._threads, worker.retire)
+            worker = self._spawn()
+        self._idle.put_nowait(worker)
+
+    async def extract(self, url: str, options: dict, group: str = None) -> dict:
+        """
+        Extracts info for a URL without downloading it, like `YoutubeDL(options).extract_info(url, download=False)`.
+
+        `group` is used to cancel jobs with `cancel`, and is usually the server ID.
+        """
+        if not self.enabled:
+            ydl = functools.partial(_extract_in_thread, url, options)
+            return await executors.get_executor("voice-extraction").run(ydl, loop=self.loop)
+
+        self.start()
+        self._waiting += 1
+        try:
+            worker = await self._idle.get()
+        finally:
+            self._waiting -= 1
+        if worker is None:
+            raise ExtractionError("The extraction service was stopped")
+        if not worker.alive():
+            worker.kill()
+            worker = self._spawn()
+
+        fut = self.loop.run_in_executor(self._threads, worker.call, url, options, self.timeout)
+        self._jobs[group].add(fut)
+        broken = True
+        try:
+            with metrics.time_hook("voice_extraction", "extract"):
+                ok, result = await fut
+            broken = False
+        except asyncio.CancelledError:
+            if fut in self._cancelled:
+                raise ExtractionCancelled("Extraction of {} was cancelled".format(url))
+            raise
+        except ExtractionTimeout:
+            metrics.incr("voice_extraction.timeouts")
+            raise
+        except (EOFError, OSError) as e:
+            raise ExtractionError("youtube_dl worker died: {}".format(e))
+        finally:
+            self._cancelled.discard(fut)
+            self._jobs[group].discard(fut)
+            if not self._jobs[group]:
+                del self._jobs[group]
+            worker.jobs += 1
+            if self.started:
+                self._release(worker, broken)
+            else:
+                worker.kill()
+
+        if not ok:
+            raise ExtractionError(result)
+        return result
+
+    def cancel(self, group: str) -> int:
+        """
+        Cancels the running jobs for a group. Their workers are killed and replaced.
+        Returns the number of jobs cancelled.
+        """
+        futures = self._jobs.get(group, ())
+        for fut in futures:
+            self._cancelled.add(fut)
+            fut.cancel()
+        return len(futures)
+
+    def stats(self) -> dict:
+        return {
+            "workers": self.worker_count, "idle": self._idle.qsize() if self.started else 0,
+            "running": sum(len(futures) for futures in self._jobs.values()),
+            "recycled": self.recycled, "killed": self.killed
+        }
+
+
+def _extract_in_thread(url: str, options: dict):
+    import youtube_dl
+    return youtube_dl.YoutubeDL(options).extract_info(url, download=False)
+
+
+extractor = ExtractionService()
@@ -23,16 +23,14 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 
 # Contains the overridded voice client class.
 import asyncio
-import functools
 import logging
 import random
 from math import trunc, ceil
 
 import discord
-import youtube_dl
-
 from navalbot.api import db
 from navalbot.api.contexts import CommandContext
+from navalbot.voice import extraction
 
 logger = logging.getLogger("NavalBot::Voice")
 
@@ -127,12 +125,8 @@ class NavalVoiceClient(discord.VoiceClient):
 
         logger.info("Fixing up track {}...".format(wp_url))
 
-        ydl = youtube_dl.YoutubeDL(
-            {"format": 'webm[abr>0]/bestaudio/best', "ignoreerrors": True, "source_address": "0.0.0.0"})
-
         # Await to get the new item.
-        func = functools.partial(ydl.extract_info, wp_url, download=False)
-        data = await self.loop.run_in_executor(None, func)
+        data = await extraction.extractor.extract(wp_url, extraction.FIXUP_OPTIONS, group=self.server.id)
 
         logger.info("Fixed up track {}, got new URL: {}".format(wp_url, download_url != data.get("url")))
 
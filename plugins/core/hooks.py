@@ -6,13 +6,13 @@ These were previously stored in the bot class, but they are now separate.
 
 This means default message processing can be disabled easily, and delegated to a different handler.
 """
+import asyncio
 import logging
 import traceback
 
 import discord
 from navalbot import builtins
 
-from navalbot.api import db
 from navalbot.api.botcls import NavalClient
 from navalbot.api.commands import commands, Command
 from navalbot.api.contexts import OnMessageEventContext
@@ -21,7 +21,45 @@ from navalbot.api.hooks import on_event
 logger = logging.getLogger("NavalBot")
 
 
-@on_event("on_message")
+async def _run_command(ctx: OnMessageEventContext, coro, snapshot, prefix: str):
+    """
+    Runs a command, replying with the traceback if it errors.
+    """
+    try:
+        if isinstance(coro, Command):
+            try:
+                await coro.invoke(ctx)
+            except discord.Forbidden:
+                await ctx.client.send_message(ctx.channel, ctx.locale["generic.bad_permission"])
+                return
+            # Delete automatically, only if invocation was successful.
+            autodelete = True if snapshot.get_config("autodelete") == "True" else False
+            if autodelete and ctx.message.content.startswith(prefix):
+                try:
+                    await ctx.client.delete_message(ctx.message)
+                except discord.Forbidden:
+                    return
+        else:
+            await coro(ctx.client, ctx.message, snapshot=snapshot, tokens=ctx.get_tokens(prefix))
+    except asyncio.CancelledError:
+        raise
+    except Exception:
+        tb = traceback.format_exc()
+        # The limit is 2000.
+        # But use 1500 anyway.
+        if len(tb) > 1500:
+            async with ctx.client.web.post("http://dpaste.com/api/v2/", data={"content": tb}) as p:
+                await ctx.client.send_message(ctx.message.channel,
+                                              ":exclamation: Error encountered: {}".format(await p.text()))
+        else:
+            await ctx.client.send_message(ctx.message.channel, content="```\n{}\n```".format(tb))
+        logger.error("Caught exception in command {}".format(ctx.get_tokens(prefix).command))
+        traceback.print_exc()
+
+
+# Only parsing and the blacklist check run here; the command itself runs as its own task, so long commands
+# (?play, ?setup, ?repl) don't hold the scheduler worker for this guild.
+@on_event("on_message", needs=(), timeout=0, essential=True)
 async def command_processor(ctx: OnMessageEventContext):
     """
     This is the default command processor for the bot.
@@ -32,41 +70,19 @@ async def command_processor(ctx: OnMessageEventContext):
         # Ignore bot messages.
         return
 
-    prefix = await db.get_config(ctx.message.server.id, "command_prefix", "?")
+    snapshot = await ctx.get_snapshot()
+    prefix = snapshot.get_config("command_prefix", "?")
 
     if ctx.message.content.startswith(prefix):
-        cmd_content = ctx.message.content[len(prefix):]
-        cmd_word = cmd_content.split(" ")[0].lower()
+        # Only load the locale and check the blacklist once we know this is a command.
+        await ctx.resolve("locale", "blacklist")
+        if ctx.blacklisted:
+            logger.info("Ignoring command from blacklisted user {}.".format(ctx.member.display_name))
+            return
+        cmd_word = ctx.get_tokens(prefix).command.lower()
         try:
             coro = commands[cmd_word]
         except KeyError as e:
             logger.warning("-> No such command: " + str(e))
             coro = builtins.default
-        try:
-            if isinstance(coro, Command):
-                try:
-                    await coro.invoke(ctx)
-                except discord.Forbidden:
-                    await ctx.client.send_message(ctx.channel, ctx.locale["generic.bad_permission"])
-                    return
-                # Delete automatically, only if invocation was successful.
-                autodelete = True if await db.get_config(ctx.message.server.id, "autodelete") == "True" else False
-                if autodelete and ctx.message.content.startswith(prefix):
-                    try:
-                        await ctx.client.delete_message(ctx.message)
-                    except discord.Forbidden:
-                        return
-            else:
-                await coro(ctx.client, ctx.message)
-        except Exception as e:
-            tb = traceback.format_exc()
-            # The limit is 2000.
-            # But use 1500 anyway.
-            if len(tb) > 1500:
-                async with ctx.client.tb_session.post("http://dpaste.com/api/v2/", data={"content": tb}) as p:
-                    await ctx.client.send_message(ctx.message.channel,
-                                                  ":exclamation: Error encountered: {}".format(await p.text()))
-            else:
-                await ctx.client.send_message(ctx.message.channel, content="```\n{}\n```".format(traceback.format_exc()))
-            # Allow it to fall through.
-            raise
+        ctx.client.start_command(_run_command(ctx, coro, snapshot, prefix), ctx.message)
@@ -24,6 +24,7 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 import asyncio
 import datetime
 import functools
+import io
 import os
 import random
 
@@ -39,7 +40,7 @@ import urbandict
 import pytz
 from google import search
 
-from navalbot.api import db, util
+from navalbot.api import db, executors, lagmonitor, metrics, util
 from navalbot.api.commands import command
 from navalbot.api.commands.cmdclass import NavalRole
 from navalbot.api.contexts import CommandContext
@@ -65,15 +66,17 @@ def _get_google(f):
     return list(f())[0]
 
 
-@command("google", argcount="?")
+async def _search_google(userinput: str) -> str:
+    return await util.with_threading(functools.partial(_get_google, functools.partial(search, userinput, stop=1)))
+
+
+@command("google", argcount="?", priority="low")
 async def google(ctx: CommandContext):
     """
     Searches google for the top two results for the search.
     """
     userinput = ' '.join(ctx.args)
-    f = functools.partial(search, userinput, stop=1)
-    f2 = functools.partial(_get_google, f)
-    l = await util.with_threading(f2)
+    l = await util.with_cache(userinput, expires=3600, miss=_search_google, namespace="google")
     await ctx.client.send_message(ctx.message.channel, l)
 
 
@@ -83,7 +86,8 @@ def _get_weather(api_key, userinput):
     return observation
 
 
-@command("weather", argcount="?", argerror=":x: You must specify a village/town/city/settlement to query!")
+@command("weather", argcount="?", priority="low",
+         argerror=":x: You must specify a village/town/city/settlement to query!")
 async def weather(ctx: CommandContext):
     """
     Displays the weather of a specified place.
@@ -194,9 +198,77 @@ async def stats(ctx: CommandContext):
                                                       shard_count=ctx.client.shard_count) + "\n"
     else:
         shardm = ""
+    sched = ctx.client.scheduler.stats()
     await ctx.reply("fun.stats.response",
                     shardm=shardm, servcount=server_count, msgcount=msgcount, vcount=voice_clients,
-                    scount=streams, memcount=used_memory, tasks=tasks)
+                    scount=streams, memcount=used_memory, tasks=tasks,
+                    queued=sched["queued"], dropped=sched["dropped"], lag=ctx.client.lag.lag * 1000,
+                    shedlevel=ctx.client.lag.level, shedname=lagmonitor.LEVEL_NAMES[ctx.client.lag.level])
+
+
+@command("queues", owner=True)
+async def queues(ctx: CommandContext):
+    """
+    Displays the guilds with the most queued events.
+    """
+    depths = ctx.client.scheduler.depths()
+    if not depths:
+        await ctx.reply("fun.queues.none")
+        return
+
+    s = ctx.locale["fun.queues.header"]
+    for guild_id, depth in sorted(depths.items(), key=lambda i: i[1], reverse=True)[:15]:
+        server = ctx.client.get_server(guild_id) if guild_id else None
+        s += ctx.locale["fun.queues.row"].format(name=server.name if server else guild_id, depth=depth,
+                                                 dropped=ctx.client.scheduler.dropped.get(guild_id, 0))
+    s += "```"
+    await ctx.client.send_message(ctx.channel, s)
+
+
+@command("executors", owner=True)
+async def executor_stats(ctx: CommandContext):
+    """
+    Displays the load on each executor pool.
+    """
+    s = ctx.locale["fun.executors.header"]
+    for name, stats in sorted(executors.get_stats().items()):
+        s += ctx.locale["fun.executors.row"].format(name=name, wait=stats["wait_p95"] * 1000,
+                                                    run=stats["run_p95"] * 1000, **stats)
+    s += "```"
+    await ctx.client.send_message(ctx.channel, s)
+
+
+@command("hookstats", owner=True, argcount="+")
+async def hookstats(ctx: CommandContext):
+    """
+    Displays timing statistics for hooks, slowest first.
+
+    Use `json` as the argument to get the full stats as a JSON file.
+    """
+    if ctx.args and ctx.args[0] == "json":
+        fp = io.BytesIO(metrics.export_json().encode())
+        await ctx.client.send_file(ctx.channel, fp, filename="hookstats.json")
+        return
+
+    rows = []
+    for event, hooks in metrics.get_hook_stats().items():
+        for name, stats in hooks.items():
+            rows.append(("{} -> {}".format(event, name), stats))
+
+    if not rows:
+        await ctx.reply("fun.hookstats.none")
+        return
+
+    # Sort by total time spent, so the hooks eating the event loop are at the top.
+    rows.sort(key=lambda row: row[1]["total"], reverse=True)
+    s = ctx.locale["fun.hookstats.header"]
+    for name, stats in rows[:15]:
+        s += ctx.locale["fun.hookstats.row"].format(
+            name=name, count=stats["count"], errors=stats["errors"],
+            p50=stats["p50"] * 1000, p95=stats["p95"] * 1000, p99=stats["p99"] * 1000
+        )
+    s += "```"
+    await ctx.client.send_message(ctx.channel, s)
 
 
 def _get_urban(get):
@@ -204,12 +276,17 @@ def _get_urban(get):
     return define['word'], define['def'], define['example']
 
 
-@command("urban", argcount="?", argerror=":x: You must provide a word or phrase.")
+async def _search_urban(word: str) -> list:
+    return await util.with_threading(functools.partial(_get_urban, word))
+
+
+@command("urban", argcount="?", priority="low", argerror=":x: You must provide a word or phrase.")
 async def urban(ctx: CommandContext):
     """
     Defines a word using urban dictionary.
     """
-    word, definition, example = await util.with_threading(functools.partial(_get_urban, ' '.join(ctx.args)))
+    word, definition, example = await util.with_cache(' '.join(ctx.args), expires=3600, miss=_search_urban,
+                                                      namespace="urban")
     await ctx.reply("fun.urban", search=word, definition=definition, example=example)
 
 
@@ -224,7 +301,7 @@ def _get_sr_data(arg):
     return sub.url
 
 
-@command("sr", "subreddit", argcount=1, argerror=":x: You must provide a subreddit.")
+@command("sr", "subreddit", argcount=1, priority="low", argerror=":x: You must provide a subreddit.")
 async def subreddit(ctx: CommandContext):
     """
     Fetches random post from subreddit's front page.
@@ -22,10 +22,9 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 """
 import os
 
-import aioredis
 import discord
 
-from navalbot.api import db, util
+from navalbot.api import db, permissions, util
 from navalbot.api.commands import commands, command
 from navalbot.api.commands.cmdclass import NavalRole
 from navalbot.api.contexts import CommandContext
@@ -102,10 +101,7 @@ async def add_role_override(ctx: CommandContext):
         await ctx.reply("core.cfg.bad_override")
         return
 
-    # Set in aioredis
-    async with (await util.get_pool()).get() as conn:
-        assert isinstance(conn, aioredis.Redis)
-        conn.sadd("override:{}:{}".format(ctx.message.server.id, ctx.args[0]), ctx.args[1])
+    await permissions.add_override(ctx.message.server.id, ctx.args[0], ctx.args[1])
 
     # await client.send_message(message.channel, ":x: Added role override for command {}.".format(command_name))
     await ctx.reply("core.cfg.added_role_override", cmd=ctx.args[0])
@@ -122,10 +118,7 @@ async def remove_role_override(ctx: CommandContext):
         return
 
     role = ctx.args[1]
-    # smse
-    async with (await util.get_pool()).get() as conn:
-        assert isinstance(conn, aioredis.Redis)
-        conn.srem("override:{}:{}".format(ctx.message.server.id, command_name), role)
+    await permissions.remove_override(ctx.message.server.id, command_name, role)
 
     await ctx.reply("core.cfg_removed_role_override", cmd=command_name)
 
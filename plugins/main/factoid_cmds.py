@@ -20,10 +20,11 @@ along with this program.  If not, see <http://www.gnu.org/licenses/>
 
 =================================
 """
-import aioredis
+import fnmatch
+
 import discord
 
-from navalbot.api import db, util
+from navalbot.api import db
 from navalbot.api.commands import command
 from navalbot.api.contexts import CommandContext
 
@@ -93,27 +94,21 @@ async def factoids(ctx: CommandContext):
     """
     Searches for factoids with a specific pattern.
     """
-    fac_patt = "config:{}:fac:".format(ctx.message.server.id) + ctx.args[0]
-    pool = await util.get_pool()
-    async with pool.get() as conn:
-        assert isinstance(conn, aioredis.Redis)
-        keys = conn.iscan(match=fac_patt)
+    fac_patt = "fac:" + ctx.args[0]
+    # This is a user-run search, so it may SCAN for factoids that haven't been migrated to the hash yet.
+    config = await db.get_all_config(ctx.message.server.id, legacy_match=fac_patt)
     index, s = 0, ctx.locale["core.factoids.match.header"] + '\n'
     fcs = []
-    async for key in keys:
-        # Decode it
-        key = key.decode()
-        if key.endswith(":locked"):
+    for key in sorted(config):
+        if not fnmatch.fnmatchcase(key, fac_patt) or key.endswith(":locked"):
             continue
-        else:
-            nkey = key.split(":fac:")[1]
+        nkey = key[len("fac:"):]
         if len(nkey) == 0:
             continue
         index += 1
         if index == 20:
             break
-        data = await db.get_config(ctx.message.server.id, "fac:{}".format(nkey))
-        fcs.append((nkey, data))
+        fcs.append((nkey, config[key].decode()))
     # Sort fcs
     fcs = sorted(fcs, key=lambda x: x[0])
     for n, k in enumerate(fcs):
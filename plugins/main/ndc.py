@@ -34,6 +34,7 @@ import traceback
 import aioredis
 
 from navalbot.api import util, db
+from navalbot.api.blacklists import blacklists
 from navalbot.api.botcls import NavalClient
 from navalbot.api.commands import command
 from navalbot.api.contexts import CommandContext
@@ -166,7 +167,7 @@ async def repl(ctx: CommandContext):
 
         if fmt is not None:
             if len(fmt) > 2000:
-                async with ctx.client.tb_session.post("http://dpaste.com/api/v2/", data={"content": fmt}) as p:
+                async with ctx.client.web.post("http://dpaste.com/api/v2/", data={"content": fmt}) as p:
                     await ctx.client.send_message(ctx.message.channel,
                                                   ":exclamation: Error encountered: {}".format(await p.text()))
             else:
@@ -218,7 +219,7 @@ async def globalblacklist(ctx: CommandContext):
         return
 
     # Okay, you asked for it.
-    await ctx.db.add_to_set("global_blacklist", user_id)
+    await blacklists.add(user_id)
     await ctx.reply("core.ndc.globalblacklist_success", u=user_id)
 
 
@@ -235,10 +236,33 @@ async def globalunblacklist(ctx: CommandContext):
     else:
         user_id = user.id
 
-    await ctx.db.remove_from_set("global_blacklist", user_id)
+    await blacklists.remove(user_id)
     await ctx.reply("core.ndc.globalunblacklist", u=user_id)
 
 
+@command("record", owner=True, argcount="+")
+async def record(ctx: CommandContext):
+    """
+    Starts or stops recording gateway traffic.
+    """
+    recorder = ctx.client.recorder
+    action = ctx.args[0] if ctx.args else "status"
+    if action == "start":
+        # `raw` skips anonymising, for recordings that never leave this machine.
+        path = recorder.start(anonymise=False if "raw" in ctx.args[1:] else None)
+        await ctx.reply("core.ndc.record_start", path=path)
+    elif action == "stop":
+        path = recorder.stop()
+        if path is None:
+            await ctx.reply("core.ndc.record_not_running")
+            return
+        await ctx.reply("core.ndc.record_stop", path=path, frames=recorder.frames)
+    elif recorder.active:
+        await ctx.reply("core.ndc.record_status", path=recorder.path, frames=recorder.frames)
+    else:
+        await ctx.reply("core.ndc.record_not_running")
+
+
 @command("plugins")
 async def plugins(ctx: CommandContext):
     """
@@ -27,6 +27,7 @@ import asyncio
 
 import discord
 
+from navalbot.api.blacklists import blacklists
 from navalbot.api.commands import command
 from navalbot.api.contexts import CommandContext
 from navalbot.api.commands.cmdclass import NavalRole
@@ -359,7 +360,7 @@ async def blacklist(ctx: CommandContext):
         return
 
     # Add the item to the blacklist.
-    await ctx.db.add_to_set("blacklist:{}".format(ctx.server.id), user.id)
+    await blacklists.add(user.id, server_id=ctx.server.id)
     await ctx.reply("moderation.blacklisted", user=user.display_name)
 
 
@@ -373,7 +374,7 @@ async def unblacklist(ctx: CommandContext):
         await ctx.reply("generic.cannot_find_user", user=ctx.args[0])
         return
 
-    await ctx.db.remove_from_set("blacklist:{}".format(ctx.server.id), user.id)
+    await blacklists.remove(user.id, server_id=ctx.server.id)
     await ctx.reply("moderation.unblacklisted", user=user.display_name)
 
 
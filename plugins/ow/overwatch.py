@@ -5,6 +5,8 @@ import logging
 
 import aiohttp
 
+from navalbot.api import util
+from navalbot.api.cache import async_cache
 from navalbot.api.commands import command
 from navalbot.api.contexts import CommandContext
 
@@ -13,19 +15,20 @@ OWAPI_BASE_URL = "https://owapi.net"
 logger = logging.getLogger("NavalBot")
 
 
+# Profiles barely change between lookups, and unknown battletags are cached briefly so they can't hammer owapi.
+@async_cache(maxsize=256, ttl=300, negative_ttl=60)
 async def get_profile_json(btag: str, endpoint: str = "stats", version=1) -> dict:
     """
     Get the profile JSON using owapi.
     """
     url = OWAPI_BASE_URL + "/api/v{}/u/{}/{}/general".format(version, btag, endpoint)
     logger.info("GET => {}".format(url))
-    async with aiohttp.ClientSession() as sess:
-        async with sess.get(url) as r:
-            assert isinstance(r, aiohttp.ClientResponse)
-            if r.status != 200:
-                # Usually a 404.
-                return None
-            return await r.json()
+    async with util.get_http_client().get(url) as r:
+        assert isinstance(r, aiohttp.ClientResponse)
+        if r.status != 200:
+            # Usually a 404.
+            return None
+        return await r.json()
 
 
 async def get_stats_formatted(btag: str) -> str:
@@ -6,10 +6,10 @@ import discord
 from navalbot.api import db
 from navalbot.api.commands import command
 from navalbot.api.contexts import CommandContext, OnMessageEventContext
-from navalbot.api.hooks import on_message
+from navalbot.api.hooks import on_event
 
 
-@on_message
+@on_event("on_message", needs=("blacklist",))
 async def check_pm_mention(ctx: OnMessageEventContext):
     """
     PMs a user if they have PM mentions enabled.
@@ -25,13 +25,13 @@ import re
 from concurrent.futures import TimeoutError
 
 import discord
-import youtube_dl
 
 from navalbot.api import db
 from navalbot.api import util
 from navalbot.api.commands import command
 from navalbot.api.commands.cmdclass import NavalRole
 from navalbot.api.contexts import CommandContext
+from navalbot.voice import extraction
 from .stores import voice_locks
 
 # Get loop
@@ -61,7 +61,8 @@ async def _fix_voice(client: discord.Client, vc: discord.VoiceClient, channel: d
 
 @command("reset", "disconnect", roles={NavalRole.ADMIN, NavalRole.BOT_COMMANDER, NavalRole.VOICE})
 async def reset(ctx: CommandContext):
-    # Unlock the lock, if it's locked.
+    # Stop any extraction that's still running, and unlock the lock, if it's locked.
+    extraction.extractor.cancel(ctx.message.server.id)
     lock = voice_locks.get(ctx.message.server.id)
     if lock:
         del voice_locks[ctx.message.server.id]
@@ -170,10 +171,7 @@ async def play(ctx: CommandContext):
     qsize = await db.get_config(ctx.message.server.id, "max_queue", default=99, type_=int)
 
     # Use fallback for soundcloud, if possible
-    ydl = youtube_dl.YoutubeDL({
-        "format": 'best', "ignoreerrors": True, "playlistend": qsize,
-        "default_search": "ytsearch", "source_address": "0.0.0.0"})
-    func = functools.partial(ydl.extract_info, vidname, download=False)
+    options = dict(extraction.PLAYBACK_OPTIONS, playlistend=qsize)
     # Set the download lock.
     lock = voice_locks.get(ctx.message.server.id)
     assert isinstance(lock, asyncio.Lock)
@@ -182,7 +180,7 @@ async def play(ctx: CommandContext):
             await ctx.reply("voice.playback.wait_for")
         await lock.acquire()
         await ctx.reply("voice.playback.downloading")
-        info = await loop.run_in_executor(None, func)
+        info = await extraction.extractor.extract(vidname, options, group=ctx.message.server.id)
         try:
             lock.release()
         except RuntimeError:
@@ -191,7 +189,9 @@ async def play(ctx: CommandContext):
             except Exception:
                 pass
     except Exception as e:
-        await ctx.reply("voice.playback.ytdl_error", err=e)
+        # A ?reset cancels the extraction, and has already replied.
+        if not isinstance(e, extraction.ExtractionCancelled):
+            await ctx.reply("voice.playback.ytdl_error", err=e)
         try:
             lock.release()
         except RuntimeError:
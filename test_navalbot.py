@@ -57,6 +57,45 @@ async def test_on_ready():
         assert data.name == "Type ?info for help!"
 
 
+@pytest.mark.asyncio
+async def test_long_command_does_not_block():
+    """
+    Tests that a running command doesn't hold its guild's scheduler worker, so the next message is still handled.
+    """
+    from navalbot.api.commands import command, commands
+    from navalbot.api.scheduler import FairScheduler
+    release = asyncio.Event()
+
+    @command("testwait")
+    async def testwait(ctx):
+        await release.wait()
+        await ctx.client.send_message(ctx.channel, "done")
+
+    def make_message(content):
+        msg = discord.Message(**guild_data_dump.msg["d"])
+        msg.server, msg.channel, msg.content = testing_server, testing_channel, content
+        return msg
+
+    scheduler = tc.scheduler
+    tc.scheduler = FairScheduler(loop=tc.loop, workers=1, max_per_guild=1)
+    try:
+        with tc:
+            tc.dispatch("message", make_message("?testwait"))
+            tc.dispatch("message", make_message("?fullwidth abc"))
+            for _ in range(200):
+                if tc.collect("send_message"):
+                    break
+                await asyncio.sleep(0.01)
+            assert [content for _, content in tc.collect("send_message")] == ["ａｂｃ"]
+            release.set()
+            await tc.wait_for_commands()
+            assert tc.collect("send_message")[-1][1] == "done"
+    finally:
+        tc.scheduler.stop()
+        tc.scheduler = scheduler
+        del commands["testwait"]
+
+
 def test_locale_loader():
     """
     Tests a the LocaleLoader.
@@ -86,3 +125,320 @@ async def test_command_firing():
         results = tc.collect("send_message")
         assert tc.errored is False
         assert results[0][1] == "ａｂｃ"
+
+
+def test_config_cache():
+    """
+    Tests the LRU and TTL behaviour of the config cache.
+    """
+    from navalbot.api import db
+    cache = db.ConfigCache(size=2, ttl=60)
+    cache.put("config:1:a", b"1")
+    cache.put("config:1:b", None)
+    # Unset keys are cached as None, so they don't go to redis every time.
+    assert cache.get("config:1:b") is None
+    cache.put("config:1:c", b"3")
+    assert cache.get("config:1:a") is db._MISSING
+    assert cache.evictions == 1
+    cache.invalidate("config:1:c")
+    assert cache.get("config:1:c") is db._MISSING
+    cache.put("config:2:a", b"1")
+    cache.invalidate_server("2")
+    assert cache.get("config:2:a") is db._MISSING
+    assert len(cache) == 1
+
+
+@pytest.mark.asyncio
+async def test_config_cache_with_client():
+    """
+    Tests that config reads through the test client are served from the config cache.
+    """
+    from navalbot.api import db
+    with tc:
+        await db.set_config(testing_server.id, "test_cached", "1")
+        assert await db.get_config(testing_server.id, "test_cached") == "1"
+        hits = db.config_cache.hits
+        assert await db.get_config(testing_server.id, "test_cached") == "1"
+        assert db.config_cache.hits == hits + 1
+        await db.delete_config(testing_server.id, "test_cached")
+        assert await db.get_config(testing_server.id, "test_cached") is None
+
+
+@pytest.mark.asyncio
+async def test_async_cache():
+    """
+    Tests that concurrent misses share one load, and that negative results use their own TTL.
+    """
+    from navalbot.api.cache import async_cache
+    calls = []
+
+    @async_cache(maxsize=2, ttl=60, negative_ttl=0)
+    async def lookup(key):
+        calls.append(key)
+        await asyncio.sleep(0)
+        return None if key == "missing" else key * 2
+
+    assert await asyncio.gather(lookup(1), lookup(1), lookup(1)) == [2, 2, 2]
+    assert calls == [1]
+    assert lookup.cache.coalesced == 2
+    # Typed keys, so 1.0 isn't served the entry for 1.
+    assert await lookup(1.0) == 2.0 and len(calls) == 2
+    await lookup("missing")
+    await lookup("missing")
+    assert calls.count("missing") == 2
+    await lookup(3)
+    assert lookup.cache.evictions == 1
+    lookup.invalidate(3)
+    assert len(lookup.cache) == 1
+
+
+@pytest.mark.asyncio
+async def test_blacklist_delta_during_load(monkeypatch):
+    """
+    Tests that concurrent first lookups share one load, and that deltas arriving during it aren't lost.
+    """
+    from navalbot.api import util
+    from navalbot.api.blacklists import Blacklists
+    lists = Blacklists()
+    loading, finish = asyncio.Event(), asyncio.Event()
+    calls = []
+
+    class Conn:
+        async def smembers(self, key):
+            calls.append(key)
+            loading.set()
+            await finish.wait()
+            return [b"1"]
+
+    class Pool:
+        def get(self):
+            return self
+
+        async def __aenter__(self):
+            return Conn()
+
+        async def __aexit__(self, *args):
+            pass
+
+    async def get_pool():
+        return Pool()
+
+    monkeypatch.setattr(util, "get_pool", get_pool)
+    lookups = [asyncio.ensure_future(lists.is_blacklisted("1", user_id)) for user_id in ("1", "2")]
+    await loading.wait()
+    lists.apply("add", "1", "2")
+    lists.apply("remove", "1", "1")
+    finish.set()
+    assert await asyncio.gather(*lookups) == [False, True]
+    assert calls == ["blacklist:1"]
+
+
+@pytest.mark.asyncio
+async def test_global_blacklist_delta_during_load(monkeypatch):
+    """
+    Tests that global deltas arriving while the bloom filter is being loaded are replayed onto it.
+    """
+    from navalbot.api import util
+    from navalbot.api.backends.memory import MemoryBackend, MemoryConnection
+    from navalbot.api.blacklists import Blacklists, GLOBAL_KEY
+    lists = Blacklists()
+    backend = MemoryBackend({})
+    pool = await backend.create_pool()
+    async with pool.get() as conn:
+        await conn.sadd(GLOBAL_KEY, "1")
+    scard = MemoryConnection.scard
+
+    def scard_during_changes(self, key):
+        # The scan after this reads the set from before these changes.
+        lists.apply("add", None, "2")
+        lists.apply("remove", None, "1")
+        return scard(self, key)
+
+    async def get_pool():
+        return pool
+
+    monkeypatch.setattr(util, "get_pool", get_pool)
+    monkeypatch.setattr(MemoryConnection, "scard", scard_during_changes)
+    assert await lists.is_globally_blacklisted("2")
+    assert not await lists.is_globally_blacklisted("1")
+    await backend.close()
+
+
+def test_tokens():
+    """
+    Tests that the tokenizer splits like shlex, with and without quotes.
+    """
+    from navalbot.api.tokens import Tokens
+    assert Tokens("play  some\tsong").args() == ["some", "song"]
+    assert Tokens('setcfg "command prefix" !').args() == ["command prefix", "!"]
+    # Unbalanced quotes fall back to splitting on spaces.
+    assert Tokens('say "hi there').args() == ['"hi', "there"]
+    assert Tokens('say "a b"').args(split_words=True) == ['"a', 'b"']
+    assert Tokens("Kick user").command == "Kick"
+
+
+def test_command_plan():
+    """
+    Tests that checks which don't need redis are planned before the ones that do.
+    """
+    from navalbot.api.commands.cmdclass import Command, NavalRole
+
+    async def kick(ctx):
+        pass
+
+    cmd = Command(kick, "kick", argcount=1, owner=True, roles={NavalRole.ADMIN}, priority="low")
+    assert [stage for stage, _ in cmd._plan] == ["shed", "owner", "args", "disabled", "roles"]
+    # The usage message is built without redis, too.
+    assert cmd._construct_arg_error_msg("!", {"help.None": "No help."}) == "```!(kick) <1 arguments>\n\nNo help.\n```"
+
+
+def test_permission_snapshot():
+    """
+    Tests that permission snapshots compile role names, overrides and disabled commands.
+    """
+    from navalbot.api.commands.cmdclass import NavalRole
+    from navalbot.api.permissions import PermissionSnapshot
+    perms = PermissionSnapshot("1", {"role:admin": b"Boss", "disabled:kick": b"True", "disabled:ban:2": b"True",
+                                     "disabled:play": b"False"}, {"kick": frozenset({"Mods"})})
+    assert perms.roles_for("kick", {NavalRole.ADMIN}) == ({"Boss"}, {"Boss", "Mods"})
+    assert perms.roles_for("ban", {NavalRole.VOICE}) == ({"Voice"}, {"Voice"})
+    assert perms.is_disabled("kick")
+    assert not perms.is_disabled("ban") and perms.is_disabled("ban", "2")
+    assert not perms.is_disabled("play")
+
+
+@pytest.mark.asyncio
+async def test_permission_load(monkeypatch):
+    """
+    Tests that permission loads find old-layout keys and unindexed overrides, and index them.
+    """
+    from navalbot.api import permissions, util
+    from navalbot.api.backends.memory import MemoryBackend
+    backend = MemoryBackend({})
+    pool = await backend.create_pool()
+
+    async def get_pool():
+        return pool
+
+    monkeypatch.setattr(util, "get_pool", get_pool)
+    async with pool.get() as conn:
+        await conn.hmset("config:1", "role:admin", "Boss", "disabled:ban:7", "True", "fac:big", "not loaded")
+        await conn.set("config:1:role:admin", "Old")
+        await conn.set("config:1:disabled:play:9", "True")
+        await conn.sadd("override:1:ban", "Mods")
+    perms, = await permissions.PermissionCache()._load_many(["1"])
+    assert perms.role_names == {"admin": "Boss"} and perms.overrides == {"ban": frozenset({"Mods"})}
+    assert perms.user_disabled == {("ban", "7"), ("play", "9")}
+    async with pool.get() as conn:
+        assert await conn.smembers(permissions.OVERRIDE_INDEX_KEY.format("1")) == [b"ban"]
+    await backend.close()
+
+
+@pytest.mark.asyncio
+async def test_fair_scheduler():
+    """
+    Tests that a flooded guild doesn't starve other guilds, and that overflow is dropped.
+    """
+    from navalbot.api.scheduler import FairScheduler
+    sched = FairScheduler(loop=asyncio.get_event_loop(), workers=1, queue_size=5, max_per_guild=1)
+    order = []
+
+    async def job(guild_id):
+        order.append(guild_id)
+
+    for _ in range(10):
+        sched.submit("flood", job, "flood")
+    sched.submit("quiet", job, "quiet")
+    assert sched.dropped["flood"] == 5
+    assert sched.depths() == {"flood": 5, "quiet": 1}
+
+    while sched.depths():
+        await asyncio.sleep(0)
+    sched.stop()
+    # The quiet guild is served after one job from the flooded guild, not after all of them.
+    assert order.index("quiet") == 1
+
+
+@pytest.mark.asyncio
+async def test_bounded_executor():
+    """
+    Tests that an executor pool rejects jobs once its queue is full.
+    """
+    import threading
+    from navalbot.api.executors import BoundedExecutor, ExecutorOverloaded
+    pool = BoundedExecutor("test", workers=1, queue_size=1)
+    release = threading.Event()
+    jobs = [asyncio.ensure_future(pool.run(release.wait)) for _ in range(2)]
+    await asyncio.sleep(0.05)
+    assert pool.active == 1 and pool.queued == 1
+    with pytest.raises(ExecutorOverloaded):
+        await pool.run(release.wait)
+    release.set()
+    assert await asyncio.gather(*jobs) == [True, True]
+    assert pool.stats()["rejected"] == 1 and pool.completed == 2
+    pool.shutdown()
+
+
+def test_lag_monitor():
+    """
+    Tests that the shedding level rises with loop lag, and only falls once the lag is well under the threshold.
+    """
+    from navalbot.api import lagmonitor
+    mon = lagmonitor.LagMonitor(thresholds=(0.1, 0.25, 0.5), smoothing=1.0)
+    mon.update(0.3)
+    assert mon.level == lagmonitor.SHED_HOOKS
+    mon.update(0.2)
+    assert mon.level == lagmonitor.SHED_HOOKS
+    mon.update(0.01)
+    assert mon.level == lagmonitor.SHED_NONE
+
+
+@pytest.mark.asyncio
+async def test_memory_backend():
+    """
+    Tests the in-memory storage backend.
+    """
+    from navalbot.api.backends.memory import MemoryBackend
+    backend = MemoryBackend({})
+    pool = await backend.create_pool()
+    async with pool.get() as conn:
+        await conn.set("config:1:lang", "en")
+        assert await conn.mget("config:1:lang", "config:1:missing") == [b"en", None]
+        await conn.sadd("blacklist:1", "123", "456")
+        assert await conn.sismember("blacklist:1", "123") == 1
+        assert [key async for key in conn.iscan(match="config:1:*")] == [b"config:1:lang"]
+        await conn.set("cached:a", "1", expire=-1)
+        assert await conn.get("cached:a") is None
+        await conn.hmset("config:1", "lang", "en", "command_prefix", "!")
+        await conn.hdel("config:1", "lang")
+        assert await conn.hgetall("config:1") == {b"command_prefix": b"!"}
+        assert await conn.hscan("config:1", match="command_*") == (0, [(b"command_prefix", b"!")])
+    await backend.close()
+
+
+@pytest.mark.asyncio
+async def test_sqlite_backend(tmpdir):
+    """
+    Tests the SQLite storage backend, including that writes survive a restart.
+    """
+    from navalbot.api.backends.sqlite import SqliteBackend
+    path = str(tmpdir.join("navalbot.db"))
+    backend = SqliteBackend({"path": path})
+    pool = await backend.create_pool()
+    async with pool.get() as conn:
+        await conn.set("config:1:fac:hello", "world")
+        await conn.set("config:2:fac:other", "x")
+        await conn.sadd("blacklist:1", "123", "456")
+        await conn.srem("blacklist:1", "456")
+        await conn.hset("config:1", "lang", "en")
+        # Pending writes are visible before they are committed.
+        assert [key async for key in conn.iscan(match="config:1:fac:*")] == [b"config:1:fac:hello"]
+    await backend.close()
+
+    backend = SqliteBackend({"path": path})
+    pool = await backend.create_pool()
+    async with pool.get() as conn:
+        assert await conn.get("config:1:fac:hello") == b"world"
+        assert await conn.smembers("blacklist:1") == [b"123"]
+        assert await conn.hget("config:1", "lang") == b"en"
+    await backend.close()
@@ -0,0 +1,42 @@
+"""
+Runs the synthetic message-flood benchmark.
+
+This uses the storage backend configured in `test_client.yml`, and no connection to Discord.
+Set `backend: memory` under `redis` to run without a redis server; otherwise use a separate redis database, as the
+benchmark writes factoids and settings for its fake guilds.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath("."))
+
+parser = argparse.ArgumentParser(description="Benchmark NavalBot's message handling.")
+parser.add_argument("-n", "--messages", type=int, default=2000, help="Number of messages to send.")
+parser.add_argument("-c", "--concurrency", type=int, default=1, help="Messages in flight at once.")
+parser.add_argument("-g", "--guilds", type=int, default=10, help="Number of fake guilds.")
+parser.add_argument("-m", "--mix", default="default", help="Traffic mix to use.")
+parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+args = parser.parse_args()
+
+# The client reads its config file from argv.
+sys.argv = sys.argv[:1]
+
+from navalbot.testing import bench, fakes
+
+if args.mix not in bench.MIXES:
+    parser.error("Unknown mix `{}`, choose from: {}".format(args.mix, ", ".join(sorted(bench.MIXES))))
+
+loop = asyncio.get_event_loop()
+
+client = fakes.FakeTransportClient()
+benchmark = bench.Benchmark(client, guilds=args.guilds, mix=args.mix, seed=args.seed)
+result = loop.run_until_complete(benchmark.run(args.messages, concurrency=args.concurrency))
+
+if args.json:
+    print(json.dumps(result, indent=2, sort_keys=True))
+else:
+    print(bench.format_report(result))
@@ -0,0 +1,68 @@
+"""
+Benchmarks the message tokenizer against the old way of splitting commands.
+
+The old path split the content to find the command word, then ran `shlex.split` (falling back to `str.split`) for
+the arguments, and factoid commands ran `shlex.split` again. The new path tokenizes once, and shares the result.
+"""
+import argparse
+import os
+import random
+import shlex
+import sys
+import timeit
+
+sys.path.insert(0, os.path.abspath("."))
+
+parser = argparse.ArgumentParser(description="Benchmark the message tokenizer.")
+parser.add_argument("-n", "--number", type=int, default=20000, help="Messages to tokenize per run.")
+parser.add_argument("-q", "--quoted", type=float, default=0.1, help="Fraction of messages with quotes.")
+parser.add_argument("--seed", type=int, default=0, help="Random seed.")
+args = parser.parse_args()
+
+from navalbot.api.tokens import Tokens
+
+_WORDS = ["play", "youtube", "the", "song", "please", "user", "admin", "factoid", "weather", "london", "hello"]
+
+
+def make_messages(rng: random.Random, count: int) -> list:
+    messages = []
+    for _ in range(count):
+        words = [rng.choice(_WORDS) for _ in range(rng.randint(1, 8))]
+        if rng.random() < args.quoted and len(words) > 2:
+            words[1] = '"{}'.format(words[1])
+            words[2] = '{}"'.format(words[2])
+        messages.append(" ".join(words))
+    return messages
+
+
+def old_path(text: str):
+    command = text.split(" ")[0]
+    try:
+        cmd_args = shlex.split(text)[1:]
+    except ValueError:
+        cmd_args = text.split(" ")[1:]
+    # Factoid commands split the old content again.
+    try:
+        factoid_args = shlex.split(text)[1:]
+    except ValueError:
+        factoid_args = text.split(" ")[1:]
+    return command, cmd_args, factoid_args
+
+
+def new_path(text: str):
+    tokens = Tokens(text)
+    return tokens.command, tokens.args(), tokens.args()
+
+
+messages = make_messages(random.Random(args.seed), args.number)
+# Both paths must agree before timing them means anything.
+for text in messages:
+    assert old_path(text) == new_path(text), text
+
+results = {}
+for name, func in (("shlex", old_path), ("tokens", new_path)):
+    best = min(timeit.repeat(lambda: [func(text) for text in messages], number=1, repeat=5))
+    results[name] = best
+    print("{:<8} {:8.1f}ms  {:6.2f}us/message".format(name, best * 1000, best / len(messages) * 1e6))
+
+print("speedup: {:.1f}x".format(results["shlex"] / results["tokens"]))
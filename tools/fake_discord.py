@@ -0,0 +1,70 @@
+"""
+Runs the fake Discord server, or the bot against it.
+
+    python tools/fake_discord.py serve --guilds 100 --rate 200
+    python tools/fake_discord.py bot --url http://127.0.0.1:8765
+
+Run them as separate processes, so the server doesn't compete with the bot for its event loop.
+The bot uses `config.yml` as normal, so point its redis settings at a scratch database. Any token will do.
+"""
+import argparse
+import asyncio
+import json
+import logging
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath("."))
+
+parser = argparse.ArgumentParser(description="Load test NavalBot against a fake Discord.")
+sub = parser.add_subparsers(dest="mode")
+
+serve = sub.add_parser("serve", help="Run the fake Discord server.")
+serve.add_argument("--host", default="127.0.0.1")
+serve.add_argument("--port", type=int, default=8765)
+serve.add_argument("-g", "--guilds", type=int, default=10, help="Number of synthetic guilds.")
+serve.add_argument("--members", type=int, default=50, help="Members per guild.")
+serve.add_argument("-r", "--rate", type=float, default=50.0, help="Messages per second to flood. 0 disables.")
+serve.add_argument("-d", "--duration", type=float, default=0.0, help="Seconds to flood for. 0 is forever.")
+serve.add_argument("-m", "--mix", default="default", help="Traffic mix.")
+serve.add_argument("--latency", type=float, default=0.05, help="REST latency in seconds.")
+serve.add_argument("--jitter", type=float, default=0.5, help="REST latency jitter, as a fraction of the latency.")
+serve.add_argument("--rate-limit", type=int, default=5, help="Requests per route per window.")
+serve.add_argument("--rate-limit-per", type=float, default=5.0, help="Rate limit window in seconds.")
+serve.add_argument("--no-echo", action="store_true", help="Don't send the bot's own messages back to it.")
+
+bot = sub.add_parser("bot", help="Run the bot against a fake Discord server.")
+bot.add_argument("--url", default="http://127.0.0.1:8765")
+bot.add_argument("config", nargs="?", default="config.yml")
+
+args = parser.parse_args()
+if args.mode is None:
+    parser.error("Choose a mode: serve or bot.")
+
+# The client reads its config file from argv.
+sys.argv = sys.argv[:1] + ([args.config] if args.mode == "bot" else [])
+
+from navalbot.testing import fake_discord
+
+loop = asyncio.get_event_loop()
+
+if args.mode == "serve":
+    logging.basicConfig(level=logging.INFO)
+    server = fake_discord.FakeDiscord(loop=loop, host=args.host, port=args.port, guilds=args.guilds,
+                                      members=args.members, rate=args.rate, duration=args.duration, mix=args.mix,
+                                      latency=args.latency, jitter=args.jitter, rate_limit=args.rate_limit,
+                                      rate_limit_per=args.rate_limit_per, echo=not args.no_echo)
+    loop.run_until_complete(server.start())
+    try:
+        loop.run_forever()
+    except KeyboardInterrupt:
+        pass
+    loop.run_until_complete(server.stop())
+    print(json.dumps(dict(server.stats), indent=2, sort_keys=True))
+else:
+    fake_discord.patch_discord_urls(args.url)
+
+    from navalbot.api import botcls
+
+    client = botcls.NavalClient()
+    client.navalbot()
@@ -0,0 +1,78 @@
+"""
+Converts server config from one string per key (`config:{sid}:{key}`) to one hash per server (`config:{sid}`).
+
+Run this with `redis.config_dual_read` on (the default), so the bot keeps finding keys that haven't been converted
+yet. It can be run while the bot is up. Values already in a hash are kept, as they are newer than the old copy.
+It also indexes each server's command role overrides (`overrides:{sid}`), which permission loads rely on.
+Once it has finished, set `config_dual_read: false` to skip the fallback reads.
+"""
+import argparse
+import asyncio
+import os
+import sys
+
+import yaml
+
+sys.path.insert(0, os.path.abspath("."))
+
+parser = argparse.ArgumentParser(description="Convert server config to one hash per server.")
+parser.add_argument("-c", "--config", default="config.yml", help="Config file with the `redis` section to use.")
+parser.add_argument("--batch", type=int, default=500, help="Keys to convert per pipeline.")
+parser.add_argument("--keep", action="store_true", help="Keep the old keys, instead of deleting them.")
+args = parser.parse_args()
+
+from navalbot.api import backends
+
+with open(args.config) as f:
+    backend = backends.get_backend(yaml.load(f)["redis"])
+
+
+async def convert(conn, keys: list) -> int:
+    """
+    Converts one batch of old keys, in two pipelined round trips.
+    """
+    values = await conn.mget(*keys)
+
+    pipe = conn.pipeline()
+    converted = 0
+    for key, value in zip(keys, values):
+        # Anything that isn't a string (or has gone since the scan) comes back as None.
+        if value is None:
+            continue
+        _, server_id, name = key.decode().split(":", 2)
+        pipe.hsetnx("config:{}".format(server_id), name, value)
+        converted += 1
+    if not args.keep:
+        pipe.delete(*keys)
+    await pipe.execute()
+    return converted
+
+
+async def migrate():
+    conn = await backend.create_connection()
+    converted = 0
+    keys = []
+    async for key in conn.iscan(match="config:*:*", count=args.batch):
+        keys.append(key)
+        if len(keys) >= args.batch:
+            converted += await convert(conn, keys)
+            keys = []
+            print("Converted {} keys.".format(converted))
+    if keys:
+        converted += await convert(conn, keys)
+
+    indexed = 0
+    pipe = conn.pipeline()
+    async for key in conn.iscan(match="override:*:*", count=args.batch):
+        _, server_id, name = key.decode().split(":", 2)
+        pipe.sadd("overrides:{}".format(server_id), name)
+        indexed += 1
+    await pipe.execute()
+    print("Indexed {} role overrides.".format(indexed))
+
+    conn.close()
+    await backend.close()
+    print("Done, converted {} keys.".format(converted))
+
+
+asyncio.get_event_loop().run_until_complete(migrate())
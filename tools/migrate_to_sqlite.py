@@ -0,0 +1,78 @@
+"""
+Copies a redis dataset into a SQLite database, for the `sqlite` storage backend.
+
+This is a one-shot copy: stop the bot first, so nothing changes on redis while it runs.
+Existing keys in the SQLite database are overwritten.
+"""
+import argparse
+import asyncio
+import os
+import sys
+import time
+
+import aioredis
+import yaml
+
+sys.path.insert(0, os.path.abspath("."))
+
+parser = argparse.ArgumentParser(description="Copy a redis dataset into a SQLite database.")
+parser.add_argument("-c", "--config", default="config.yml", help="Config file with the `redis` section to read.")
+parser.add_argument("-o", "--output", default=None, help="Database to write (default: `redis.path` in the config).")
+parser.add_argument("--batch", type=int, default=1000, help="Keys to copy per transaction.")
+args = parser.parse_args()
+
+from navalbot.api.backends.redis import RedisBackend
+from navalbot.api.backends.sqlite import SqliteStore
+
+with open(args.config) as f:
+    config = yaml.load(f)["redis"]
+
+store = SqliteStore(args.output or config.get("path", "navalbot.db"))
+
+
+async def copy_key(conn: aioredis.Redis, key: bytes):
+    """
+    Reads one key, as a pending write entry for the store.
+    """
+    kind = await conn.type(key)
+    if kind == b"string":
+        value, ttl = await asyncio.gather(conn.get(key), conn.pttl(key))
+        return "str", value, time.time() + ttl / 1000 if ttl > 0 else None
+    if kind == b"set":
+        return "set", set(await conn.smembers(key)), set(), True
+    if kind == b"hash":
+        return "hash", await conn.hgetall(key), True
+    if kind != b"none":
+        print("Skipping {}, as {} keys aren't supported.".format(key.decode(), kind.decode()))
+    return None
+
+
+async def migrate():
+    backend = RedisBackend(config)
+    conn = await backend.create_connection()
+    copied = 0
+    keys = []
+
+    async def copy_batch():
+        nonlocal copied
+        entries = await asyncio.gather(*[copy_key(conn, key) for key in keys])
+        batch = {key.decode(): entry for key, entry in zip(keys, entries) if entry is not None}
+        store.commit_batch(batch)
+        copied += len(batch)
+        keys.clear()
+        print("Copied {} keys.".format(copied))
+
+    async for key in conn.iscan(count=args.batch):
+        keys.append(key)
+        if len(keys) >= args.batch:
+            await copy_batch()
+    if keys:
+        await copy_batch()
+
+    conn.close()
+    store.close_writer()
+    store.close()
+    print("Done, copied {} keys to {}.".format(copied, store.path))
+
+
+asyncio.get_event_loop().run_until_complete(migrate())
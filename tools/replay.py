@@ -0,0 +1,35 @@
+"""
+Replays a gateway recording against a client with no network, and reports latency per event type.
+
+Recordings are made with `?record start` / `?record stop`.
+Commands in the recording touch redis as configured in `test_client.yml`, so point that at a scratch database.
+"""
+import argparse
+import asyncio
+import json
+import os
+import sys
+
+sys.path.insert(0, os.path.abspath("."))
+
+parser = argparse.ArgumentParser(description="Replay recorded gateway traffic.")
+parser.add_argument("recording", help="Path to the recording.")
+parser.add_argument("-s", "--speed", type=float, default=1.0,
+                    help="Speed factor. 1 is real time, 0 is as fast as possible.")
+parser.add_argument("--json", action="store_true", help="Print the results as JSON.")
+args = parser.parse_args()
+
+# The client reads its config file from argv.
+sys.argv = sys.argv[:1]
+
+from navalbot.testing import fakes, replay
+
+loop = asyncio.get_event_loop()
+
+client = fakes.FakeTransportClient()
+result = loop.run_until_complete(replay.Replay(client, args.recording, speed=args.speed).run())
+
+if args.json:
+    print(json.dumps(result, indent=2, sort_keys=True))
+else:
+    print(replay.format_report(result))